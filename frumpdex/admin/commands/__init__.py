@@ -2,6 +2,7 @@
 # Copyright (c) 2020, Adam Meily
 # All rights reserved.
 #
+from .archive_cmd import ArchiveCommand
 from .exchange_cmd import ExchangeCommand
 from .stock_cmd import StockCommand
 from .user_cmd import UserCommand
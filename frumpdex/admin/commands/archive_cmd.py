@@ -0,0 +1,66 @@
+#
+# Copyright (c) 2020, Adam Meily
+# All rights reserved.
+#
+from pypsi.core import Command, PypsiArgParser, CommandShortCircuit
+from pypsi.completers import command_completer
+
+from frumpdex.config import config
+
+
+class ArchiveCommand(Command):
+
+    def __init__(self):
+        super().__init__(name='archive', brief='archive old data')
+        self.parser = PypsiArgParser()
+        self.subcmd = self.parser.add_subparsers(help='subcmd', dest='subcmd', required=True)
+
+        votes_cmd = self.subcmd.add_parser('votes', help='move old votes to the vote archive')
+        votes_cmd.add_argument('-d', '--days', type=int, default=config.archive.vote_max_age_days,
+                               help='archive votes older than this number of days')
+        votes_cmd.add_argument('-b', '--batch-size', type=int, default=config.archive.batch_size,
+                               help='number of votes to move per batch')
+
+        self.subcmd.add_parser('status', help='show vote archive status')
+
+    def complete(self, shell, args, prefix):
+        if len(args) == 1 and args[0].startswith('-'):
+            completions = command_completer(self.parser, shell, args, prefix)
+        else:
+            completions = command_completer(self.subcmd, shell, args, prefix)
+        return completions
+
+    def run(self, shell, args):
+        try:
+            args = self.parser.parse_args(args)
+        except CommandShortCircuit as err:
+            return err.code
+
+        if args.subcmd == 'votes':
+            if args.days < 1:
+                self.error(shell, 'number of days must be at least 1')
+                return 1
+            return self.archive_votes(shell, args.days, args.batch_size)
+
+        if args.subcmd == 'status':
+            return self.print_status(shell)
+
+        self.error(shell, f'unknown sub-command: {args.subcmd}')
+
+    def archive_votes(self, shell, days: int, batch_size: int):
+        count = shell.ctx.db.archive_votes(days, batch_size=batch_size)
+        print(f'archived {count} votes older than {days} days')
+        return 0
+
+    def print_status(self, shell):
+        state = shell.ctx.db.archive_log.find_one({'_id': 'votes'})
+        if not state:
+            print('votes have never been archived')
+            return 0
+
+        print('Archived Before:', state['before'])
+        print('Archived Votes: ', state['count'])
+        print('Last Run:       ', state['date'])
+        print('Live Votes:     ', shell.ctx.db.votes.estimated_document_count())
+        print('Vote Buckets:   ', shell.ctx.db.vote_buckets.estimated_document_count())
+        return 0
@@ -7,7 +7,11 @@ import sys
 from bson import ObjectId
 from pypsi.core import Command, PypsiArgParser, CommandShortCircuit
 from pypsi.format import Table, Column
-from pypsi.completers import command_completer
+from pypsi.completers import command_completer, path_completer
+
+from frumpdex.db import ItemDoesNotExist
+from frumpdex.backup import export_exchange, restore_exchange
+from frumpdex.reconcile import reconcile
 
 class ExchangeCommand(Command):
 
@@ -28,9 +32,44 @@ class ExchangeCommand(Command):
 
         deselect_cmd = self.subcmd.add_parser('deselect', help='deselect active exchange')
 
+        export_cmd = self.subcmd.add_parser('export', help='export an exchange to a compressed '
+                                                           'archive')
+        export_cmd.add_argument('path', help='archive filename (.ndjson.gz or .bson.gz)')
+        export_cmd.add_argument('-e', '--exchange-id', action='store', help='exchange id')
+        export_cmd.add_argument('-f', '--format', choices=('ndjson', 'bson'),
+                                help='archive format (default: detect from filename)')
+        export_cmd.add_argument('-b', '--batch-size', type=int, default=1000,
+                                help='cursor batch size')
+
+        import_cmd = self.subcmd.add_parser('import', help='restore an exchange from an archive')
+        import_cmd.add_argument('path', help='archive filename')
+        import_cmd.add_argument('-f', '--format', choices=('ndjson', 'bson'),
+                                help='archive format (default: detect from filename)')
+        import_cmd.add_argument('-r', '--remap', action='store_true',
+                                help='assign new ids and user tokens to the restored documents')
+        import_cmd.add_argument('-w', '--workers', type=int, default=4,
+                                help='number of parallel insert workers')
+        import_cmd.add_argument('-b', '--batch-size', type=int, default=1000,
+                                help='number of documents per insert batch')
+        import_cmd.add_argument('-s', '--select', action='store_true',
+                                help='select the exchange after restoring it')
+
+        reconcile_cmd = self.subcmd.add_parser('reconcile', help='check stock and user counters '
+                                                                 'against the votes')
+        reconcile_cmd.add_argument('-e', '--exchange-id', action='store',
+                                   help='exchange id (default: the selected exchange)')
+        reconcile_cmd.add_argument('-a', '--all', action='store_true',
+                                   help='reconcile every exchange')
+        reconcile_cmd.add_argument('--fix', action='store_true',
+                                   help='fix discrepancies, also backfills missing user activity')
+        reconcile_cmd.add_argument('-w', '--workers', type=int, default=4,
+                                   help='number of exchanges reconciled in parallel')
+
     def complete(self, shell, args, prefix):
         if len(args) == 1 and args[0].startswith('-'):
             completions = command_completer(self.parser, shell, args, prefix)
+        elif len(args) > 1 and args[0] in ('export', 'import') and not args[-1].startswith('-'):
+            completions = path_completer(args[-1], prefix)
         else:
             completions = command_completer(self.subcmd, shell, args, prefix)
         return completions
@@ -54,6 +93,34 @@ class ExchangeCommand(Command):
             shell.select_exchange(None)
             return 0
 
+        if args.subcmd == 'export':
+            exchange_id = args.exchange_id
+            if not exchange_id and shell.ctx.exchange:
+                exchange_id = shell.ctx.exchange['_id']
+            elif not exchange_id:
+                self.error(shell, 'missing required argument -e/--exchange-id')
+                return 1
+
+            return self.export_exchange(shell, exchange_id, args.path, args.format,
+                                        args.batch_size)
+
+        if args.subcmd == 'import':
+            return self.import_exchange(shell, args.path, args.format, args.remap, args.workers,
+                                        args.batch_size, args.select)
+
+        if args.subcmd == 'reconcile':
+            if args.all:
+                exchange_ids = None
+            elif args.exchange_id:
+                exchange_ids = [args.exchange_id]
+            elif shell.ctx.exchange:
+                exchange_ids = [shell.ctx.exchange['_id']]
+            else:
+                self.error(shell, 'missing required argument -e/--exchange-id or -a/--all')
+                return 1
+
+            return self.reconcile_exchanges(shell, exchange_ids, args.fix, args.workers)
+
         self.error(shell, f'unknown sub-command: {args.subcmd}')
 
     def print_exchanges(self, shell):
@@ -84,3 +151,89 @@ class ExchangeCommand(Command):
         shell.select_exchange(exchange)
         return 0
 
+    def export_exchange(self, shell, exchange_id: str, path: str, fmt: str, batch_size: int):
+        try:
+            counts = export_exchange(shell.ctx.db, exchange_id, path, fmt=fmt,
+                                     batch_size=batch_size)
+        except ItemDoesNotExist as err:
+            self.error(shell, f'failed to export exchange: {err} - {exchange_id}')
+            return 1
+        except OSError as err:
+            self.error(shell, f'failed to write archive: {err}')
+            return 1
+
+        table = Table([Column('Collection'), Column('Documents')], spacing=4)
+        for collection, count in counts.items():
+            table.append(collection, count)
+        table.write(sys.stdout)
+
+        print()
+        print('exported exchange successfully')
+        return 0
+
+    def import_exchange(self, shell, path: str, fmt: str, remap: bool, workers: int,
+                        batch_size: int, select: bool):
+        try:
+            exchange_id, counts = restore_exchange(shell.ctx.db, path, fmt=fmt, remap=remap,
+                                                   workers=workers, batch_size=batch_size)
+        except (OSError, ValueError) as err:
+            self.error(shell, f'failed to restore exchange: {err}')
+            return 1
+
+        table = Table([Column('Collection'), Column('Documents')], spacing=4)
+        for collection, count in counts.items():
+            table.append(collection, count)
+        table.write(sys.stdout)
+
+        print()
+        print('restored exchange successfully')
+        print()
+        print('Id:', exchange_id)
+
+        if select:
+            return self.select_exchange(shell, exchange_id)
+        return 0
+
+    def reconcile_exchanges(self, shell, exchange_ids, fix: bool, workers: int):
+        try:
+            reports = reconcile(shell.ctx.db, exchange_ids, fix=fix, workers=workers)
+        except ItemDoesNotExist as err:
+            self.error(shell, f'failed to reconcile exchange: {err}')
+            return 1
+
+        def format_counters(item, counters):
+            if counters is None:
+                return 'missing'
+            return ', '.join(f'{counter}={counters.get(counter, 0)}' for counter in item.counters)
+
+        for report in reports:
+            found = len(report.discrepancies) + len(report.user_discrepancies)
+            print(f'exchange {report.exchange_id}: checked {report.checked} counter documents, '
+                  f'found {found} discrepancies')
+            if not found:
+                continue
+
+            if report.discrepancies:
+                table = Table([Column('Collection'), Column('Stock Id'), Column('Date'),
+                               Column('Expected'), Column('Actual')], spacing=4)
+                for item in report.discrepancies:
+                    table.append(item.collection, item.stock_id,
+                                 item.day.date() if item.day else '',
+                                 format_counters(item, item.expected),
+                                 format_counters(item, item.actual))
+                table.write(sys.stdout)
+
+            if report.user_discrepancies:
+                table = Table([Column('Collection'), Column('User Id'), Column('Date'),
+                               Column('Expected'), Column('Actual')], spacing=4)
+                for item in report.user_discrepancies:
+                    table.append(item.collection, item.user_id, item.day.date(),
+                                 format_counters(item, item.expected),
+                                 format_counters(item, item.actual))
+                table.write(sys.stdout)
+
+            if fix:
+                print(f'fixed {report.fixed} of {found} discrepancies')
+            print()
+
+        return 0
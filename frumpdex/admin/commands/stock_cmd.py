@@ -5,10 +5,15 @@
 import sys
 
 from bson import ObjectId
+from bson.errors import InvalidId
 from pypsi.core import Command, PypsiArgParser, CommandShortCircuit
 from pypsi.format import Table, Column
 from pypsi.ansi import AnsiCodes
 from pypsi.completers import command_completer
+from slugify import slugify
+
+from frumpdex.db import ItemDoesNotExist
+from frumpdex.admin.records import RecordError, read_records, validate_records
 
 
 class StockCommand(Command):
@@ -22,14 +27,38 @@ class StockCommand(Command):
         list_cmd = self.subcmd.add_parser('list', help='list all stocks in an exchange')
         list_cmd.add_argument('-e', '--exchange-id', action='store', help='exchange id')
 
+        search_cmd = self.subcmd.add_parser('search', help='search stocks by name or symbol')
+        search_cmd.add_argument('query', action='store', help='stock name or symbol')
+        search_cmd.add_argument('-e', '--exchange-id', action='store', help='exchange id')
+        search_cmd.add_argument('-n', '--limit', type=int, default=10,
+                                help='maximum number of results')
+
+        value_cmd = self.subcmd.add_parser('value', help='show current stock values')
+        value_cmd.add_argument('-e', '--exchange-id', action='store', help='exchange id')
+
         create_cmd = self.subcmd.add_parser('new', help='create new stock')
         create_cmd.add_argument('name', action='store', help='stock name')
         create_cmd.add_argument('-s', '--symbol', action='store', help='stock symbol')
         create_cmd.add_argument('-e', '--exchange-id', action='store', help='exchange id')
 
+        import_cmd = self.subcmd.add_parser('import', help='bulk create stocks from a csv or '
+                                                           'ndjson file')
+        import_cmd.add_argument('path', action='store', help='import file, each record has a '
+                                                             '"name" and optional "symbol"')
+        import_cmd.add_argument('-e', '--exchange-id', action='store', help='exchange id')
+        import_cmd.add_argument('-f', '--format', choices=('csv', 'ndjson'),
+                                help='import file format (default: detect from extension)')
+        import_cmd.add_argument('-b', '--batch-size', type=int, default=500,
+                                help='number of stocks to insert per batch')
+
     def complete(self, shell, args, prefix):
         if len(args) == 1 and args[0].startswith('-'):
             completions = command_completer(self.parser, shell, args, prefix)
+        elif (len(args) == 2 and args[0] == 'search' and not prefix.startswith('-') and
+              shell.ctx.exchange):
+            # complete symbols from the in-memory index rather than querying mongo
+            completions = shell.ctx.db.stock_index.complete(shell.ctx.db,
+                                                            shell.ctx.exchange['_id'], prefix)
         else:
             completions = command_completer(self.subcmd, shell, args, prefix)
         return completions
@@ -46,6 +75,26 @@ class StockCommand(Command):
                 exchange_id = shell.ctx.exchange['_id']
             return self.print_stocks(shell, exchange_id)
 
+        if args.subcmd == 'search':
+            exchange_id = args.exchange_id
+            if not exchange_id and shell.ctx.exchange:
+                exchange_id = shell.ctx.exchange['_id']
+            elif not exchange_id:
+                self.error(shell, 'missing required argument -e/--exchange-id')
+                return 1
+
+            return self.search_stocks(shell, exchange_id, args.query, args.limit)
+
+        if args.subcmd == 'value':
+            exchange_id = args.exchange_id
+            if not exchange_id and shell.ctx.exchange:
+                exchange_id = shell.ctx.exchange['_id']
+            elif not exchange_id:
+                self.error(shell, 'missing required argument -e/--exchange-id')
+                return 1
+
+            return self.print_values(shell, exchange_id)
+
         if args.subcmd == 'new':
             exchange_id = args.exchange_id
             if not exchange_id and shell.ctx.exchange:
@@ -56,6 +105,17 @@ class StockCommand(Command):
 
             return self.create_stock(shell, exchange_id, args.name, args.symbol)
 
+        if args.subcmd == 'import':
+            exchange_id = args.exchange_id
+            if not exchange_id and shell.ctx.exchange:
+                exchange_id = shell.ctx.exchange['_id']
+            elif not exchange_id:
+                self.error(shell, 'missing required argument -e/--exchange-id')
+                return 1
+
+            return self.import_stocks(shell, exchange_id, args.path, args.format,
+                                      args.batch_size)
+
         self.error(shell, f'unknown sub-command: {args.subcmd}')
 
     def print_stocks(self, shell, exchange_id: str = None):
@@ -77,6 +137,33 @@ class StockCommand(Command):
         table.write(sys.stdout)
         return 0
 
+    def search_stocks(self, shell, exchange_id: str, query: str, limit: int):
+        results = shell.ctx.db.stock_index.search(shell.ctx.db, ObjectId(exchange_id), query,
+                                                  max(1, limit))
+        table = Table([Column('Id'), Column('Name'), Column('Symbol'), Column('Match')],
+                      spacing=4)
+        for row in results:
+            table.append(row['_id'], row['name'], row['symbol'], row['match'])
+
+        table.write(sys.stdout)
+        return 0
+
+    def print_values(self, shell, exchange_id: str):
+        db = shell.ctx.db
+        exchange_id = ObjectId(exchange_id)
+        names = {stock['_id']: stock['name']
+                 for stock in db.stocks.find({'exchange_id': exchange_id}, {'name': 1})}
+        values = sorted(db.valuations.values(db, exchange_id), key=lambda row: -row['value'])
+
+        table = Table([Column('Id'), Column('Name'), Column('Value'), Column('Change')],
+                      spacing=4)
+        for row in values:
+            table.append(row['stock_id'], names.get(row['stock_id'], ''), f'{row["value"]:.2f}',
+                         f'{row["change"]:+.2f}')
+
+        table.write(sys.stdout)
+        return 0
+
     def create_stock(self, shell, exchange_id: str, name: str, symbol: str):
         stock = shell.ctx.db.create_stock(exchange_id, name, symbol)
         print('created new stock successfully')
@@ -85,3 +172,54 @@ class StockCommand(Command):
         print('Name:  ', stock['name'])
         print('Symbol:', stock['symbol'])
         return 0
+
+    def import_stocks(self, shell, exchange_id: str, path: str, fmt: str, batch_size: int):
+        try:
+            exchange = shell.ctx.db.exchanges.find_one(ObjectId(exchange_id), {'_id': 1})
+        except (InvalidId, TypeError):
+            exchange = None
+        if not exchange:
+            self.error(shell, f'exchange does not exist: {exchange_id}')
+            return 1
+
+        def with_symbols(records):
+            # stocks without a symbol get one from their name, which must be unique too
+            for lineno, record in records:
+                if not record.get('symbol') and isinstance(record.get('name'), str):
+                    record['symbol'] = slugify(record['name'])
+                yield lineno, record
+
+        try:
+            rows, errors = validate_records(with_symbols(read_records(path, fmt)),
+                                            required=['name'], optional=['symbol'],
+                                            unique=['symbol'])
+        except (OSError, RecordError) as err:
+            self.error(shell, f'failed to read import file: {err}')
+            return 1
+
+        existing = {
+            stock['symbol'] for stock in shell.ctx.db.stocks.find(
+                {'exchange_id': exchange['_id']}, {'symbol': 1, '_id': 0})
+        }
+        for row in rows:
+            if row.get('symbol') in existing:
+                errors.append(RecordError(row['lineno'], f'stock symbol already exists: '
+                                                         f'{row["symbol"]}'))
+
+        if errors:
+            for err in errors:
+                self.error(shell, str(err))
+            self.error(shell, f'import aborted: {len(errors)} invalid records')
+            return 1
+
+        count = 0
+        try:
+            for batch in shell.ctx.db.create_stocks(exchange_id, rows, batch_size=batch_size):
+                count += len(batch)
+                print(f'imported {count} / {len(rows)} stocks')
+        except ItemDoesNotExist as err:
+            self.error(shell, f'failed to import stocks: {err} - {exchange_id}')
+            return 1
+
+        print('imported stocks successfully')
+        return 0
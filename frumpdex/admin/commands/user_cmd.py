@@ -2,14 +2,17 @@
 # Copyright (c) 2020, Adam Meily
 # All rights reserved.
 #
+import csv
 import sys
 
 from bson import ObjectId
+from bson.errors import InvalidId
 from pypsi.core import Command, PypsiArgParser, CommandShortCircuit
 from pypsi.format import Table, Column
 from pypsi.completers import command_completer
 
 from frumpdex.db import ItemDoesNotExist
+from frumpdex.admin.records import RecordError, read_records, validate_records
 
 class UserCommand(Command):
 
@@ -26,6 +29,18 @@ class UserCommand(Command):
         create_cmd.add_argument('name', action='store', help='user name')
         create_cmd.add_argument('-e', '--exchange-id', action='store', help='exchange id')
 
+        import_cmd = self.subcmd.add_parser('import', help='bulk create users from a csv or '
+                                                           'ndjson file')
+        import_cmd.add_argument('path', action='store', help='import file, each record has a '
+                                                             '"name"')
+        import_cmd.add_argument('-o', '--output', action='store', required=True,
+                                help='csv file to write the generated user tokens to')
+        import_cmd.add_argument('-e', '--exchange-id', action='store', help='exchange id')
+        import_cmd.add_argument('-f', '--format', choices=('csv', 'ndjson'),
+                                help='import file format (default: detect from extension)')
+        import_cmd.add_argument('-b', '--batch-size', type=int, default=500,
+                                help='number of users to insert per batch')
+
         describe_cmd = self.subcmd.add_parser('describe', help='describe user details')
         describe_cmd.add_argument('id', help='user id')
 
@@ -58,6 +73,17 @@ class UserCommand(Command):
 
             return self.create_user(shell, exchange_id, args.name)
 
+        if args.subcmd == 'import':
+            exchange_id = args.exchange_id
+            if not exchange_id and shell.ctx.exchange:
+                exchange_id = shell.ctx.exchange['_id']
+            elif not exchange_id:
+                self.error(shell, 'missing required argument -e/--exchange-id')
+                return 1
+
+            return self.import_users(shell, exchange_id, args.path, args.output, args.format,
+                                     args.batch_size)
+
         if args.subcmd == 'describe':
             return self.describe_user(shell, args.id)
 
@@ -95,6 +121,51 @@ class UserCommand(Command):
         print('Token:', user['token'])
         return 0
 
+    def import_users(self, shell, exchange_id: str, path: str, output: str, fmt: str,
+                     batch_size: int):
+        # validate everything before the output file is created, or truncated
+        try:
+            exchange = shell.ctx.db.exchanges.find_one(ObjectId(exchange_id), {'_id': 1})
+        except (InvalidId, TypeError):
+            exchange = None
+        if not exchange:
+            self.error(shell, f'exchange does not exist: {exchange_id}')
+            return 1
+
+        try:
+            rows, errors = validate_records(read_records(path, fmt), required=['name'])
+        except (OSError, RecordError) as err:
+            self.error(shell, f'failed to read import file: {err}')
+            return 1
+
+        if errors:
+            for err in errors:
+                self.error(shell, str(err))
+            self.error(shell, f'import aborted: {len(errors)} invalid records')
+            return 1
+
+        count = 0
+        try:
+            with open(output, 'w', newline='') as fp:
+                writer = csv.writer(fp)
+                writer.writerow(['id', 'name', 'token'])
+                names = (row['name'] for row in rows)
+                for batch in shell.ctx.db.create_users(exchange_id, names, batch_size=batch_size):
+                    for user in batch:
+                        writer.writerow([user['_id'], user['name'], user['token']])
+                    fp.flush()
+                    count += len(batch)
+                    print(f'imported {count} / {len(rows)} users')
+        except ItemDoesNotExist as err:
+            self.error(shell, f'failed to import users: {err} - {exchange_id}')
+            return 1
+        except OSError as err:
+            self.error(shell, f'failed to write output file: {err}')
+            return 1
+
+        print(f'imported users successfully, tokens written to {output}')
+        return 0
+
     def describe_user(self, shell, user_id: str):
         user = shell.ctx.db.users.find_one(ObjectId(user_id))
         if not user:
@@ -105,4 +176,17 @@ class UserCommand(Command):
         print('Exchange Id:', user['exchange_id'])
         print('Name:       ', user['name'])
         print('Token:      ', user['token'])
+
+        summary = shell.ctx.db.user_vote_summary(user['_id'])
+        print('First Vote: ', summary['first_vote'] or '-')
+        print('Last Vote:  ', summary['last_vote'] or '-')
+        print()
+
+        table = Table([Column('Window'), Column('Votes'), Column('Ups'), Column('Downs'),
+                       Column('Rating')], spacing=4)
+        for window in ('today', 'week', 'month', 'lifetime'):
+            counters = summary[window]
+            table.append(window, counters['votes'], counters['ups'], counters['downs'],
+                         counters['rating'])
+        table.write(sys.stdout)
         return 0
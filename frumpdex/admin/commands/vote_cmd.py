@@ -48,12 +48,21 @@ class VoteCommand(Command):
             columns = [Column('Id'), Column('Exchange Id'), Column('Name'), Column('Value')]
             cursor = shell.ctx.db.stocks.find()
 
+        db = shell.ctx.db
+        values = {}
         table = Table(columns, spacing=4)
         for row in cursor:
+            if row['exchange_id'] not in values:
+                values[row['exchange_id']] = {
+                    item['stock_id']: item['value']
+                    for item in db.valuations.values(db, row['exchange_id'])
+                }
+            value = values[row['exchange_id']].get(row['_id'])
+
             if exchange_id:
-                table.append(row['_id'], row['name'], row['value'])
+                table.append(row['_id'], row['name'], value)
             else:
-                table.append(row['_id'], row['exchange_id'], row['name'], row['value'])
+                table.append(row['_id'], row['exchange_id'], row['name'], value)
 
         table.write(sys.stdout)
         return 0
@@ -0,0 +1,125 @@
+#
+# Copyright (c) 2020, Adam Meily
+# All rights reserved.
+#
+import csv
+import json
+import os
+from typing import Iterator, List, Tuple
+
+
+class RecordError(Exception):
+    '''
+    A record in an import file is invalid.
+    '''
+
+    def __init__(self, lineno: int, message: str):
+        self.lineno = lineno
+        self.message = message
+
+    def __str__(self) -> str:
+        return f'line {self.lineno}: {self.message}'
+
+
+def detect_format(filename: str, fmt: str = None) -> str:
+    '''
+    Determine the format of an import file based on its extension.
+
+    :param filename: import filename
+    :param fmt: explicit format ("csv" or "ndjson"), overrides the file extension
+    :returns: the file format, either "csv" or "ndjson"
+    '''
+    if fmt:
+        return fmt
+
+    ext = os.path.splitext(filename)[1].lower()
+    if ext in ('.ndjson', '.jsonl', '.json'):
+        return 'ndjson'
+    return 'csv'
+
+
+def read_records(filename: str, fmt: str = None) -> Iterator[Tuple[int, dict]]:
+    '''
+    Read records from a CSV file (with a header row) or an NDJSON file (one JSON object per line).
+
+    :param filename: import filename
+    :param fmt: explicit format ("csv" or "ndjson")
+    :returns: generator of ``(lineno, record)`` tuples
+    '''
+    fmt = detect_format(filename, fmt)
+    with open(filename, 'r', newline='') as fp:
+        if fmt == 'csv':
+            reader = csv.DictReader(fp)
+            for row in reader:
+                yield reader.line_num, {key.strip(): (value or '').strip()
+                                        for key, value in row.items() if key}
+        else:
+            for lineno, line in enumerate(fp, start=1):
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    record = json.loads(line)
+                except ValueError as err:
+                    raise RecordError(lineno, f'invalid json: {err}')
+
+                if not isinstance(record, dict):
+                    raise RecordError(lineno, 'record must be a json object')
+                yield lineno, record
+
+
+def validate_records(records: Iterator[Tuple[int, dict]], required: List[str],
+                     optional: List[str] = None,
+                     unique: List[str] = None) -> Tuple[List[dict], List[RecordError]]:
+    '''
+    Validate every record before anything is written.
+
+    :param records: ``(lineno, record)`` tuples returned by :func:`read_records`
+    :param required: fields that must be present and non-empty
+    :param optional: fields that may be present
+    :param unique: fields that must not be repeated across records
+    :returns: a tuple of ``(valid records, errors)``
+    '''
+    optional = optional or []
+    unique = unique or []
+    seen = {field: {} for field in unique}
+    rows = []
+    errors = []
+
+    for lineno, record in records:
+        row = {}
+        valid = True
+        for field in required:
+            value = record.get(field)
+            if not isinstance(value, str) or not value.strip():
+                errors.append(RecordError(lineno, f'missing required field: {field}'))
+                valid = False
+            else:
+                row[field] = value.strip()
+
+        for field in optional:
+            value = record.get(field)
+            if value is None or value == '':
+                continue
+            if not isinstance(value, str):
+                errors.append(RecordError(lineno, f'field must be a string: {field}'))
+                valid = False
+            else:
+                row[field] = value.strip()
+
+        for field in unique:
+            value = row.get(field)
+            if value is None:
+                continue
+            if value in seen[field]:
+                errors.append(RecordError(lineno, f'duplicate {field} "{value}" (first seen on '
+                                                  f'line {seen[field][value]})'))
+                valid = False
+            else:
+                seen[field][value] = lineno
+
+        if valid:
+            row['lineno'] = lineno
+            rows.append(row)
+
+    return rows, errors
@@ -24,6 +24,7 @@ from . import commands
 from ..db import FrumpdexDatabase
 
 class AdminShell(Shell):
+    archive_cmd = commands.ArchiveCommand()
     exchange_cmd = commands.ExchangeCommand()
     stock_cmd = commands.StockCommand()
     user_cmd = commands.UserCommand()
@@ -2,11 +2,15 @@
 # Copyright (c) 2020, Adam Meily
 # All rights reserved.
 #
-from flask import g
+from flask import g, request
 from flask_restful import Resource, abort
 from bson import ObjectId
 
-from .lib import register_resource, auth_required, parse_time_window_query
+from .lib import (register_resource, auth_required, parse_time_window_query,
+                  parse_fields_projection, cached_response, series_date_range)
+from ..config import config
+from ..leaderboard import WINDOWS
+from ..timeseries import BUCKETS, build_series
 
 
 @register_resource('/exchange')
@@ -17,25 +21,149 @@ class ExchangeResource(Resource):
         return g.db.exchanges.find_one(ObjectId(g.user['exchange_id']))
 
 
+@register_resource('/exchange/snapshot')
+class ExchangeSnapshotResource(Resource):
+
+    @auth_required
+    @cached_response('exchange.snapshot')
+    def get(self):
+        return g.db.exchange_snapshot(g.user['exchange_id'])
+
+
 @register_resource('/exchange/activity', '/exchange/activity/<string:window>')
 class ExchangeActivityResource(Resource):
+    FIELDS = ('_id', 'stock_id', 'exchange_id', 'date', 'ups', 'downs', 'rating', 'ratings',
+              'labels', 'gitlab_activity')
+    FIELD_PRESETS = {
+        'counts': ('stock_id', 'date', 'ups', 'downs', 'rating')
+    }
+
+    @auth_required
+    @cached_response('exchange.activity')
+    def get(self, window: str = None):
+        projection = parse_fields_projection(self.FIELDS, self.FIELD_PRESETS)
+        if not window or window == 'today':
+            return g.db.views.today_activity(g.db, g.user['exchange_id'], projection)
+
+        q = parse_time_window_query(window)
+        q['exchange_id'] = g.user['exchange_id']
+        return list(g.db.stock_day_activity.find(q, projection))
+
+
+@register_resource('/exchange/labels', '/exchange/labels/<string:window>')
+class ExchangeLabelsResource(Resource):
 
     @auth_required
+    @cached_response('exchange.labels')
     def get(self, window: str = None):
         q = parse_time_window_query(window or 'today')
         q['exchange_id'] = g.user['exchange_id']
-        return list(g.db.stock_day_activity.find(q))
+        q['labels'] = {'$exists': True}
+
+        stocks = {}
+        for activity in g.db.stock_day_activity.find(q, {'stock_id': 1, 'labels': 1}):
+            labels = stocks.setdefault(activity['stock_id'], {})
+            for symbol, count in activity['labels'].items():
+                labels[symbol] = labels.get(symbol, 0) + count
+
+        return [{'stock_id': stock_id, 'labels': labels} for stock_id, labels in stocks.items()]
+
+
+@register_resource('/exchange/timeseries', '/exchange/timeseries/<string:window>')
+class ExchangeTimeSeriesResource(Resource):
+
+    @auth_required
+    @cached_response('exchange.timeseries')
+    def get(self, window: str = None):
+        bucket = request.args.get('bucket', 'day')
+        if bucket not in BUCKETS:
+            abort(400, message=f'invalid bucket: {bucket}')
+
+        try:
+            max_points = int(request.args.get('max_points', config.timeseries.max_points))
+        except ValueError:
+            abort(400, message='max_points must be an integer')
+
+        q = parse_time_window_query(window or 'month')
+        q['exchange_id'] = g.user['exchange_id']
+        if request.args.get('stock_id'):
+            q['stock_id'] = ObjectId(request.args['stock_id'])
+
+        start, end = series_date_range(q, g.user['exchange_id'])
+
+        projection = {'stock_id': 1, 'date': 1, 'ups': 1, 'downs': 1, 'rating': 1, '_id': 0}
+        rows = g.db.stock_day_activity.find(q, projection)
+        return build_series(rows, start, end, bucket=bucket, max_points=max(1, max_points))
+
+
+@register_resource('/exchange/values', '/exchange/values/<string:window>')
+class ExchangeValuesResource(Resource):
+
+    @auth_required
+    @cached_response('exchange.values')
+    def get(self, window: str = None):
+        if not window:
+            return g.db.valuations.values(g.db, g.user['exchange_id'])
+
+        start, end = series_date_range(parse_time_window_query(window), g.user['exchange_id'])
+        stock_id = ObjectId(request.args['stock_id']) if request.args.get('stock_id') else None
+        return g.db.valuations.series(g.db, g.user['exchange_id'], start, end, stock_id)
 
 
 @register_resource('/exchange/stocks', '/exchange/stocks/<string:stock_id>')
 class ExchangeStockResource(Resource):
+    FIELDS = ('_id', 'exchange_id', 'name', 'symbol', 'ups', 'downs', 'votes', 'rating',
+              'ratings', 'gitlab')
+    FIELD_PRESETS = {
+        'basic': ('_id', 'name', 'symbol'),
+        'counts': ('_id', 'name', 'symbol', 'ups', 'downs', 'rating')
+    }
 
     @auth_required
+    @cached_response('exchange.stocks')
     def get(self, stock_id: str = None):
+        projection = parse_fields_projection(self.FIELDS, self.FIELD_PRESETS)
         if stock_id:
-            stock = g.db.stocks.find_one(ObjectId(stock_id))
+            stock = g.db.views.stock(g.db, g.user['exchange_id'], ObjectId(stock_id), projection)
             if not stock:
                 abort(404, message='stock does not exist')
             return stock
 
-        return list(g.db.stocks.find({'exchange_id': g.user['exchange_id']}))
+        return g.db.views.stocks(g.db, g.user['exchange_id'], projection)
+
+
+@register_resource('/exchange/stocks/search')
+class ExchangeStockSearchResource(Resource):
+
+    @auth_required
+    @cached_response('exchange.stocks.search')
+    def get(self):
+        query = request.args.get('q', '').strip()
+        if not query:
+            abort(400, message='missing search query: q')
+
+        try:
+            limit = int(request.args.get('limit', config.search.limit))
+        except ValueError:
+            abort(400, message='limit must be an integer')
+
+        limit = max(1, min(limit, config.search.max_limit))
+        return g.db.stock_index.search(g.db, g.user['exchange_id'], query, limit)
+
+
+@register_resource('/exchange/leaderboard', '/exchange/leaderboard/<string:window>')
+class ExchangeLeaderboardResource(Resource):
+
+    @auth_required
+    def get(self, window: str = None):
+        window = window or 'today'
+        if window not in WINDOWS:
+            abort(400, message=f'invalid leaderboard window: {window}')
+
+        try:
+            limit = int(request.args.get('limit', config.leaderboard.size))
+        except ValueError:
+            abort(400, message='limit must be an integer')
+
+        limit = max(1, min(limit, config.leaderboard.max_size))
+        return g.db.leaderboards.top(g.db, g.user['exchange_id'], window, limit)
@@ -4,14 +4,17 @@
 #
 import os
 import importlib
-from typing import List, Union, Callable, Type, Tuple
-from datetime import datetime, timedelta, date
+from typing import List, Union, Callable, Type, Tuple, Dict, Sequence, Optional, Mapping
+from datetime import datetime, timedelta, date, timezone
 from bson import ObjectId
 import arrow
+import msgpack
 
-from flask import request, session, g
+from flask import request, session, g, Response
 from flask_restful import abort, Resource
 
+from ..compression import CONTENT_ENCODINGS, encoded_etag
+from ..config import config
 from ..db import midnight
 
 
@@ -38,7 +41,8 @@ def parse_time_window_query(window: str) -> dict:
     if not window or window == 'today':
         q = {'date': {'$gte': today_midnight.datetime}}
     elif window == 'week':
-        q = {'date': {'$gte': today_midnight - timedelta(days=today_midnight.weekday())}}
+        week_start = today_midnight - timedelta(days=today_midnight.weekday())
+        q = {'date': {'$gte': week_start.datetime}}
     elif window == 'month':
         # today = today.replace(minute=0, second=0, microsecond=0, hour=0, day=1)
         q = {'date': {'$gte': today_midnight.replace(day=1).datetime}}
@@ -46,12 +50,102 @@ def parse_time_window_query(window: str) -> dict:
         q = {'date': {'$gte': today_midnight.replace(month=1, day=1).datetime}}
     elif window == 'lifetime':
         q = {}
-    elif window:
-        q = {}  # TODO handle custom window
+    elif '..' in window:
+        q = parse_time_range_query(window)
+    else:
+        abort(400, message=f'invalid time window: {window}')
 
     return q
 
 
+def parse_time_range_query(window: str) -> dict:
+    '''
+    Parse an explicit time range window, ``<start>..<end>``, where both dates are inclusive and
+    in ``YYYY-MM-DD`` format. Either date may be omitted for an open ended range.
+    '''
+    start, end = window.split('..', 1)
+    tzinfo = arrow.now().tzinfo
+    q = {}
+    try:
+        if start:
+            q['$gte'] = arrow.get(start, 'YYYY-MM-DD', tzinfo=tzinfo).datetime
+        if end:
+            q['$lt'] = arrow.get(end, 'YYYY-MM-DD', tzinfo=tzinfo).shift(days=1).datetime
+    except (ValueError, OverflowError):
+        abort(400, message=f'invalid time window: {window}')
+
+    return {'date': q} if q else {}
+
+
+def series_date_range(q: dict, exchange_id: ObjectId) -> Tuple[date, date]:
+    '''
+    Get the first and last day of a dense daily series for a time window query. The series ends
+    no later than today. An open ended window, or a window that spans more than
+    ``timeseries.max_days`` days, starts at the exchange's first day of activity instead, and a
+    window that is still too large is rejected with a ``400``.
+
+    :param q: time window query, built by :func:`parse_time_window_query`
+    :param exchange_id: exchange id
+    :returns: a tuple of ``(first day, last day)``
+    '''
+    today = arrow.now().date()
+    date_range = q.get('date', {})
+    start = arrow.get(date_range['$gte']).date() if '$gte' in date_range else None
+    if '$lt' in date_range:
+        end = min(arrow.get(date_range['$lt']).date() - timedelta(days=1), today)
+    else:
+        end = today
+
+    max_days = config.timeseries.max_days
+    if not start or (end - start).days >= max_days:
+        first = g.db.first_activity_day(exchange_id) or end
+        start = max(start, first) if start else first
+
+    days = (end - start).days + 1
+    if days > max_days:
+        abort(400, message=f'time window too large: {days} days -- must be at most {max_days} '
+                           'days')
+    return start, end
+
+
+def parse_fields_projection(allowed: Sequence[str], presets: Dict[str, Sequence[str]] = None,
+                            args: Mapping[str, str] = None) -> Optional[dict]:
+    '''
+    Parse the ``fields`` and ``preset`` query parameters into a MongoDB projection. ``fields`` is
+    a comma separated list of document fields and ``preset`` is the name of a predefined list of
+    fields. Both may be specified, in which case the union of fields is returned. Every field must
+    be in the ``allowed`` whitelist of the resource.
+
+    :param allowed: fields that clients may request
+    :param presets: named field presets
+    :param args: query parameters, defaults to the active request's
+    :returns: the projection, or ``None`` if neither parameter was specified (all fields)
+    '''
+    args = request.args if args is None else args
+    presets = presets or {}
+    fields = [field.strip() for field in args.get('fields', '').split(',') if field.strip()]
+
+    preset = args.get('preset')
+    if preset:
+        if preset not in presets:
+            abort(400, message=f'invalid field preset: {preset} -- must be one of: '
+                               f'{", ".join(sorted(presets))}')
+        fields.extend(presets[preset])
+
+    if not fields:
+        return None
+
+    invalid = [field for field in fields if field not in allowed]
+    if invalid:
+        abort(400, message=f'invalid fields: {", ".join(invalid)} -- must be one of: '
+                           f'{", ".join(allowed)}')
+
+    projection = {field: 1 for field in fields}
+    if '_id' not in projection:
+        projection['_id'] = 0
+    return projection
+
+
 def auth_required(func: Callable) -> Callable:
     def wrapper(*args, **kwargs):
         if not g.user:
@@ -62,6 +156,81 @@ def auth_required(func: Callable) -> Callable:
     return wrapper
 
 
+def cached_response(endpoint: str, exchange_scoped: bool = True) -> Callable:
+    '''
+    Cache the response of a resource method. Responses are keyed by the endpoint, the user's
+    exchange, the method arguments (such as the time window), and the query string, and carry an
+    ETag so that clients can revalidate with ``If-None-Match`` and receive a ``304`` without the
+    response being rebuilt. Write paths in :class:`~frumpdex.db.FrumpdexDatabase` bump the
+    exchange version which invalidates the cached responses.
+
+    :param endpoint: cache key prefix
+    :param exchange_scoped: the response only contains data of the user's exchange, otherwise the
+        response is shared and only invalidated by global version bumps
+    '''
+    def decorator(func: Callable) -> Callable:
+        def wrapper(self, *args, **kwargs):
+            cache = g.db.response_cache
+            exchange_id = g.user['exchange_id'] if exchange_scoped and g.user else None
+            key = (endpoint, exchange_id, args, tuple(sorted(kwargs.items())),
+                   request.query_string, midnight().date())
+            etag = cache.etag(key, exchange_id)
+            mediatype = negotiate_mediatype()
+            # each representation of the response is a different entity
+            representation_etag = f'{etag}-{mediatype.rsplit("/", 1)[-1]}'
+            # the client may hold a compressed body, which is tagged with its encoding
+            matched = next((candidate for candidate in (
+                representation_etag,
+                *(encoded_etag(representation_etag, encoding) for encoding in CONTENT_ENCODINGS)
+            ) if request.if_none_match.contains(candidate)), None)
+
+            if matched:
+                response = Response(status=304)
+                response.set_etag(matched)
+            else:
+                entry = cache.get(key, etag)
+                if not entry:
+                    entry = cache.put(key, etag, func(self, *args, **kwargs))
+                response = make_cached_response(entry, mediatype)
+                response.set_etag(representation_etag)
+            response.vary.update(('Accept', 'Accept-Encoding'))
+            response.cache_control.private = True
+            response.cache_control.no_cache = True
+            return response
+
+        wrapper.__name__ = func.__name__
+        return wrapper
+    return decorator
+
+
+def negotiate_mediatype() -> str:
+    '''
+    :returns: the API representation negotiated from the request's ``Accept`` header
+    '''
+    return request.accept_mimetypes.best_match(list(g.api.representations),
+                                               default=g.api.default_mediatype)
+
+
+def make_cached_response(entry, mediatype: str) -> Response:
+    '''
+    Serialize a cached response using the negotiated representation. The serialized body is
+    stored on the cache entry so it is only encoded once per media type.
+
+    :param entry: response cache entry
+    :param mediatype: the media type negotiated by :func:`negotiate_mediatype`
+    :returns: the response
+    '''
+    representations = g.api.representations
+    body = entry.bodies.get(mediatype)
+    if body is None:
+        body = entry.bodies[mediatype] = representations[mediatype](entry.data, 200).get_data()
+
+    response = Response(body, 200, mimetype=mediatype)
+    # let the compression handler store compressed bodies alongside the cached body
+    response.compressed_cache = entry.bodies
+    return response
+
+
 def serialize_extra_types(value, default=None):
     if isinstance(value, ObjectId):
         return str(value)
@@ -70,3 +239,24 @@ def serialize_extra_types(value, default=None):
     if default:
         return default(value)
     raise TypeError(f'unserializable type: {type(value)}')
+
+
+#: MessagePack extension type code for ObjectIds (12 raw bytes)
+MSGPACK_OBJECTID_EXT_TYPE = 1
+
+
+def pack_extra_types(value):
+    '''
+    MessagePack ``default`` hook. ObjectIds are packed as a 12 byte extension type and datetimes
+    as the native MessagePack timestamp extension type.
+    '''
+    if isinstance(value, ObjectId):
+        return msgpack.ExtType(MSGPACK_OBJECTID_EXT_TYPE, value.binary)
+    if isinstance(value, datetime):
+        if not value.tzinfo:
+            # datetimes from pymongo are naive UTC
+            value = value.replace(tzinfo=timezone.utc)
+        return msgpack.Timestamp.from_datetime(value)
+    if isinstance(value, date):
+        return value.isoformat()
+    raise TypeError(f'unserializable type: {type(value)}')
@@ -0,0 +1,16 @@
+#
+# Copyright (c) 2020, Adam Meily
+# All rights reserved.
+#
+from flask_restful import Resource
+
+from .lib import register_resource, auth_required
+from ..metrics import metrics
+
+
+@register_resource('/metrics')
+class MetricsResource(Resource):
+
+    @auth_required
+    def get(self):
+        return metrics.snapshot()
@@ -6,18 +6,22 @@ from flask import g
 from flask_restful import Resource, abort
 from bson import ObjectId
 
-from .lib import register_resource
+from .lib import register_resource, parse_fields_projection
+from .exchange import ExchangeStockResource
 
 
 @register_resource('/stocks', '/stocks/<string:stock_id>')
 class StockResource(Resource):
+    FIELDS = ExchangeStockResource.FIELDS
+    FIELD_PRESETS = ExchangeStockResource.FIELD_PRESETS
 
     def get(self, stock_id: str = None):
+        projection = parse_fields_projection(self.FIELDS, self.FIELD_PRESETS)
         if stock_id:
-            stock = g.db.stocks.find_one(ObjectId(stock_id))
+            stock = g.db.stocks.find_one(ObjectId(stock_id), projection)
             if not stock:
                 abort(404, message='stock does not exist')
             return stock
 
         # TODO scope to user's exchange
-        return list(g.db.stocks.find())
+        return list(g.db.stocks.find({}, projection))
@@ -6,11 +6,14 @@ from flask import g
 from flask_restful import Resource, abort
 from bson import ObjectId
 
-from .lib import register_resource
+from .lib import register_resource, parse_fields_projection, cached_response
 
 
 @register_resource('/vote-labels')
 class VoteLabelsResource(Resource):
+    FIELDS = ('_id', 'name', 'symbol')
 
+    @cached_response('vote-labels', exchange_scoped=False)
     def get(self):
-        return list(g.db.vote_labels.find())
+        projection = parse_fields_projection(self.FIELDS)
+        return g.db.views.vote_labels(g.db, projection)
@@ -6,36 +6,89 @@ from flask import g, request
 from flask_restful import Resource, abort
 from bson import ObjectId
 
-from .lib import register_resource, parse_time_window_query, auth_required
+from .lib import (register_resource, parse_time_window_query, auth_required,
+                  parse_fields_projection, cached_response)
+from ..config import config
 
 
 @register_resource('/votes', '/votes/<string:window>',)
 class VoteResource(Resource):
+    FIELDS = ('_id', 'stock_id', 'user_id', 'exchange_id', 'comment', 'rating', 'labels', 'date')
+    FIELD_PRESETS = {
+        'counts': ('stock_id', 'rating', 'date'),
+        'summary': ('_id', 'stock_id', 'user_id', 'rating', 'labels', 'date')
+    }
 
     @auth_required
-    def get(self, window: str = None, stock_id: str = None):
+    def get(self, window: str = None, stock_id: str = None, user_id: ObjectId = None):
         if not g.user:
             abort(403, message='api token required')
 
+        projection = parse_fields_projection(self.FIELDS, self.FIELD_PRESETS)
         q = parse_time_window_query(window or 'today')
         if stock_id:
             q['stock_id'] = ObjectId(stock_id)
+        if user_id:
+            q['user_id'] = user_id
 
         q['exchange_id'] = g.user['exchange_id']
 
-        # TODO scope to user's exchange
-        return list(g.db.votes.find(q))
+        return g.db.find_votes(q, projection)
+
+
+@register_resource('/users/me/votes', '/users/me/votes/<string:window>')
+class UserVoteResource(VoteResource):
+
+    @auth_required
+    def get(self, window: str = None):
+        if not g.user:
+            abort(403, message='api token required')
+        return super().get(window, user_id=g.user['_id'])
+
+
+@register_resource('/votes/search')
+class VoteSearchResource(Resource):
+    FIELDS = ('_id', 'seq', 'stock_id', 'user_id', 'exchange_id', 'snippet', 'rating', 'labels',
+              'date', 'score')
+
+    @auth_required
+    @cached_response('votes.search')
+    def get(self):
+        query = request.args.get('q', '').strip()
+        if not query:
+            abort(400, message='missing search query: q')
+
+        try:
+            limit = int(request.args.get('limit', config.search.limit))
+            offset = int(request.args.get('offset', 0))
+        except ValueError:
+            abort(400, message='limit and offset must be integers')
+
+        projection = parse_fields_projection(self.FIELDS)
+        q = parse_time_window_query(request.args.get('window', 'lifetime'))
+        labels = [label.strip() for label in request.args.get('labels', '').split(',')
+                  if label.strip()]
+
+        votes = g.db.search_votes(g.user['exchange_id'], query, q, labels=labels,
+                                  offset=max(0, offset),
+                                  limit=max(1, min(limit, config.search.max_limit)))
+        if projection:
+            votes = [{key: value for key, value in vote.items() if projection.get(key)}
+                     for vote in votes]
+        return votes
 
 
 @register_resource('/stocks/<string:stock_id>/votes', '/stocks/<string:stock_id>/<string:window>')
 class VoteStockResource(VoteResource):
+    #: each vote is several database writes and a broadcast, so posting votes is rate limited
+    RATE_LIMITED_METHODS = ('POST',)
 
     def get(self, stock_id: str, window: str = None):
-        super().get(window, stock_id)
+        return super().get(window, stock_id)
 
     @auth_required
     def post(self, stock_id: str):
-        stock = g.db.stocks.find_one(ObjectId(stock_id))
+        stock = g.db.find_stock(stock_id)
         if not stock:
             abort(404, message='stock does not exist')
 
@@ -49,7 +102,7 @@ class VoteStockResource(VoteResource):
         vote = g.db.vote(stock_id, g.user['token'], direction, comment, labels=labels,
                          rating=rating)
 
-        g.socketio.emit('vote', vote, room=f'exchange.{stock["exchange_id"]}')
+        g.events.emit(f'exchange.{stock["exchange_id"]}', vote['seq'], 'vote', vote)
 
         return vote
 
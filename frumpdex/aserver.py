@@ -0,0 +1,455 @@
+#
+# Copyright (c) 2020, Adam Meily
+# All rights reserved.
+#
+'''
+asyncio server mode, requires the ``aiohttp`` and ``motor`` packages.
+
+The hot paths, posting votes and reading exchange activity, are served by coroutines that talk to
+MongoDB through motor, so a slow database call does not tie up a thread. Socket.IO is served by
+python-socketio's ``AsyncServer``. Every other API resource and view is served by the existing
+Flask application, run in a thread pool, so the two server modes expose the same ``/api/v1``
+resources and share the same in-process caches, rate limiters, and serializers.
+'''
+import asyncio
+import json
+import logging
+import math
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import List, Optional
+
+import motor.motor_asyncio
+import socketio as socketio_lib
+from aiohttp import web
+from bson import ObjectId
+from bson.errors import InvalidId
+from pymongo import ReturnDocument
+from werkzeug.datastructures import MIMEAccept
+from werkzeug.exceptions import HTTPException
+from werkzeug.http import parse_accept_header
+from werkzeug.test import EnvironBuilder, run_wsgi_app
+
+from . import server
+from .api.exchange import ExchangeActivityResource
+from .api.lib import parse_fields_projection, parse_time_window_query, serialize_extra_types
+from .config import config
+from .db import FrumpdexDatabase, ItemDoesNotExist
+from .metrics import metrics
+
+logger = logging.getLogger('frumpdex')
+
+
+class SocketJson:
+    '''
+    JSON module used by the Socket.IO server, handles ObjectIds and datetimes.
+    '''
+    loads = staticmethod(json.loads)
+
+    @staticmethod
+    def dumps(*args, **kwargs) -> str:
+        kwargs.setdefault('default', serialize_extra_types)
+        return json.dumps(*args, **kwargs)
+
+
+class AsyncFrumpdexDatabase:
+    '''
+    Coroutine versions of the :class:`~frumpdex.db.FrumpdexDatabase` operations on the hot path.
+    The in-process caches, leaderboards, and materialized views of the wrapped database are
+    shared with the Flask application.
+
+    :param db: the connected frumpdex database
+    :param uri: MongoDB URI
+    '''
+
+    def __init__(self, db: FrumpdexDatabase, uri: str):
+        self.sync = db
+        self.client = motor.motor_asyncio.AsyncIOMotorClient(uri)
+        self.db = self.client.frumpdex
+
+    async def find_user_by_token(self, token: str) -> Optional[dict]:
+        '''
+        :returns: the user with the API token, see
+            :meth:`~frumpdex.db.FrumpdexDatabase.find_user_by_token`
+        '''
+        user = self.sync.user_cache.get(token)
+        if not user:
+            user = await self.db.users.find_one({'token': token})
+            if user:
+                self.sync.user_cache.put(token, user)
+        return user
+
+    async def find_stock(self, stock_id: ObjectId) -> Optional[dict]:
+        '''
+        :returns: the stock, see :meth:`~frumpdex.db.FrumpdexDatabase.find_stock`
+        '''
+        stock = self.sync.stock_cache.get(stock_id)
+        if not stock:
+            stock = await self.db.stocks.find_one(stock_id)
+            if stock:
+                self.sync.stock_cache.put(stock_id, stock)
+        return stock
+
+    async def next_vote_sequence(self, exchange_id: ObjectId) -> int:
+        '''
+        :returns: the next vote sequence number of the exchange
+        '''
+        exchange = await self.db.exchanges.find_one_and_update(
+            {'_id': exchange_id}, {'$inc': {'vote_seq': 1}}, projection={'vote_seq': 1},
+            return_document=ReturnDocument.AFTER)
+        if not exchange:
+            raise ItemDoesNotExist('exchange')
+        return exchange['vote_seq']
+
+    async def vote(self, stock: dict, user: dict, direction: str, comment: str,
+                   rating: int = 0, labels: List[str] = None) -> dict:
+        '''
+        Cast a vote, see :meth:`~frumpdex.db.FrumpdexDatabase.vote`.
+        '''
+        db = self.sync
+        rating = db.vote_rating(direction, rating)
+        db.check_vote(stock, user)
+
+        if db.journal:
+            # journal appends block on fsync, keep them off the event loop
+            return await asyncio.get_event_loop().run_in_executor(
+                None, partial(db.vote, stock['_id'], user['token'], direction, comment,
+                              rating=rating, labels=labels))
+
+        logger.info('user %s is voting %s stock %s', user['name'], direction, stock['name'])
+        if not db.applied_seqs.begin(stock['exchange_id'], blocking=False):
+            # a snapshot of the exchange is being read, wait for it without blocking the loop
+            await asyncio.get_event_loop().run_in_executor(None, db.applied_seqs.begin,
+                                                           stock['exchange_id'])
+        seq = None
+        try:
+            seq = await self.next_vote_sequence(stock['exchange_id'])
+            vote = db.build_vote(stock, user, seq, comment, rating, labels)
+            await self.apply_vote(vote)
+            db.vote_acknowledged(stock, vote)
+        finally:
+            db.applied_seqs.end(stock['exchange_id'], seq)
+        return vote
+
+    async def apply_vote(self, vote: dict) -> bool:
+        '''
+        Write a vote and update the stock statistics, see
+        :meth:`~frumpdex.db.FrumpdexDatabase.apply_vote`.
+        '''
+        db = self.sync
+        collection, q, projection = db.stored_vote_query(vote)
+        writes = db.vote_writes(vote, await self.db[collection].find_one(q, projection))
+        if not writes:
+            return False
+
+        results = [await self.db[write.collection].update_one(write.query, write.update,
+                                                              upsert=write.upsert)
+                   for write in writes]
+        db.vote_written(vote, writes, results)
+        return True
+
+
+class WsgiBridge:
+    '''
+    Serves a WSGI application from aiohttp by running each request in a thread pool.
+
+    :param app: WSGI application
+    :param workers: number of worker threads
+    '''
+
+    def __init__(self, app, workers: int):
+        self.app = app
+        self.executor = ThreadPoolExecutor(workers, thread_name_prefix='wsgi')
+
+    async def handle(self, request: web.Request) -> web.StreamResponse:
+        '''
+        Run a request through the WSGI application.
+        '''
+        builder = EnvironBuilder(method=request.method, path=request.path,
+                                 base_url=f'{request.scheme}://{request.host}',
+                                 query_string=request.query_string,
+                                 headers=list(request.headers.items()),
+                                 data=await request.read())
+        try:
+            environ = builder.get_environ()
+        finally:
+            builder.close()
+        environ['REMOTE_ADDR'] = request.remote or ''
+
+        app_iter, status, headers = await asyncio.get_event_loop().run_in_executor(
+            self.executor, partial(run_wsgi_app, self.app, environ, buffered=True))
+        body = b''.join(app_iter)
+        response = web.Response(body=body, status=int(status.split(' ', 1)[0]))
+        for name, value in headers.items():
+            if name.lower() != 'content-length':
+                response.headers.add(name, value)
+        return response
+
+
+class ThreadsafeEmitter:
+    '''
+    Lets code running in the WSGI thread pool emit events through the asyncio Socket.IO server.
+    '''
+
+    def __init__(self, sio: socketio_lib.AsyncServer, loop: asyncio.AbstractEventLoop):
+        self.sio = sio
+        self.loop = loop
+
+    def emit(self, event: str, data, room: str = None) -> None:
+        asyncio.run_coroutine_threadsafe(self.sio.emit(event, data, room=room), self.loop)
+
+
+class AsyncFrumpdexServer:
+    '''
+    The asyncio frumpdex server.
+
+    :param db: the connected frumpdex database
+    :param mongo_uri: MongoDB URI
+    :param cors_allowed_origins: Socket.IO allowed origins
+    '''
+
+    def __init__(self, db: FrumpdexDatabase, mongo_uri: str,
+                 cors_allowed_origins: List[str] = None):
+        self.adb = AsyncFrumpdexDatabase(db, mongo_uri)
+        self.sio = socketio_lib.AsyncServer(async_mode='aiohttp', json=SocketJson,
+                                            cors_allowed_origins=cors_allowed_origins or [])
+        self.app = web.Application(middlewares=[self.inflight_middleware])
+        self.sio.attach(self.app)
+        self.wsgi = WsgiBridge(server.app, config.asyncio.wsgi_workers)
+
+        self.sio.on('connect', self.handle_connect)
+        self.sio.on('join', self.handle_join_room)
+        self.sio.on('leave', self.handle_leave_room)
+
+        self.app.router.add_post('/api/v1/stocks/{stock_id}/votes', self.post_vote)
+        self.app.router.add_get('/api/v1/exchange/activity', self.get_activity)
+        self.app.router.add_get('/api/v1/exchange/activity/{window}', self.get_activity)
+        self.app.router.add_route('*', '/{path:.*}', self.wsgi.handle, name='wsgi')
+        self.app.on_startup.append(self.on_startup)
+
+    async def on_startup(self, app: web.Application) -> None:  # pylint: disable=unused-argument
+        # route events emitted by the Flask resources through the asyncio Socket.IO server
+        server.events.socketio = ThreadsafeEmitter(self.sio, asyncio.get_event_loop())
+
+    @web.middleware
+    async def inflight_middleware(self, request: web.Request, handler) -> web.StreamResponse:
+        '''
+        Shed load on the natively served API routes, see :func:`~frumpdex.server.before_request`.
+        Requests passed to the Flask application are limited by Flask.
+        '''
+        if (not config.ratelimit.enabled or request.match_info.route.name == 'wsgi' or
+                not request.path.startswith('/api/')):
+            return await handler(request)
+
+        if not server.inflight_limiter.acquire():
+            metrics.increment('ratelimit.rejected.inflight')
+            return self.error(503, 'server is busy', 1)
+
+        try:
+            return await handler(request)
+        finally:
+            server.inflight_limiter.release()
+
+    async def authenticate(self, headers, cookies) -> Optional[dict]:
+        '''
+        Authenticate a request from its ``Authorization: Bearer`` header or the Flask session
+        cookie, see :func:`~frumpdex.server.get_request_user`.
+        '''
+        token = None
+        cookie = cookies.get(server.app.session_cookie_name)
+        if cookie:
+            serializer = server.app.session_interface.get_signing_serializer(server.app)
+            try:
+                token = serializer.loads(cookie).get('token')
+            except Exception:  # pylint: disable=broad-except
+                token = None
+
+        header_auth = headers.get('Authorization')
+        if not token and header_auth:
+            parts = header_auth.split(' ', 1)
+            if len(parts) == 2 and parts[0] == 'Bearer':
+                token = parts[1]
+
+        return await self.adb.find_user_by_token(token) if token else None
+
+    def respond(self, request: web.Request, data, status: int = 200) -> web.Response:
+        '''
+        Serialize a response with the API representation negotiated from the ``Accept`` header.
+        '''
+        representations = server.api.representations
+        accept = MIMEAccept(parse_accept_header(request.headers.get('Accept', '*/*')))
+        mediatype = accept.best_match(list(representations), default=server.api.default_mediatype)
+        body = representations[mediatype](data, status).get_data()
+        response = web.Response(body=body, status=status, content_type=mediatype)
+        if config.compression.enabled and len(body) >= config.compression.min_size:
+            response.enable_compression()
+        return response
+
+    def error(self, status: int, message: str, retry_after: float = None) -> web.Response:
+        '''
+        :returns: a JSON error response
+        '''
+        response = web.json_response({'message': message}, status=status)
+        if retry_after is not None:
+            response.headers['Retry-After'] = str(max(1, math.ceil(retry_after)))
+        return response
+
+    def check_vote_rate_limits(self, user: dict) -> Optional[web.Response]:
+        '''
+        :returns: an error response if the user or exchange exceeded its vote rate limit, see
+            :func:`~frumpdex.server.check_rate_limits`
+        '''
+        if not config.ratelimit.enabled:
+            return None
+
+        retry_after = server.user_vote_limiter.check(user['_id'])
+        if retry_after:
+            metrics.increment('ratelimit.rejected.user')
+            return self.error(429, 'rate limit exceeded', retry_after)
+
+        retry_after = server.exchange_vote_limiter.check(user['exchange_id'])
+        if retry_after:
+            metrics.increment('ratelimit.rejected.exchange')
+            return self.error(429, 'exchange rate limit exceeded', retry_after)
+
+        return None
+
+    async def post_vote(self, request: web.Request) -> web.Response:
+        '''
+        Cast a vote, see :meth:`~frumpdex.api.votes.VoteStockResource.post`.
+        '''
+        user = await self.authenticate(request.headers, request.cookies)
+        if not user:
+            return self.error(403, 'api token required')
+
+        limited = self.check_vote_rate_limits(user)
+        if limited:
+            return limited
+
+        try:
+            stock = await self.adb.find_stock(ObjectId(request.match_info['stock_id']))
+        except (InvalidId, TypeError):
+            stock = None
+        if not stock or stock['exchange_id'] != user['exchange_id']:
+            return self.error(404, 'stock does not exist')
+
+        form = await request.post()
+        try:
+            direction = form['direction']
+            comment = form['comment']
+            rating = int(form['rating'])
+        except (KeyError, ValueError):
+            return self.error(400, 'direction, comment, and rating are required')
+
+        try:
+            vote = await self.adb.vote(stock, user, direction, comment, rating=rating,
+                                       labels=form.getall('labels[]', []))
+        except TypeError as err:
+            return self.error(400, str(err))
+
+        room = f'exchange.{stock["exchange_id"]}'
+        server.events.buffer.append(room, vote['seq'], 'vote', vote)
+        await self.sio.emit('vote', vote, room=room)
+        return self.respond(request, vote)
+
+    async def get_activity(self, request: web.Request) -> web.Response:
+        '''
+        Get exchange activity, see :meth:`~frumpdex.api.exchange.ExchangeActivityResource.get`.
+        '''
+        user = await self.authenticate(request.headers, request.cookies)
+        if not user:
+            return self.error(403, 'api token required')
+
+        window = request.match_info.get('window')
+        try:
+            projection = parse_fields_projection(ExchangeActivityResource.FIELDS,
+                                                 ExchangeActivityResource.FIELD_PRESETS,
+                                                 args=request.query)
+            if not window or window == 'today':
+                data = await asyncio.get_event_loop().run_in_executor(
+                    None, self.adb.sync.views.today_activity, self.adb.sync,
+                    user['exchange_id'], projection)
+                return self.respond(request, data)
+
+            q = parse_time_window_query(window)
+        except HTTPException as err:
+            message = getattr(err, 'data', {}).get('message') or err.description
+            return self.error(err.code, message)
+
+        q['exchange_id'] = user['exchange_id']
+        data = await self.adb.db.stock_day_activity.find(q, projection).to_list(None)
+        return self.respond(request, data)
+
+    async def handle_connect(self, sid: str, environ: dict) -> None:
+        '''
+        Authenticate a user attempting to connect to the web socket.
+        '''
+        request = environ.get('aiohttp.request')
+        user = await self.authenticate(request.headers, request.cookies) if request else None
+        if not user:
+            raise ConnectionRefusedError('unauthorized')
+        await self.sio.save_session(sid, {'user': user})
+
+    async def handle_join_room(self, sid: str, data: dict) -> None:
+        '''
+        Join an exchange room, see :func:`~frumpdex.server.handle_join_room`.
+        '''
+        room = data['room']
+        user = (await self.sio.get_session(sid)).get('user')
+        if not room.startswith('exchange.'):
+            return
+
+        exchange_id = room.split('.', 1)[1]
+        if not user or exchange_id != str(user['exchange_id']):
+            return
+
+        logger.debug('join room: %s', room)
+        self.sio.enter_room(sid, room)
+
+        since_seq = data.get('since_seq')
+        if isinstance(since_seq, int):
+            await self.resync_room(sid, room, user['exchange_id'], since_seq)
+
+    async def resync_room(self, sid: str, room: str, exchange_id: ObjectId,
+                          since_seq: int) -> None:
+        '''
+        Send the events a rejoining client missed, see :func:`~frumpdex.server.resync_room`.
+        '''
+        loop = asyncio.get_event_loop()
+        db = self.adb.sync
+        missed = server.events.buffer.since(room, since_seq)
+        if missed is None:
+            seq = await loop.run_in_executor(None, db.vote_sequence, exchange_id)
+            if seq == since_seq:
+                missed = []
+
+        if missed is None:
+            logger.debug('resync room %s from snapshot: seq %s is not buffered', room, since_seq)
+            snapshot = await loop.run_in_executor(None, db.exchange_snapshot, exchange_id)
+            await self.sio.emit('resync', snapshot, room=sid)
+            return
+
+        logger.debug('replaying %d events to room %s since seq %s', len(missed), room, since_seq)
+        for _, event, event_data in missed:
+            await self.sio.emit(event, event_data, room=sid)
+
+    async def handle_leave_room(self, sid: str, data: dict) -> None:
+        '''
+        Websocket client leave room.
+        '''
+        logger.debug('leave room: %s', data['room'])
+        self.sio.leave_room(sid, data['room'])
+
+
+def run_async_server(debug: bool = False, host: str = '127.0.0.1', port: int = 5000,
+                     logfile: str = None, silent: bool = False, mongo_uri: str = None,
+                     cors_allowed_origins: List[str] = None):
+    '''
+    Run the asyncio frumpdex server.
+    '''
+    server.setup_logging(logfile, debug=debug, silent=silent)
+    db = server.setup_server(mongo_uri, port)
+    aserver = AsyncFrumpdexServer(db, mongo_uri, cors_allowed_origins)
+
+    logger.info(f'starting asyncio frumpdex server: http://{host}:{port}')
+    web.run_app(aserver.app, host=host, port=port, print=None)
@@ -0,0 +1,175 @@
+#
+# Copyright (c) 2020, Adam Meily
+# All rights reserved.
+#
+'''
+Static asset bundling.
+
+The build step precompiles the riot tags (using the node ``@riotjs/compiler`` package) and
+concatenates them with the vendor scripts and stylesheets into content hashed bundles, along with
+gzip and brotli compressed variants of each bundle. The bundle filenames are written to a manifest
+that the templates use to reference the bundles.
+'''
+import gzip
+import hashlib
+import json
+import logging
+import os
+import re
+import subprocess
+import tempfile
+from typing import Dict, List, Optional
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+logger = logging.getLogger(__name__)
+
+PACKAGE_DIR = os.path.abspath(os.path.dirname(__file__))
+ROOT_DIR = os.path.dirname(PACKAGE_DIR)
+NODE_DIR = os.path.join(ROOT_DIR, 'node_modules')
+TAGS_DIR = os.path.join(PACKAGE_DIR, 'static', 'tags')
+DIST_DIR = os.path.join(PACKAGE_DIR, 'static', 'dist')
+MANIFEST_FILENAME = 'manifest.json'
+COMPILE_TAGS_SCRIPT = os.path.join(ROOT_DIR, 'scripts', 'compile-tags.js')
+
+#: vendor scripts, relative to node_modules, in load order
+VENDOR_JS = [
+    'jquery/dist/jquery.min.js',
+    'bootstrap/dist/js/bootstrap.bundle.min.js',
+    'riot/riot.min.js',
+    'socket.io-client/dist/socket.io.js'
+]
+
+#: vendor stylesheets, relative to node_modules, in load order
+VENDOR_CSS = [
+    'bootstrap/dist/css/bootstrap.min.css',
+    'open-iconic/font/css/open-iconic-bootstrap.min.css'
+]
+
+#: compressed variants, content encoding -> file extension
+ENCODINGS = {'br': '.br', 'gzip': '.gz'}
+
+CSS_URL_RE = re.compile(r'url\((["\']?)(?!data:|https?:|/)([^)"\']+)\1\)')
+
+_manifest: Optional[Dict[str, str]] = None
+
+
+def compile_tags(output: str) -> None:
+    '''
+    Precompile the riot tags into a single script.
+
+    :param output: output filename
+    '''
+    subprocess.run(['node', COMPILE_TAGS_SCRIPT, TAGS_DIR, output], check=True, cwd=ROOT_DIR)
+
+
+def rebase_css_urls(css: str, filename: str) -> str:
+    '''
+    Rewrite relative ``url()`` references in a vendor stylesheet to absolute vendor URLs so they
+    still resolve once the stylesheet is moved into the bundle.
+
+    :param css: stylesheet contents
+    :param filename: stylesheet filename, relative to node_modules
+    :returns: the rewritten stylesheet
+    '''
+    base = os.path.dirname(filename)
+
+    def replace(match) -> str:
+        path = os.path.normpath(os.path.join(base, match.group(2))).replace(os.sep, '/')
+        return f'url({match.group(1)}/vendor/{path}{match.group(1)})'
+
+    return CSS_URL_RE.sub(replace, css)
+
+
+def write_bundle(name: str, ext: str, parts: List[bytes], output_dir: str) -> str:
+    '''
+    Write a content hashed bundle and its compressed variants.
+
+    :param name: bundle name
+    :param ext: bundle file extension
+    :param parts: bundle contents
+    :param output_dir: output directory
+    :returns: the bundle filename
+    '''
+    content = b'\n'.join(parts)
+    digest = hashlib.sha256(content).hexdigest()[:16]
+    filename = f'{name}.{digest}{ext}'
+    path = os.path.join(output_dir, filename)
+
+    with open(path, 'wb') as fp:
+        fp.write(content)
+
+    with open(path + ENCODINGS['gzip'], 'wb') as fp:
+        fp.write(gzip.compress(content, compresslevel=9))
+
+    if brotli:
+        with open(path + ENCODINGS['br'], 'wb') as fp:
+            fp.write(brotli.compress(content, quality=11))
+
+    logger.info(f'wrote bundle {filename} ({len(content)} bytes)')
+    return filename
+
+
+def build_assets(output_dir: str = DIST_DIR) -> Dict[str, str]:
+    '''
+    Build the static asset bundles.
+
+    :param output_dir: output directory
+    :returns: the asset manifest, logical name -> bundle filename
+    '''
+    os.makedirs(output_dir, exist_ok=True)
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        tags_js = os.path.join(tmpdir, 'tags.js')
+        compile_tags(tags_js)
+
+        js = [open(os.path.join(NODE_DIR, filename), 'rb').read() for filename in VENDOR_JS]
+        # vendor scripts may not end with a semicolon or newline
+        js = [part.rstrip() + b';' for part in js]
+        js.append(open(tags_js, 'rb').read())
+
+    css = []
+    for filename in VENDOR_CSS:
+        with open(os.path.join(NODE_DIR, filename), 'r') as fp:
+            css.append(rebase_css_urls(fp.read(), filename).encode())
+
+    manifest = {
+        'app.js': write_bundle('app', '.js', js, output_dir),
+        'app.css': write_bundle('app', '.css', css, output_dir)
+    }
+
+    with open(os.path.join(output_dir, MANIFEST_FILENAME), 'w') as fp:
+        json.dump(manifest, fp, indent=2)
+
+    return manifest
+
+
+def get_manifest() -> Optional[Dict[str, str]]:
+    '''
+    :returns: the asset manifest, or ``None`` if the assets have not been built
+    '''
+    global _manifest  # pylint: disable=global-statement,invalid-name
+    if _manifest is None:
+        path = os.path.join(DIST_DIR, MANIFEST_FILENAME)
+        if os.path.isfile(path):
+            with open(path, 'r') as fp:
+                _manifest = json.load(fp)
+        else:
+            _manifest = {}
+
+    return _manifest or None
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('action', choices=('build',), help='action to perform')
+    parser.add_argument('-o', '--output', default=DIST_DIR, help='output directory')
+
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    build_assets(args.output)
@@ -0,0 +1,285 @@
+#
+# Copyright (c) 2020, Adam Meily
+# All rights reserved.
+#
+'''
+Exchange backup and restore.
+
+An exchange archive is a gzip compressed stream of records, one per document, in either NDJSON
+(MongoDB extended JSON) or BSON format. Each record has the form ``{"c": <collection>, "d":
+<document>}``. The first record is a header describing the archive.
+'''
+import gzip
+import logging
+import secrets
+from concurrent.futures import ThreadPoolExecutor, Future, wait, FIRST_COMPLETED
+from typing import Dict, Iterator, List, Set, Tuple
+
+import bson
+from bson import ObjectId, json_util
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+
+from .db import FrumpdexDatabase, ItemDoesNotExist, ObjectIdStr
+
+logger = logging.getLogger(__name__)
+
+#: Archive format identifier, stored in the header record
+ARCHIVE_FORMAT = 'frumpdex-exchange'
+
+#: Archive format version, stored in the header record
+ARCHIVE_VERSION = 1
+
+#: Collections that are exported, in the order they are written to the archive
+EXPORT_COLLECTIONS = ('exchanges', 'users', 'stocks', 'votes', 'vote_buckets', 'votes_archive',
+                      'stock_day_activity', 'user_day_activity', 'vote_labels')
+
+#: Document fields that hold ObjectId references and are rewritten when remapping ids
+REFERENCE_FIELDS = ('_id', 'exchange_id', 'user_id', 'stock_id')
+
+#: MongoDB duplicate key error code
+DUPLICATE_KEY_ERROR = 11000
+
+
+def detect_archive_format(filename: str, fmt: str = None) -> str:
+    '''
+    Determine the archive format based on the filename.
+
+    :param filename: archive filename
+    :param fmt: explicit format ("ndjson" or "bson"), overrides the filename
+    :returns: the archive format
+    '''
+    if fmt:
+        return fmt
+    return 'bson' if '.bson' in filename.lower() else 'ndjson'
+
+
+def _export_query(collection: str, exchange_id: ObjectId) -> dict:
+    if collection == 'exchanges':
+        return {'_id': exchange_id}
+    if collection == 'vote_labels':
+        # vote labels are global and are not scoped to an exchange
+        return {}
+    return {'exchange_id': exchange_id}
+
+
+class ArchiveWriter:
+    '''
+    Writes records to a compressed exchange archive.
+    '''
+
+    def __init__(self, fp, fmt: str):
+        self.fp = fp
+        self.fmt = fmt
+
+    def write(self, collection: str, doc: dict) -> None:
+        '''
+        Write a single record.
+
+        :param collection: collection name
+        :param doc: the document
+        '''
+        record = {'c': collection, 'd': doc}
+        if self.fmt == 'bson':
+            self.fp.write(bson.encode(record))
+        else:
+            line = json_util.dumps(record, json_options=json_util.RELAXED_JSON_OPTIONS)
+            self.fp.write(line.encode() + b'\n')
+
+
+def read_archive(fp, fmt: str) -> Iterator[Tuple[str, dict]]:
+    '''
+    Read records from an exchange archive.
+
+    :param fp: decompressed binary file object
+    :param fmt: archive format
+    :returns: generator of ``(collection, document)`` tuples
+    '''
+    if fmt == 'bson':
+        records = bson.decode_file_iter(fp)
+    else:
+        records = (json_util.loads(line) for line in fp if line.strip())
+
+    for record in records:
+        yield record['c'], record['d']
+
+
+def export_exchange(db: FrumpdexDatabase, exchange_id: ObjectIdStr, filename: str,
+                    fmt: str = None, batch_size: int = 1000) -> Dict[str, int]:
+    '''
+    Stream all documents belonging to an exchange to a compressed archive. Documents are read
+    with batched cursors and written as they arrive so memory usage does not depend on the size
+    of the exchange.
+
+    :param db: frumpdex database
+    :param exchange_id: exchange to export
+    :param filename: archive filename
+    :param fmt: archive format, "ndjson" or "bson" (detected from ``filename`` if not specified)
+    :param batch_size: cursor batch size
+    :returns: the number of exported documents per collection
+    '''
+    exchange_id = ObjectId(exchange_id)
+    exchange = db.exchanges.find_one(exchange_id)
+    if not exchange:
+        raise ItemDoesNotExist('exchange')
+
+    fmt = detect_archive_format(filename, fmt)
+    counts = {}
+    with gzip.open(filename, 'wb') as fp:
+        writer = ArchiveWriter(fp, fmt)
+        writer.write('__header__', {
+            'format': ARCHIVE_FORMAT,
+            'version': ARCHIVE_VERSION,
+            'exchange_id': exchange_id,
+            'collections': list(EXPORT_COLLECTIONS),
+            'votes_archived_before': db.votes_archived_before()
+        })
+
+        for collection in EXPORT_COLLECTIONS:
+            cursor = db.db[collection].find(_export_query(collection, exchange_id))
+            cursor = cursor.sort('_id', 1).batch_size(batch_size)
+            count = 0
+            for doc in cursor:
+                writer.write(collection, doc)
+                count += 1
+
+            counts[collection] = count
+            logger.info(f'exported {count} {collection} documents from exchange '
+                        f'{exchange["name"]}')
+
+    return counts
+
+
+class IdRemapper:
+    '''
+    Assigns new ObjectIds to restored documents while keeping references between documents
+    consistent.
+    '''
+
+    def __init__(self):
+        self.ids: Dict[ObjectId, ObjectId] = {}
+
+    def __call__(self, value: ObjectId) -> ObjectId:
+        new_id = self.ids.get(value)
+        if not new_id:
+            new_id = self.ids[value] = ObjectId()
+        return new_id
+
+    def remap(self, doc: dict) -> dict:
+        '''
+        Rewrite all ObjectId references within a document.
+
+        :param doc: document to remap (modified in place)
+        :returns: the remapped document
+        '''
+        for field in REFERENCE_FIELDS:
+            if isinstance(doc.get(field), ObjectId):
+                doc[field] = self(doc[field])
+
+        if isinstance(doc.get('votes'), list):
+            # vote buckets embed their votes
+            for entry in doc['votes']:
+                self.remap(entry)
+        return doc
+
+
+def _insert_batch(db: FrumpdexDatabase, collection: str, docs: List[dict]) -> int:
+    if collection == 'vote_labels':
+        # vote labels are global, only restore labels that don't exist in the target
+        result = db.vote_labels.bulk_write([
+            UpdateOne({'symbol': doc['symbol']}, {'$setOnInsert': doc}, upsert=True)
+            for doc in docs
+        ], ordered=False)
+        return result.upserted_count
+
+    try:
+        result = db.db[collection].insert_many(docs, ordered=False)
+        return len(result.inserted_ids)
+    except BulkWriteError as err:
+        # documents that were already restored are skipped so a restore can be re-run
+        errors = err.details.get('writeErrors', [])
+        if any(error.get('code') != DUPLICATE_KEY_ERROR for error in errors):
+            raise
+        return err.details.get('nInserted', 0)
+
+
+def restore_exchange(db: FrumpdexDatabase, filename: str, fmt: str = None, remap: bool = False,
+                     workers: int = 4, batch_size: int = 1000) -> Tuple[ObjectId, Dict[str, int]]:
+    '''
+    Restore an exchange archive. Documents are bulk inserted in batches by a pool of worker
+    threads. When ``remap`` is set, every document is assigned a new ObjectId and users are
+    issued new API tokens, which allows cloning an exchange into a database that already
+    contains it.
+
+    :param db: frumpdex database
+    :param filename: archive filename
+    :param fmt: archive format, "ndjson" or "bson" (detected from ``filename`` if not specified)
+    :param remap: assign new ObjectIds to the restored documents
+    :param workers: number of insert worker threads
+    :param batch_size: number of documents per insert batch
+    :returns: a tuple of ``(restored exchange id, number of restored documents per collection)``
+    '''
+    fmt = detect_archive_format(filename, fmt)
+    remapper = IdRemapper() if remap else None
+    counts = {collection: 0 for collection in EXPORT_COLLECTIONS}
+    batches = {collection: [] for collection in EXPORT_COLLECTIONS}
+    pending: Set[Future] = set()
+    exchange_id = None
+
+    def collect(done: Set[Future]) -> None:
+        for future in done:
+            collection, count = future.result()
+            counts[collection] += count
+
+    def submit(executor: ThreadPoolExecutor, collection: str, docs: List[dict]) -> None:
+        nonlocal pending
+        # bound the number of in-flight batches so memory stays flat for large archives
+        if len(pending) >= workers * 2:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            collect(done)
+        pending.add(executor.submit(lambda: (collection, _insert_batch(db, collection, docs))))
+
+    with gzip.open(filename, 'rb') as fp, ThreadPoolExecutor(max_workers=workers) as executor:
+        records = read_archive(fp, fmt)
+        header = next(records, (None, {}))[1]
+        if header.get('format') != ARCHIVE_FORMAT:
+            raise ValueError(f'not a frumpdex exchange archive: {filename}')
+        if header.get('version', 0) > ARCHIVE_VERSION:
+            raise ValueError(f'unsupported archive version: {header["version"]}')
+
+        exchange_id = header['exchange_id']
+        if remapper:
+            exchange_id = remapper(exchange_id)
+
+        for collection, doc in records:
+            if collection not in batches:
+                logger.warning(f'skipping unknown collection in archive: {collection}')
+                continue
+
+            if remapper:
+                remapper.remap(doc)
+                if collection == 'users':
+                    doc['token'] = secrets.token_hex(16)
+
+            batch = batches[collection]
+            batch.append(doc)
+            if len(batch) >= batch_size:
+                submit(executor, collection, batch)
+                batches[collection] = []
+
+        for collection, batch in batches.items():
+            if batch:
+                submit(executor, collection, batch)
+
+        collect(wait(pending).done)
+
+    if header.get('votes_archived_before') and counts['votes_archive']:
+        # archived votes are only read for date ranges before the archive cutoff
+        db.archive_log.update_one({'_id': 'votes'}, {
+            '$max': {'before': header['votes_archived_before']}
+        }, upsert=True)
+
+    for collection, count in counts.items():
+        logger.info(f'restored {count} {collection} documents to exchange {exchange_id}')
+
+    return exchange_id, counts
@@ -0,0 +1,191 @@
+#
+# Copyright (c) 2020, Adam Meily
+# All rights reserved.
+#
+'''
+In-process caches.
+'''
+import hashlib
+import secrets
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, Optional
+
+from bson import ObjectId
+
+
+class TTLCache:
+    '''
+    A bounded, thread safe cache where each entry expires after a fixed number of seconds.
+    '''
+
+    def __init__(self, ttl: float, max_entries: int = 1024):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.__lock = threading.Lock()
+        self.__entries: 'OrderedDict[Hashable, tuple]' = OrderedDict()
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        '''
+        :returns: the cached value or ``None`` if the key is not cached or has expired
+        '''
+        with self.__lock:
+            item = self.__entries.get(key)
+            if not item:
+                return None
+
+            expires, value = item
+            if expires <= time.monotonic():
+                del self.__entries[key]
+                return None
+
+            self.__entries.move_to_end(key)
+            return value
+
+    def put(self, key: Hashable, value: Any) -> None:
+        '''
+        Cache a value, evicting the least recently used entry if the cache is full.
+        '''
+        if self.ttl <= 0:
+            return
+
+        with self.__lock:
+            self.__entries[key] = (time.monotonic() + self.ttl, value)
+            self.__entries.move_to_end(key)
+            while len(self.__entries) > self.max_entries:
+                self.__entries.popitem(last=False)
+
+    def evict(self, key: Hashable) -> None:
+        '''
+        Remove a key from the cache.
+        '''
+        with self.__lock:
+            self.__entries.pop(key, None)
+
+    def clear(self) -> None:
+        '''
+        Remove every entry from the cache.
+        '''
+        with self.__lock:
+            self.__entries.clear()
+
+
+class CacheEntry:
+    '''
+    A cached response. ``data`` is the resource's return value and ``bodies`` holds the
+    serialized response body per media type so it is only encoded once.
+    '''
+    __slots__ = ('etag', 'data', 'bodies')
+
+    def __init__(self, etag: str, data: Any):
+        self.etag = etag
+        self.data = data
+        self.bodies: Dict[Hashable, bytes] = {}
+
+
+class ResponseCache:
+    '''
+    Versioned cache of API responses. Each exchange has a version counter that is bumped whenever
+    data belonging to the exchange changes, along with a global version for data that is shared by
+    every exchange (vote labels). A cached response is valid as long as the versions it was built
+    from have not changed, and its ETag is derived from those versions so conditional requests can
+    be answered without building the response.
+    '''
+
+    def __init__(self, max_entries: int = 1024):
+        self.max_entries = max_entries
+        #: seconds that a cached response stays valid when data may change without the versions
+        #: being bumped, ``None`` to rely on the versions alone
+        self.max_age: Optional[float] = None
+        #: random per-process value so ETags issued before a restart are never matched
+        self.boot_id = secrets.token_hex(4)
+        self.__lock = threading.Lock()
+        self.__global_version = 0
+        self.__versions: Dict[ObjectId, int] = {}
+        self.__entries: 'OrderedDict[Hashable, CacheEntry]' = OrderedDict()
+
+    def bump(self, exchange_id: ObjectId = None) -> None:
+        '''
+        Invalidate cached responses.
+
+        :param exchange_id: the exchange whose data changed, or ``None`` to invalidate the
+            responses of every exchange
+        '''
+        with self.__lock:
+            if exchange_id:
+                self.__versions[exchange_id] = self.__versions.get(exchange_id, 0) + 1
+            else:
+                self.__global_version += 1
+
+    def etag(self, key: Hashable, exchange_id: ObjectId = None) -> str:
+        '''
+        :param key: cache key
+        :param exchange_id: the exchange that the response belongs to
+        :returns: the ETag of the current version of the response
+        '''
+        with self.__lock:
+            versions = (self.__global_version, self.__versions.get(exchange_id, 0))
+        if self.max_age:
+            # the ETag, and so the cached response, rolls over every max_age seconds
+            versions += (int(time.time() // self.max_age),)
+        digest = hashlib.sha1(repr((self.boot_id, key, exchange_id, versions)).encode())
+        return digest.hexdigest()[:20]
+
+    def get(self, key: Hashable, etag: str) -> Optional[CacheEntry]:
+        '''
+        :param key: cache key
+        :param etag: the current ETag of the response
+        :returns: the cached response if it is still current
+        '''
+        with self.__lock:
+            entry = self.__entries.get(key)
+            if not entry:
+                return None
+
+            if entry.etag != etag:
+                del self.__entries[key]
+                return None
+
+            self.__entries.move_to_end(key)
+            return entry
+
+    def put(self, key: Hashable, etag: str, data: Any) -> CacheEntry:
+        '''
+        Cache a response.
+
+        :param key: cache key
+        :param etag: the ETag computed before the response data was read
+        :param data: response data
+        :returns: the cache entry
+        '''
+        entry = CacheEntry(etag, data)
+        with self.__lock:
+            self.__entries[key] = entry
+            self.__entries.move_to_end(key)
+            while len(self.__entries) > self.max_entries:
+                self.__entries.popitem(last=False)
+        return entry
+
+    def fetch(self, key: Hashable, exchange_id: Optional[ObjectId],
+              builder: Callable[[], Any]) -> CacheEntry:
+        '''
+        Get a cached response, building and caching it if it is missing or out of date.
+
+        :param key: cache key
+        :param exchange_id: the exchange that the response belongs to
+        :param builder: function that builds the response data
+        :returns: the cache entry
+        '''
+        etag = self.etag(key, exchange_id)
+        entry = self.get(key, etag)
+        if not entry:
+            entry = self.put(key, etag, builder())
+        return entry
+
+    def clear(self) -> None:
+        '''
+        Remove every cached response.
+        '''
+        with self.__lock:
+            self.__entries.clear()
@@ -0,0 +1,197 @@
+#
+# Copyright (c) 2020, Adam Meily
+# All rights reserved.
+#
+'''
+Response compression for the API and views.
+'''
+import time
+import zlib
+from typing import Iterable, Iterator, Optional
+
+from flask import Flask, Response, request
+
+from .metrics import metrics
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+#: media types that are worth compressing
+COMPRESSIBLE_MIMETYPES = {
+    'application/json',
+    'application/bson',
+    'application/msgpack',
+    'application/x-msgpack',
+    'application/javascript',
+    'text/html',
+    'text/css',
+    'text/plain'
+}
+
+#: content encodings the server may send
+CONTENT_ENCODINGS = ('br', 'gzip')
+
+
+def encoded_etag(etag: str, encoding: str) -> str:
+    '''
+    :param etag: ETag of the uncompressed response
+    :param encoding: content encoding of the response body
+    :returns: the ETag of the response body compressed with the encoding
+    '''
+    return f'{etag}-{encoding}'
+
+
+class Compressor:
+    '''
+    Incremental gzip or brotli compressor.
+    '''
+
+    def __init__(self, encoding: str, level: int, brotli_quality: int):
+        self.encoding = encoding
+        if encoding == 'br':
+            self._compressor = brotli.Compressor(quality=brotli_quality)
+        else:
+            # wbits=31 produces a gzip container
+            self._compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+
+    def compress(self, data: bytes) -> bytes:
+        '''
+        Compress a chunk of data, returning any compressed output that is ready.
+        '''
+        if self.encoding == 'br':
+            return self._compressor.process(data)
+        return self._compressor.compress(data)
+
+    def flush(self) -> bytes:
+        '''
+        Flush the remaining compressed output, finalizing the stream.
+        '''
+        if self.encoding == 'br':
+            return self._compressor.finish()
+        return self._compressor.flush()
+
+
+class ResponseCompression:
+    '''
+    Compresses responses with brotli (when the ``brotli`` package is installed) or gzip,
+    depending on what the client accepts. Small responses are sent as is. Streamed responses are
+    compressed chunk by chunk as they are generated rather than buffered.
+
+    Responses built from the response cache carry a ``compressed_cache`` dictionary, which is used
+    to store the compressed body so a cached response is only compressed once per encoding.
+    '''
+
+    def __init__(self, app: Flask = None, min_size: int = 1024, level: int = 6,
+                 brotli_quality: int = 5):
+        self.min_size = min_size
+        self.level = level
+        self.brotli_quality = brotli_quality
+        if app:
+            self.init_app(app)
+
+    def init_app(self, app: Flask) -> None:
+        '''
+        Register the compression handler with the application.
+        '''
+        app.after_request(self.after_request)
+
+    def select_encoding(self) -> Optional[str]:
+        '''
+        :returns: the best content encoding the client accepts
+        '''
+        if brotli and 'br' in request.accept_encodings:
+            return 'br'
+        if 'gzip' in request.accept_encodings:
+            return 'gzip'
+        return None
+
+    def after_request(self, response: Response) -> Response:
+        '''
+        Compress the response if it is eligible.
+        '''
+        if (response.status_code != 200 or response.direct_passthrough or
+                'Content-Encoding' in response.headers or
+                response.mimetype not in COMPRESSIBLE_MIMETYPES):
+            return response
+
+        # whether the response is compressed depends on the request's Accept-Encoding, even
+        # when this response is too small or the client doesn't accept a supported encoding
+        response.vary.add('Accept-Encoding')
+        encoding = self.select_encoding()
+        if not encoding:
+            return response
+
+        if response.is_streamed:
+            response.response = self.compress_stream(response.response, encoding)
+            response.headers.pop('Content-Length', None)
+        else:
+            data = response.get_data()
+            if len(data) < self.min_size:
+                return response
+
+            cache = getattr(response, 'compressed_cache', None)
+            cache_key = (response.mimetype, encoding)
+            body = cache.get(cache_key) if cache is not None else None
+            if body is None:
+                body = self.compress(data, encoding)
+                if cache is not None:
+                    cache[cache_key] = body
+            else:
+                metrics.increment('compression.cache_hits')
+
+            response.set_data(body)
+
+        # the compressed body is a different entity than the uncompressed body
+        etag, weak = response.get_etag()
+        if etag:
+            response.set_etag(encoded_etag(etag, encoding), weak)
+        response.headers['Content-Encoding'] = encoding
+        return response
+
+    def compress(self, data: bytes, encoding: str) -> bytes:
+        '''
+        Compress a complete response body and record compression metrics.
+        '''
+        start = time.perf_counter()
+        compressor = Compressor(encoding, self.level, self.brotli_quality)
+        body = compressor.compress(data) + compressor.flush()
+        self.record(encoding, len(data), len(body), time.perf_counter() - start)
+        return body
+
+    def compress_stream(self, chunks: Iterable[bytes], encoding: str) -> Iterator[bytes]:
+        '''
+        Compress a streamed response body as it is generated.
+        '''
+        compressor = Compressor(encoding, self.level, self.brotli_quality)
+        size_in = size_out = 0
+        elapsed = 0.0
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode()
+            start = time.perf_counter()
+            output = compressor.compress(chunk)
+            elapsed += time.perf_counter() - start
+            size_in += len(chunk)
+            size_out += len(output)
+            if output:
+                yield output
+
+        start = time.perf_counter()
+        output = compressor.flush()
+        elapsed += time.perf_counter() - start
+        size_out += len(output)
+        self.record(encoding, size_in, size_out, elapsed)
+        yield output
+
+    def record(self, encoding: str, size_in: int, size_out: int, elapsed: float) -> None:
+        '''
+        Record compression metrics.
+        '''
+        metrics.increment(f'compression.{encoding}.responses')
+        metrics.increment('compression.bytes_in', size_in)
+        metrics.increment('compression.bytes_out', size_out)
+        if size_in:
+            metrics.observe('compression.ratio', size_out / size_in)
+        metrics.observe('compression.time_ms', elapsed * 1000)
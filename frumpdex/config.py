@@ -12,6 +12,63 @@ schema.gitlab.url = UrlField()
 
 schema.logfile = FilenameField()
 
+schema.logging.asynchronous = BoolField(default=True)
+schema.logging.queue_size = IntField(default=10000, min=1)
+schema.logging.sample_burst = IntField(default=20, min=0)
+schema.logging.sample_interval = IntField(default=60, min=1)
+
 schema.mongodb.url = UrlField(default='mongodb://localhost:27017', required=True)
 
+schema.socketio.replay_buffer_size = IntField(default=256, min=1)
+
+schema.asyncio.wsgi_workers = IntField(default=16, min=1)
+
+schema.compression.enabled = BoolField(default=True)
+schema.compression.min_size = IntField(default=1024, min=0)
+schema.compression.level = IntField(default=6, min=1, max=9)
+schema.compression.brotli_quality = IntField(default=5, min=0, max=11)
+
+schema.ratelimit.enabled = BoolField(default=True)
+schema.ratelimit.user_votes_per_minute = IntField(default=30, min=1)
+schema.ratelimit.user_burst = IntField(default=10, min=1)
+schema.ratelimit.exchange_votes_per_minute = IntField(default=600, min=1)
+schema.ratelimit.exchange_burst = IntField(default=100, min=1)
+schema.ratelimit.max_inflight = IntField(default=256, min=1)
+
+schema.cache.max_entries = IntField(default=1024, min=1)
+schema.cache.user_ttl = IntField(default=60, min=0)
+
+schema.view.refresh_interval = IntField(default=300, min=1)
+
+schema.invalidation.enabled = BoolField(default=True)
+schema.invalidation.consumer = StringField()
+schema.invalidation.save_interval = IntField(default=5, min=1)
+
+schema.search.limit = IntField(default=10, min=1)
+schema.search.max_limit = IntField(default=50, min=1)
+
+schema.leaderboard.size = IntField(default=10, min=1)
+schema.leaderboard.max_size = IntField(default=100, min=1)
+
+schema.valuation.initial_value = FloatField(default=1000.0, min=0)
+schema.valuation.vote_weight = FloatField(default=0.01, min=0)
+schema.valuation.rating_weight = FloatField(default=0.002, min=0)
+schema.valuation.gitlab_weight = FloatField(default=0.005, min=0)
+schema.valuation.max_daily_change = FloatField(default=0.1, min=0, max=1)
+schema.valuation.max_exchanges = IntField(default=64, min=1)
+
+schema.timeseries.max_points = IntField(default=366, min=1)
+schema.timeseries.max_days = IntField(default=3660, min=1)
+
+schema.archive.vote_max_age_days = IntField(default=180, min=1)
+schema.archive.batch_size = IntField(default=1000, min=1)
+
+schema.votes.storage = StringField(default='documents', choices=['documents', 'buckets'])
+schema.votes.bucket_size = IntField(default=200, min=1)
+
+schema.journal.enabled = BoolField(default=False)
+schema.journal.path = StringField(default='journal')
+schema.journal.max_segment_size = IntField(default=16 * 1024 * 1024, min=4096)
+schema.journal.retry_interval = IntField(default=5, min=1)
+
 config = schema()
@@ -3,17 +3,33 @@
 # All rights reserved.
 #
 import logging
-from typing import List, Union, Any, Optional
+import os
+import socket
+from datetime import date, datetime, timedelta, timezone
+from typing import List, Union, Any, Optional, Iterable, Iterator, Tuple
 import threading
 import secrets
+import time
 
 import pymongo
 import pymongo.collection
 import pymongo.database
+import pymongo.errors
+from pymongo import ReturnDocument
 from bson import ObjectId
 from slugify import slugify
 import arrow
 
+from .cache import ResponseCache, TTLCache
+from .config import config
+from .invalidation import CacheInvalidator
+from .journal import JournalLocked, VoteJournal, VoteReplayer
+from .leaderboard import WINDOWS, LeaderboardCache, local_date, window_start
+from .materialized import MaterializedViews
+from .sequences import AppliedSequences
+from .search import StockSearchIndexes, TextSearch, comment_snippet
+from .valuation import StockValuations, ValuationModel
+
 logger = logging.getLogger(__name__)
 
 
@@ -38,6 +54,47 @@ class ItemDoesNotExist(Exception):
 
 ObjectIdStr = Union[str, ObjectId]
 
+#: vote fields that are stored once on a vote bucket instead of on each vote entry
+VOTE_BUCKET_FIELDS = ('stock_id', 'exchange_id', 'date')
+
+#: the counter updates of a vote, each named after the collection it updates
+VOTE_COUNTER_STEPS = ('stock_day_activity', 'stocks', 'user_day_activity')
+
+#: aggregation projection that turns an unwound vote bucket into a vote document
+BUCKET_VOTE_PROJECTION = {
+    '_id': '$votes._id',
+    'seq': '$votes.seq',
+    'stock_id': '$stock_id',
+    'user_id': '$votes.user_id',
+    'exchange_id': '$exchange_id',
+    'comment': '$votes.comment',
+    'rating': '$votes.rating',
+    'labels': '$votes.labels',
+    'date': '$date'
+}
+
+
+class VoteWrite:
+    '''
+    A single document update made while applying a vote. The vote writes are built once, by
+    :meth:`FrumpdexDatabase.vote_writes`, and executed in order by both the pymongo and the motor
+    database drivers.
+
+    :param step: ``store``, ``pending``, or one of the :data:`VOTE_COUNTER_STEPS`
+    :param collection: collection name
+    :param query: update filter
+    :param update: update document
+    :param upsert: insert the document if it does not exist
+    '''
+
+    def __init__(self, step: str, collection: str, query: dict, update: dict,
+                 upsert: bool = False):
+        self.step = step
+        self.collection = collection
+        self.query = query
+        self.update = update
+        self.upsert = upsert
+
 
 class FrumpdexDatabase:
     '''
@@ -54,9 +111,40 @@ class FrumpdexDatabase:
             cls.__instance = cls()
         return cls.__instance
 
+    #: number of seconds to cache the vote archive cutoff date
+    ARCHIVE_CUTOFF_TTL = 300
+
+    #: number of seconds before the journal lease of a process that stopped renewing it expires
+    JOURNAL_LEASE_TTL = 30
+
     def __init__(self):
         self.client = None
         self.__trade_lock = threading.Lock()
+        self.__archive_cutoff: Optional[datetime] = None
+        self.__archive_cutoff_expires = 0.0
+        self.leaderboards = LeaderboardCache()
+        self.response_cache = ResponseCache(max_entries=config.cache.max_entries)
+        self.user_cache = TTLCache(config.cache.user_ttl, max_entries=config.cache.max_entries)
+        self.exchange_cache = TTLCache(config.cache.user_ttl,
+                                       max_entries=config.cache.max_entries)
+        self.views = MaterializedViews(config.view.refresh_interval)
+        self.stock_index = StockSearchIndexes(config.view.refresh_interval)
+        self.valuations = StockValuations(ValuationModel(
+            initial_value=config.valuation.initial_value,
+            vote_weight=config.valuation.vote_weight,
+            rating_weight=config.valuation.rating_weight,
+            gitlab_weight=config.valuation.gitlab_weight,
+            max_change=config.valuation.max_daily_change),
+            max_days=config.timeseries.max_days, max_entries=config.valuation.max_exchanges)
+        self.stock_cache = TTLCache(config.cache.user_ttl, max_entries=config.cache.max_entries)
+        self.journal: Optional[VoteJournal] = None
+        self.replayer: Optional[VoteReplayer] = None
+        self.invalidator: Optional[CacheInvalidator] = None
+        self.applied_seqs = AppliedSequences()
+        self.__seq_lock = threading.Lock()
+        self.__vote_seqs = {}
+        self.__journal_seeded = set()
+        self.__journal_lease_renew_at = 0.0
 
     def connect(self, uri: str = 'mongodb://localhost:27017') -> None:
         '''
@@ -71,40 +159,162 @@ class FrumpdexDatabase:
 
         self._create_indexes()
 
+    def enable_journal(self, path: str, max_segment_size: int = 16 * 1024 * 1024,
+                       retry_interval: float = 5.0) -> None:
+        '''
+        Enable the local vote journal. Once enabled, votes are acknowledged as soon as they are
+        durably journaled and are applied to the database by a background replayer. Votes left
+        in the journal by a previous run are replayed.
+
+        In journal mode vote sequence numbers are allocated in memory, so only a single server
+        process may use the journal. This is enforced with a lease stored in the database, which
+        the replayer renews. Enabling the journal raises :class:`~frumpdex.journal.JournalLocked`
+        while another server holds the lease.
+
+        :param path: journal directory
+        :param max_segment_size: journal segment size in bytes
+        :param retry_interval: seconds to wait before retrying a failed replay
+        '''
+        # the same journal, restarted on the same host, may reclaim the lease immediately
+        owner = f'{socket.gethostname()}:{os.path.abspath(path)}'
+        journal = VoteJournal(path, max_segment_size)
+        if not self._renew_journal_lease(owner):
+            journal.close()
+            lease = self.locks.find_one({'_id': 'vote_journal'}) or {}
+            raise JournalLocked(f'vote journal is in use by another server: {lease.get("owner")}')
+
+        self.journal = journal
+        self.__vote_seqs = self.journal.pending_sequences()
+        self.__journal_seeded = set()
+        self.replayer = VoteReplayer(self.journal, self.replay_vote, retry_interval,
+                                     heartbeat=lambda: self._heartbeat_journal_lease(owner))
+        try:
+            # catch up before serving so that the votes are visible to the in-memory caches
+            count = self.replayer.replay()
+            if count:
+                logger.info(f'replayed {count} votes from the journal')
+        except pymongo.errors.PyMongoError as err:
+            logger.warning(f'failed to replay the vote journal: {err}')
+        self.replayer.start()
+        logger.info(f'vote journal enabled: {path}')
+
+    def _renew_journal_lease(self, owner: str) -> bool:
+        '''
+        Claim or renew the lease that lets a single server allocate vote sequence numbers in
+        journal mode.
+
+        :param owner: the journal claiming the lease
+        :returns: ``True`` if the lease is held by ``owner``
+        '''
+        now = arrow.utcnow().datetime
+        try:
+            self.locks.update_one({
+                '_id': 'vote_journal',
+                '$or': [{'owner': owner}, {'expires': {'$lt': now}}]
+            }, {
+                '$set': {'owner': owner,
+                         'expires': now + timedelta(seconds=self.JOURNAL_LEASE_TTL)}
+            }, upsert=True)
+        except pymongo.errors.DuplicateKeyError:
+            return False
+
+        self.__journal_lease_renew_at = time.monotonic() + self.JOURNAL_LEASE_TTL / 3
+        return True
+
+    def _heartbeat_journal_lease(self, owner: str) -> None:
+        if time.monotonic() < self.__journal_lease_renew_at:
+            return
+
+        if not self._renew_journal_lease(owner):
+            logger.error('the vote journal lease was claimed by another server, vote sequence '
+                         'numbers may be duplicated')
+
+    def enable_invalidation(self, consumer: str, save_interval: float = 5.0) -> None:
+        '''
+        Start tailing the MongoDB change stream to invalidate the in-process caches when another
+        process writes to the database. On a standalone MongoDB server, which does not support
+        change streams, the caches fall back to TTL based expiry.
+
+        :param consumer: stable name of this process, used to store the change stream resume
+            token
+        :param save_interval: seconds between saving the resume token
+        '''
+        self.invalidator = CacheInvalidator(self, consumer, save_interval)
+        self.invalidator.start()
+
+    def use_ttl_caching(self) -> None:
+        '''
+        Expire cached responses and leaderboards after a fixed time, for when changes made by
+        other processes cannot be observed.
+        '''
+        max_age = max(1, config.cache.user_ttl)
+        self.response_cache.max_age = max_age
+        self.leaderboards.max_age = config.view.refresh_interval
+        self.valuations.max_age = config.view.refresh_interval
+
+    def clear_caches(self) -> None:
+        '''
+        Drop every in-process cache.
+        '''
+        self.user_cache.clear()
+        self.exchange_cache.clear()
+        self.stock_cache.clear()
+        self.views.clear()
+        self.stock_index.clear()
+        self.leaderboards.clear()
+        self.valuations.clear()
+        self.response_cache.bump()
+
+    #: indexes of each collection
+    INDEXES = {
+        'users': ['token'],
+        'votes': ['exchange_id', 'stock_id', 'labels',
+                  [('user_id', pymongo.ASCENDING), ('date', pymongo.ASCENDING)],
+                  [('exchange_id', pymongo.ASCENDING), ('comment', pymongo.TEXT)]],
+        'stock_day_activity': ['exchange_id', 'stock_id',
+                               [('exchange_id', pymongo.ASCENDING), ('date', pymongo.ASCENDING)]],
+        'user_day_activity': ['exchange_id',
+                              [('user_id', pymongo.ASCENDING), ('date', pymongo.ASCENDING)]],
+        'stocks': ['exchange_id'],
+        'vote_labels': ['symbol'],
+        'votes_archive': [[('exchange_id', pymongo.ASCENDING), ('date', pymongo.ASCENDING)],
+                          'stock_id',
+                          [('user_id', pymongo.ASCENDING), ('date', pymongo.ASCENDING)],
+                          [('exchange_id', pymongo.ASCENDING), ('comment', pymongo.TEXT)]],
+        'vote_buckets': [[('exchange_id', pymongo.ASCENDING), ('date', pymongo.ASCENDING)],
+                         [('stock_id', pymongo.ASCENDING), ('date', pymongo.ASCENDING)],
+                         'date',
+                         [('votes.user_id', pymongo.ASCENDING), ('date', pymongo.ASCENDING)],
+                         [('exchange_id', pymongo.ASCENDING), ('votes.comment', pymongo.TEXT)]]
+    }
+
+    #: options of collections that are not created with the defaults
+    COLLECTION_OPTIONS = {
+        # archived votes are rarely read, trade cpu for disk with a stronger compressor
+        'votes_archive': {
+            'storageEngine': {'wiredTiger': {'configString': 'block_compressor=zlib'}}
+        }
+    }
+
     def _create_indexes(self) -> None:
         '''
-        Create collection indexes.
+        Create the collections and any of their :attr:`INDEXES` that do not exist yet. This is
+        run on every connect so that indexes added by a new release are built on existing
+        databases.
         '''
         db = self.db
         collection_names = db.collection_names()
-        if 'users' not in collection_names:
-            logger.info('creating index for users collection')
-            users = db.create_collection('users')
-            users.create_index('token')
-
-        if 'votes' not in collection_names:
-            logger.info('creating index for votes collection')
-            votes = db.create_collection('votes')
-            votes.create_index('exchange_id')
-            votes.create_index('stock_id')
-            votes.create_index('user_id')
-            votes.create_index('labels')
-
-        if 'stock_day_activity' not in collection_names:
-            logger.info('creating index for stock_day_activity collection')
-            activity = db.create_collection('stock_day_activity')
-            activity.create_index('exchange_id')
-            activity.create_index('stock_id')
-
-        if 'stocks' not in collection_names:
-            logger.info('creating index for stocks collection')
-            stocks = db.create_collection('stocks')
-            stocks.create_index('exchange_id')
-
-        if 'vote_labels' not in collection_names:
-            logger.info('creating index for vote_labels collection')
-            vlabels = db.create_collection('vote_labels')
-            vlabels.create_index('symbol')
+        for name, keys in self.INDEXES.items():
+            if name not in collection_names:
+                logger.info(f'creating {name} collection')
+                db.create_collection(name, **self.COLLECTION_OPTIONS.get(name, {}))
+
+            existing = db[name].index_information()
+            missing = [pymongo.IndexModel(key) for key in keys]
+            missing = [model for model in missing if model.document['name'] not in existing]
+            if missing:
+                logger.info(f'creating {len(missing)} indexes for {name} collection')
+                db[name].create_indexes(missing)
 
     def _stock_statistics_initial_doc(self) -> dict:
         return {
@@ -113,6 +323,20 @@ class FrumpdexDatabase:
             'ratings': 0
         }
 
+    def _label_symbols(self, labels: List[str]) -> List[str]:
+        '''
+        Normalize vote labels to symbols that are safe to use as document keys.
+
+        :param labels: vote labels
+        :returns: the unique, non-empty label symbols
+        '''
+        symbols = []
+        for label in labels:
+            symbol = slugify(label) if isinstance(label, str) else ''
+            if symbol and symbol not in symbols:
+                symbols.append(symbol)
+        return symbols
+
     @property
     def db(self) -> pymongo.database.Database:
         '''
@@ -136,6 +360,21 @@ class FrumpdexDatabase:
         '''
         return self.db.votes
 
+    @property
+    def vote_buckets(self) -> pymongo.collection.Collection:
+        '''
+        :returns: the vote_buckets collection, holds the votes of a stock for a single day when
+            the ``buckets`` vote storage layout is enabled
+        '''
+        return self.db.vote_buckets
+
+    @property
+    def bucketed_votes(self) -> bool:
+        '''
+        :returns: new votes are stored in vote buckets rather than as individual documents
+        '''
+        return config.votes.storage == 'buckets'
+
     @property
     def vote_labels(self) -> pymongo.collection.Collection:
         '''
@@ -157,6 +396,42 @@ class FrumpdexDatabase:
         '''
         return self.db.stocks
 
+    @property
+    def votes_archive(self) -> pymongo.collection.Collection:
+        '''
+        :returns: the votes_archive collection, cold storage for old votes
+        '''
+        return self.db.votes_archive
+
+    @property
+    def user_day_activity(self) -> pymongo.collection.Collection:
+        '''
+        :returns: the user_day_activity collection, the vote counters of each user per day
+        '''
+        return self.db.user_day_activity
+
+    @property
+    def archive_log(self) -> pymongo.collection.Collection:
+        '''
+        :returns: the archive_log collection, tracks the state of archival jobs
+        '''
+        return self.db.archive_log
+
+    @property
+    def locks(self) -> pymongo.collection.Collection:
+        '''
+        :returns: the locks collection, leases held by a single server process
+        '''
+        return self.db.locks
+
+    @property
+    def change_stream_tokens(self) -> pymongo.collection.Collection:
+        '''
+        :returns: the change_stream_tokens collection, stores the change stream resume token of
+            each server process
+        '''
+        return self.db.change_stream_tokens
+
     @property
     def stock_day_activity(self) -> pymongo.collection.Collection:
         '''
@@ -164,6 +439,319 @@ class FrumpdexDatabase:
         '''
         return self.db.stock_day_activity
 
+    def first_activity_day(self, exchange_id: ObjectId) -> Optional[date]:
+        '''
+        :param exchange_id: exchange id
+        :returns: the first day with stock activity in the exchange, ``None`` if there is none
+        '''
+        doc = self.stock_day_activity.find_one({'exchange_id': exchange_id}, {'date': 1},
+                                               sort=[('date', pymongo.ASCENDING)])
+        if not doc:
+            return None
+        # activity dates are local midnight stored as UTC
+        return arrow.get(doc['date']).to('local').shift(hours=12).date()
+
+    def archive_votes(self, max_age_days: int, batch_size: int = 1000) -> int:
+        '''
+        Move votes older than ``max_age_days`` from the ``votes`` and ``vote_buckets``
+        collections to the compressed ``votes_archive`` collection. Archived votes are stored as
+        individual documents regardless of the vote storage layout. Stock and day activity
+        counters are not modified. The job is safe to re-run after an interruption: votes are
+        copied to the archive before they are deleted and votes that were already archived are
+        skipped.
+
+        :param max_age_days: archive votes cast more than this number of days ago
+        :param batch_size: number of votes to move per batch
+        :returns: the number of archived votes
+        '''
+        cutoff = (midnight() - timedelta(days=max_age_days)).datetime
+        count = 0
+        while True:
+            batch = list(self.votes.find({'date': {'$lt': cutoff}}).sort('_id', 1)
+                         .limit(batch_size))
+            if not batch:
+                break
+
+            self._insert_archived_votes(batch)
+            result = self.votes.delete_many({'_id': {'$in': [vote['_id'] for vote in batch]}})
+            count += result.deleted_count
+            logger.debug(f'archived {count} votes')
+
+        bucket_batch_size = max(1, batch_size // config.votes.bucket_size)
+        while True:
+            buckets = list(self.vote_buckets.find({'date': {'$lt': cutoff}}).sort('_id', 1)
+                           .limit(bucket_batch_size))
+            if not buckets:
+                break
+
+            self._insert_archived_votes([self.unbucket_vote(bucket, entry) for bucket in buckets
+                                         for entry in bucket['votes']])
+            self.vote_buckets.delete_many({'_id': {'$in': [bucket['_id'] for bucket in buckets]}})
+            count += sum(len(bucket['votes']) for bucket in buckets)
+            logger.debug(f'archived {count} votes')
+
+        self.archive_log.update_one({'_id': 'votes'}, {
+            '$max': {'before': cutoff},
+            '$inc': {'count': count},
+            '$set': {'date': arrow.utcnow().datetime}
+        }, upsert=True)
+        self.__archive_cutoff_expires = 0.0
+
+        logger.info(f'archived {count} votes older than {cutoff.date()}')
+        return count
+
+    def _insert_archived_votes(self, votes: List[dict]) -> None:
+        try:
+            self.votes_archive.insert_many(votes, ordered=False)
+        except pymongo.errors.BulkWriteError as err:
+            if any(error.get('code') != 11000 for error in err.details['writeErrors']):
+                raise
+
+    def votes_archived_before(self, after: datetime = None) -> Optional[datetime]:
+        '''
+        The cutoff only ever moves forward, so a cached cutoff that is later than ``after`` is
+        still correct when another process has since archived more votes. A cached cutoff that
+        is not, including a cached ``None``, is read again from the ``archive_log`` collection.
+
+        :param after: the date the caller needs the cutoff to be later than
+        :returns: the date before which votes have been moved to the archive, or ``None`` if
+            votes have never been archived
+        '''
+        now = time.monotonic()
+        cutoff = self.__archive_cutoff
+        if now >= self.__archive_cutoff_expires or not cutoff or (after and after >= cutoff):
+            state = self.archive_log.find_one({'_id': 'votes'})
+            cutoff = state['before'] if state else None
+            if cutoff and not cutoff.tzinfo:
+                cutoff = cutoff.replace(tzinfo=timezone.utc)
+            self.__archive_cutoff = cutoff
+            self.__archive_cutoff_expires = now + self.ARCHIVE_CUTOFF_TTL
+        return self.__archive_cutoff
+
+    def find_votes(self, q: dict, projection: dict = None) -> List[dict]:
+        '''
+        Find votes matching a query. The vote archive is only searched when the query reaches
+        back before the archive cutoff, either because it has no lower date bound (lifetime) or
+        because it is an explicit historic range.
+
+        :param q: vote query, typically built by ``parse_time_window_query``
+        :param projection: optional field projection
+        :returns: the matching votes, archived votes first followed by live votes
+        '''
+        votes = list(self.votes.find(q, projection))
+        if self.bucketed_votes:
+            # votes cast before buckets were enabled remain in the votes collection
+            votes += self._find_bucketed_votes(q, projection)
+
+        if self._reaches_archive(q):
+            votes = list(self.votes_archive.find(q, projection)) + votes
+        return votes
+
+    def _reaches_archive(self, q: dict) -> bool:
+        start = q.get('date', {}).get('$gte')
+        if start and start.tzinfo is None:
+            start = start.replace(tzinfo=timezone.utc)
+
+        cutoff = self.votes_archived_before(start)
+        if not cutoff:
+            return False
+        return start is None or start < cutoff
+
+    def _find_bucketed_votes(self, q: dict, projection: dict = None) -> List[dict]:
+        bucket_q = {key: value for key, value in q.items() if key in VOTE_BUCKET_FIELDS}
+        vote_q = {key: value for key, value in q.items() if key not in VOTE_BUCKET_FIELDS}
+        for key, value in vote_q.items():
+            if not isinstance(value, dict):
+                # only read buckets that contain a matching vote, such as the votes of a user
+                bucket_q[f'votes.{key}'] = value
+
+        # unwind the buckets into documents with the same shape as build_vote
+        pipeline = [{'$match': bucket_q}, {'$unwind': '$votes'},
+                    {'$project': BUCKET_VOTE_PROJECTION}]
+        if vote_q:
+            pipeline.append({'$match': vote_q})
+        if projection:
+            pipeline.append({'$project': projection})
+
+        return list(self.vote_buckets.aggregate(pipeline))
+
+    def search_votes(self, exchange_id: ObjectId, query: str, q: dict = None,
+                     labels: List[str] = None, offset: int = 0, limit: int = 10) -> List[dict]:
+        '''
+        Search vote comments using the text indexes of the vote collections. The vote archive is
+        searched under the same conditions as :meth:`find_votes`. Vote buckets are matched by the
+        text index and then narrowed to the votes whose comments match the search on their own,
+        see :class:`~frumpdex.search.TextSearch`, each sharing the relevance score of its bucket.
+
+        :param exchange_id: exchange id
+        :param query: MongoDB ``$text`` search string
+        :param q: additional vote query, typically built by ``parse_time_window_query``
+        :param labels: only return votes with at least one of these labels
+        :param offset: number of results to skip
+        :param limit: maximum number of results
+        :returns: the matching votes, most relevant first, each with a ``score`` and a
+            ``snippet`` of the comment in place of the full comment
+        '''
+        q = dict(q or {}, exchange_id=exchange_id)
+        vote_q = dict(q)
+        if labels:
+            vote_q['labels'] = {'$in': labels}
+
+        count = offset + limit
+        text_q = dict(vote_q, **{'$text': {'$search': query}})
+        score = {'score': {'$meta': 'textScore'}}
+        sources = [self.votes]
+        if self._reaches_archive(q):
+            sources.append(self.votes_archive)
+
+        votes = []
+        for collection in sources:
+            cursor = collection.find(text_q, score).sort([('score', {'$meta': 'textScore'})])
+            votes += cursor.limit(count)
+
+        search = TextSearch(query)
+        if self.bucketed_votes:
+            bucket_q = {key: value for key, value in q.items() if key in VOTE_BUCKET_FIELDS}
+            bucket_q['$text'] = {'$search': query}
+            pipeline = [{'$match': bucket_q}, {'$addFields': score}, {'$sort': {'score': -1}},
+                        {'$unwind': '$votes'},
+                        {'$project': dict(BUCKET_VOTE_PROJECTION, score=1)}]
+            if labels:
+                pipeline.append({'$match': {'labels': {'$in': labels}}})
+
+            # the text index can't match the votes within a bucket individually, the buckets are
+            # read most relevant first until enough of their votes match
+            matched = 0
+            for vote in self.vote_buckets.aggregate(pipeline):
+                if search.matches(vote['comment']):
+                    votes.append(vote)
+                    matched += 1
+                    if matched >= count:
+                        break
+
+        votes.sort(key=lambda vote: (vote['score'], vote['date']), reverse=True)
+        votes = votes[offset:count]
+        for vote in votes:
+            vote['snippet'] = comment_snippet(vote.pop('comment', ''), search)
+        return votes
+
+    @staticmethod
+    def unbucket_vote(bucket: dict, entry: dict) -> dict:
+        '''
+        :param bucket: vote bucket
+        :param entry: vote entry within the bucket
+        :returns: the vote document
+        '''
+        return {
+            '_id': entry['_id'],
+            'seq': entry['seq'],
+            'stock_id': bucket['stock_id'],
+            'user_id': entry['user_id'],
+            'exchange_id': bucket['exchange_id'],
+            'comment': entry['comment'],
+            'rating': entry['rating'],
+            'labels': entry['labels'],
+            'date': bucket['date']
+        }
+
+    def exchange_snapshot(self, exchange_id: ObjectIdStr) -> dict:
+        '''
+        Get everything needed to render an exchange in a single document: the exchange, its
+        stocks (sorted by name) with today's activity joined to each stock, and the vote labels.
+        The snapshot is cached until the exchange or the vote labels change.
+
+        :param exchange_id: exchange id
+        :returns: the exchange snapshot
+        '''
+        exchange_id = ObjectId(exchange_id)
+        key = ('exchange.snapshot', exchange_id, midnight().date())
+        return self.response_cache.fetch(key, exchange_id,
+                                         lambda: self._build_exchange_snapshot(exchange_id)).data
+
+    def _build_exchange_snapshot(self, exchange_id: ObjectId) -> dict:
+        # read while none of the exchange's votes are being written, so that the counters include
+        # exactly the votes up to the snapshot's sequence number
+        with self.applied_seqs.quiesce(exchange_id) as seq:
+            if seq is None:
+                # no votes written since the server started, in journal mode the stored sequence
+                # only covers votes that have been replayed
+                seq = self._stored_vote_sequence(exchange_id)
+            return self._read_exchange_snapshot(exchange_id, seq)
+
+    def _read_exchange_snapshot(self, exchange_id: ObjectId, seq: int) -> dict:
+        activity_projection = {'stock_id': 1, 'ups': 1, 'downs': 1, 'rating': 1, 'labels': 1,
+                               '_id': 0}
+        activity = {
+            item['stock_id']: item for item in self.stock_day_activity.find({
+                'exchange_id': exchange_id,
+                'date': {'$gte': midnight().datetime}
+            }, activity_projection)
+        }
+
+        stocks = list(self.stocks.find({'exchange_id': exchange_id}).sort('name', 1))
+        for stock in stocks:
+            today = activity.get(stock['_id'], {})
+            stock['activity'] = {
+                'ups': today.get('ups', 0),
+                'downs': today.get('downs', 0),
+                'rating': today.get('rating', 0),
+                'labels': today.get('labels', {})
+            }
+
+        return {
+            'exchange': self.exchanges.find_one(exchange_id),
+            'date': midnight().datetime,
+            'seq': seq,
+            'stocks': stocks,
+            'vote_labels': list(self.vote_labels.find())
+        }
+
+    def next_vote_sequence(self, exchange_id: ObjectId) -> int:
+        '''
+        Allocate the next vote sequence number of an exchange. Sequence numbers are monotonically
+        increasing per exchange and let websocket clients detect and recover missed votes.
+
+        When the vote journal is enabled the sequence is kept in memory, seeded from the database
+        and the journal, and is persisted as journaled votes are replayed.
+
+        :param exchange_id: exchange id
+        :returns: the sequence number
+        '''
+        if self.journal:
+            with self.__seq_lock:
+                seq = self.__vote_seqs.get(exchange_id, 0)
+                if exchange_id not in self.__journal_seeded:
+                    seq = max(seq, self._stored_vote_sequence(exchange_id))
+                    self.__journal_seeded.add(exchange_id)
+                seq = self.__vote_seqs[exchange_id] = seq + 1
+                return seq
+
+        exchange = self.exchanges.find_one_and_update({'_id': exchange_id},
+                                                      {'$inc': {'vote_seq': 1}},
+                                                      projection={'vote_seq': 1},
+                                                      return_document=ReturnDocument.AFTER)
+        if not exchange:
+            raise ItemDoesNotExist('exchange')
+        return exchange['vote_seq']
+
+    def vote_sequence(self, exchange_id: ObjectId) -> int:
+        '''
+        :param exchange_id: exchange id
+        :returns: the sequence number of the most recent vote in the exchange
+        '''
+        if self.journal:
+            with self.__seq_lock:
+                if exchange_id in self.__journal_seeded:
+                    return self.__vote_seqs[exchange_id]
+                pending = self.__vote_seqs.get(exchange_id, 0)
+            return max(pending, self._stored_vote_sequence(exchange_id))
+
+        return self._stored_vote_sequence(exchange_id)
+
+    def _stored_vote_sequence(self, exchange_id: ObjectId) -> int:
+        exchange = self.exchanges.find_one({'_id': exchange_id}, {'vote_seq': 1})
+        return exchange.get('vote_seq', 0) if exchange else 0
+
     def update_gitlab_activity(self, stock_id: ObjectIdStr, activity: dict,
                                day: arrow.Arrow = None) -> None:
         '''
@@ -203,6 +791,10 @@ class FrumpdexDatabase:
             '$inc': lifetime_inc_doc
         })
 
+        self.views.clear(stock['exchange_id'])
+        self.valuations.clear(stock['exchange_id'])
+        self.response_cache.bump(stock['exchange_id'])
+
     def vote(self, stock_id: ObjectIdStr, token: str, direction: str, comment: str,
              rating: int = 0, labels: List[str] = None) -> dict:
         '''
@@ -216,13 +808,46 @@ class FrumpdexDatabase:
         :param labels: the list of label symbols applying to the vote
         :returns: the created vote
         '''
-        stock_id = ObjectId(stock_id)
-        stock = self.stocks.find_one(stock_id)
+        rating = self.vote_rating(direction, rating)
+        stock = self.find_stock(stock_id)
+        user = self.find_user_by_token(token)
+        if not user:
+            # never log the token itself, it may be a valid token with a typo
+            logger.warning('vote rejected: user token incorrect')
+        self.check_vote(stock, user)
+
+        logger.info('user %s is voting %s stock %s', user['name'], direction, stock['name'])
+        if self.journal:
+            # the sequence number is assigned as the vote is journaled so that votes are
+            # replayed in sequence order, the caches are updated once the vote is replayed
+            vote = self.build_vote(stock, user, None, comment, rating, labels)
+            self.journal.append(vote, sequence=self._journal_vote_sequence)
+            return vote
+
+        seq = None
+        self.applied_seqs.begin(stock['exchange_id'])
+        try:
+            seq = self.next_vote_sequence(stock['exchange_id'])
+            vote = self.build_vote(stock, user, seq, comment, rating, labels)
+            self.apply_vote(vote)
+            self.vote_acknowledged(stock, vote)
+        finally:
+            self.applied_seqs.end(stock['exchange_id'], seq)
+        return vote
 
-        inc_doc = self._stock_statistics_initial_doc()
+    def _journal_vote_sequence(self, vote: dict) -> None:
+        vote['seq'] = self.next_vote_sequence(vote['exchange_id'])
 
+    @staticmethod
+    def vote_rating(direction: str, rating: int = 0) -> int:
+        '''
+        Normalize a vote rating so that its sign matches the vote direction.
+
+        :param direction: the vote direction, either "up" or "down"
+        :param rating: the requested rating
+        :returns: the vote rating, between -5 and 5
+        '''
         if direction in ('up', '1', '+1'):
-            inc_doc['ups'] = 1
             if not rating:
                 rating = 1
             elif rating < 0:
@@ -231,7 +856,6 @@ class FrumpdexDatabase:
             if rating > 5:
                 rating = 5
         elif direction in ('down', '-1'):
-            inc_doc['downs'] = 1
             if not rating:
                 rating = -1
             elif rating > 0:
@@ -242,47 +866,302 @@ class FrumpdexDatabase:
         else:
             raise TypeError(f'invalid vote: {direction} -- must be either "up" or "down"')
 
-        inc_doc['rating'] = rating
+        return rating
+
+    @staticmethod
+    def check_vote(stock: Optional[dict], user: Optional[dict]) -> None:
+        '''
+        Verify that a user may vote on a stock.
 
+        :param stock: the stock, ``None`` if it does not exist
+        :param user: the user, ``None`` if the token was invalid
+        '''
         if not stock:
             raise ItemDoesNotExist('stock')
 
-        user = self.login(token)
         if not user:
             raise ItemDoesNotExist('user')
 
         if user['exchange_id'] != stock['exchange_id']:
             raise ItemDoesNotExist('user')
 
-        today = midnight().datetime
-
-        vote = {
+    @staticmethod
+    def build_vote(stock: dict, user: dict, seq: Optional[int], comment: str, rating: int,
+                   labels: List[str] = None) -> dict:
+        '''
+        :param seq: the vote sequence number, ``None`` if it is assigned later
+        :returns: a new vote document
+        '''
+        return {
             '_id': ObjectId(),
-            'stock_id': stock_id,
+            'seq': seq,
+            'stock_id': stock['_id'],
             'user_id': user['_id'],
             'exchange_id': user['exchange_id'],
             'comment': comment,
             'rating': rating,
             'labels': labels or [],
-            'date': today
+            'date': midnight().datetime
         }
 
-        logger.info(f'user {user["name"]} is voting {direction} stock {stock["name"]}')
-        self.votes.insert_one(vote)
+    def vote_updates(self, vote: dict) -> Tuple[dict, dict]:
+        '''
+        :param vote: the vote
+        :returns: a tuple of ``(stock $inc document, day activity $inc document)``
+        '''
+        inc_doc = self._stock_statistics_initial_doc()
+        if vote['rating'] > 0:
+            inc_doc['ups'] = 1
+        else:
+            inc_doc['downs'] = 1
+        inc_doc['rating'] = vote['rating']
+
+        # per-label counters are only kept on the day activity, keyed by the label symbol
+        day_inc_doc = dict(inc_doc)
+        for symbol in self._label_symbols(vote['labels']):
+            day_inc_doc[f'labels.{symbol}'] = day_inc_doc.get(f'labels.{symbol}', 0) + 1
 
-        self.stock_day_activity.update_one({
-            'stock_id': stock['_id'],
-            'exchange_id': stock['exchange_id'],
-            'date': today
+        return inc_doc, day_inc_doc
+
+    def stored_vote_query(self, vote: dict) -> Tuple[str, dict, dict]:
+        '''
+        :param vote: the vote
+        :returns: a tuple of ``(collection, query, projection)`` that finds the vote, or the
+            bucket holding the vote, if it has already been stored
+        '''
+        if self.bucketed_votes:
+            return 'vote_buckets', self._bucketed_vote_key(vote), {
+                'votes': {'$elemMatch': {'_id': vote['_id']}}
+            }
+        return 'votes', {'_id': vote['_id']}, {'pending': 1}
+
+    @staticmethod
+    def _bucketed_vote_key(vote: dict) -> dict:
+        return {'stock_id': vote['stock_id'], 'date': vote['date'], 'votes._id': vote['_id']}
+
+    def vote_bucket_update(self, vote: dict, pending: List[str] = None) -> Tuple[dict, dict]:
+        '''
+        Build the upsert that appends a vote to a bucket of its stock and day that is not full,
+        creating a new bucket once every existing bucket is full. Buckets hold at most
+        ``votes.bucket_size`` votes along with ``count``, ``ups``, ``downs``, and ``rating``
+        summary fields.
+
+        :param vote: the vote
+        :param pending: the counter updates of the vote that have not been applied yet
+        :returns: a tuple of ``(query, update)``
+        '''
+        inc_doc = {'count': 1, 'rating': vote['rating']}
+        inc_doc['ups' if vote['rating'] > 0 else 'downs'] = 1
+        entry = {key: value for key, value in vote.items() if key not in VOTE_BUCKET_FIELDS}
+        if pending is not None:
+            entry['pending'] = pending
+        return {
+            'stock_id': vote['stock_id'],
+            'exchange_id': vote['exchange_id'],
+            'date': vote['date'],
+            'count': {'$lt': config.votes.bucket_size}
         }, {
+            '$push': {'votes': entry},
             '$inc': inc_doc
-        }, upsert=True)
+        }
 
-        self.stocks.update_one({'_id': stock['_id']}, {
-            '$inc': inc_doc
-        })
+    @staticmethod
+    def user_day_update(vote: dict) -> Tuple[dict, dict]:
+        '''
+        :param vote: the vote
+        :returns: a tuple of ``(query, update)`` that adds the vote to the voter's day activity
+        '''
+        inc_doc = {'votes': 1, 'rating': vote['rating']}
+        inc_doc['ups' if vote['rating'] > 0 else 'downs'] = 1
+        return {
+            'user_id': vote['user_id'],
+            'date': vote['date']
+        }, {
+            '$inc': inc_doc,
+            '$setOnInsert': {'exchange_id': vote['exchange_id']}
+        }
 
-        return vote
+    def vote_writes(self, vote: dict, stored: Optional[dict],
+                    resumable: bool = False) -> List[VoteWrite]:
+        '''
+        Build the updates that store a vote and add it to the stock, day activity, and user day
+        activity counters.
+
+        The counter updates of a resumable vote are tracked in the vote's ``pending`` field, which
+        is cleared one counter at a time as they are applied. If applying the vote is interrupted,
+        applying it again only runs the counter updates that are still pending, so each counter
+        is incremented once even though the vote is stored by the first attempt. A counter can
+        only be incremented twice if the interruption lands between its update and the update of
+        ``pending`` that follows it, which the stock counter reconciliation repairs.
+
+        :param vote: the vote, as built by :meth:`build_vote`
+        :param stored: the result of the :meth:`stored_vote_query`, ``None`` if the vote has not
+            been stored yet
+        :param resumable: track the counter updates of a new vote so they can be resumed
+        :returns: the updates to execute in order, empty if the vote has already been applied
+        '''
+        writes = []
+        if stored is None:
+            pending = list(VOTE_COUNTER_STEPS) if resumable else None
+            writes.append(self._vote_store_write(vote, pending))
+        else:
+            if self.bucketed_votes:
+                stored = (stored.get('votes') or [{}])[0]
+            pending = stored.get('pending')
+            if not pending:
+                return []
+
+        inc_doc, day_inc_doc = self.vote_updates(vote)
+        counters = {
+            'stock_day_activity': ({
+                'stock_id': vote['stock_id'],
+                'exchange_id': vote['exchange_id'],
+                'date': vote['date']
+            }, {'$inc': day_inc_doc}, True),
+            'stocks': ({'_id': vote['stock_id']}, {'$inc': inc_doc}, False),
+            'user_day_activity': self.user_day_update(vote) + (True,)
+        }
+
+        for index, step in enumerate(pending or VOTE_COUNTER_STEPS):
+            q, update, upsert = counters[step]
+            writes.append(VoteWrite(step, step, q, update, upsert=upsert))
+            if pending is not None:
+                writes.append(self._vote_pending_write(vote, pending[index + 1:]))
+        return writes
+
+    def _vote_store_write(self, vote: dict, pending: Optional[List[str]]) -> VoteWrite:
+        if self.bucketed_votes:
+            return VoteWrite('store', 'vote_buckets', *self.vote_bucket_update(vote, pending),
+                             upsert=True)
+
+        doc = {key: value for key, value in vote.items() if key != '_id'}
+        if pending is not None:
+            doc['pending'] = pending
+        return VoteWrite('store', 'votes', {'_id': vote['_id']}, {'$setOnInsert': doc},
+                         upsert=True)
+
+    def _vote_pending_write(self, vote: dict, pending: List[str]) -> VoteWrite:
+        if self.bucketed_votes:
+            collection, q, field = 'vote_buckets', self._bucketed_vote_key(vote), 'votes.$.pending'
+        else:
+            collection, q, field = 'votes', {'_id': vote['_id']}, 'pending'
+
+        update = {'$set': {field: pending}} if pending else {'$unset': {field: ''}}
+        return VoteWrite('pending', collection, q, update)
+
+    def vote_written(self, vote: dict, writes: List[VoteWrite], results: list) -> None:
+        '''
+        Update the materialized views once the writes of a vote have been executed.
+
+        :param vote: the vote
+        :param writes: the executed :meth:`vote_writes`
+        :param results: the result of each write
+        '''
+        if writes[0].step != 'store':
+            # resumed an interrupted vote, some of its counters were updated by an earlier attempt
+            self.views.clear(vote['exchange_id'])
+            return
+
+        activity_id = None
+        for write, result in zip(writes, results):
+            if write.step == 'stock_day_activity':
+                activity_id = result.upserted_id
+
+        inc_doc, day_inc_doc = self.vote_updates(vote)
+        self.views.record_vote(vote, inc_doc, day_inc_doc, activity_id)
+
+    def user_vote_summary(self, user_id: ObjectIdStr) -> dict:
+        '''
+        Summarize a user's votes from the ``user_day_activity`` counters, without reading the
+        votes themselves. Votes cast before the counters existed are only included once the
+        exchange has been reconciled, see :func:`~frumpdex.reconcile.reconcile_exchange`.
+
+        :param user_id: user id
+        :returns: the number of votes, up votes, down votes, and total rating of the user in each
+            leaderboard window and over their lifetime, along with the first and last days they
+            voted
+        '''
+        today = arrow.now().date()
+        starts = {window: window_start(window, today) for window in WINDOWS}
+        summary = {
+            window: {'votes': 0, 'ups': 0, 'downs': 0, 'rating': 0}
+            for window in WINDOWS + ('lifetime',)
+        }
+        first = last = None
+
+        for doc in self.user_day_activity.find({'user_id': ObjectId(user_id)}).sort('date', 1):
+            day = local_date(doc['date'])
+            first = first or day
+            last = day
+            for window, counters in summary.items():
+                if window == 'lifetime' or day >= starts[window]:
+                    for counter in counters:
+                        counters[counter] += doc.get(counter, 0)
+
+        summary['first_vote'] = first
+        summary['last_vote'] = last
+        return summary
+
+    def vote_acknowledged(self, stock: dict, vote: dict) -> None:
+        '''
+        Update the in-memory leaderboards and invalidate cached responses once a vote has been
+        written to the database.
+        '''
+        ups, downs = (1, 0) if vote['rating'] > 0 else (0, 1)
+        self.leaderboards.record_vote(stock, vote['date'], ups, downs, vote['rating'])
+        self.valuations.record_vote(stock, vote['date'], ups, downs, vote['rating'])
+        self.response_cache.bump(stock['exchange_id'])
+
+    def apply_vote(self, vote: dict, resumable: bool = False) -> bool:
+        '''
+        Write a vote and update the stock statistics. Applying a vote is idempotent: the vote is
+        stored first and, if a vote with the same id already exists, only the statistics that
+        are still pending are updated, see :meth:`vote_writes`.
+
+        :param vote: the vote, as built by :meth:`build_vote`
+        :param resumable: track the statistics updates so that an interrupted attempt can be
+            resumed, used when replaying journaled votes
+        :returns: ``True`` if the vote was applied, ``False`` if it had already been applied
+        '''
+        collection, q, projection = self.stored_vote_query(vote)
+        writes = self.vote_writes(vote, self.db[collection].find_one(q, projection), resumable)
+        if not writes:
+            return False
+
+        results = [self.db[write.collection].update_one(write.query, write.update,
+                                                        upsert=write.upsert)
+                   for write in writes]
+        self.vote_written(vote, writes, results)
+        return True
+
+    def replay_vote(self, vote: dict) -> None:
+        '''
+        Apply a journaled vote and persist its sequence number. A vote that was stored by an
+        earlier, interrupted replay has its pending statistics updates resumed. The in-memory
+        leaderboards and valuations are updated once the vote is in the database.
+
+        :param vote: the journaled vote
+        '''
+        seq = None
+        self.applied_seqs.begin(vote['exchange_id'])
+        try:
+            applied = self.apply_vote(vote, resumable=True)
+            # persisted even if the vote had already been applied, the replay may have been
+            # interrupted before the sequence number was written
+            self.exchanges.update_one({'_id': vote['exchange_id']}, {
+                '$max': {'vote_seq': vote['seq']}
+            })
+
+            stock = self.find_stock(vote['stock_id']) if applied else None
+            if stock:
+                self.vote_acknowledged(stock, vote)
+            else:
+                # responses built before the vote reached the database are stale
+                self.response_cache.bump(vote['exchange_id'])
+            seq = vote['seq']
+        finally:
+            # a failed replay is retried, its sequence number has not been applied yet
+            self.applied_seqs.end(vote['exchange_id'], seq)
 
     def create_exchange(self, name: str) -> dict:
         '''
@@ -347,10 +1226,101 @@ class FrumpdexDatabase:
             '_id': ObjectId()
         }
         self.stocks.insert_one(stock)
+        self.views.add_stocks([stock])
+        self.stock_index.add_stocks([stock])
+        self.valuations.add_stocks([stock])
+        self.response_cache.bump(stock['exchange_id'])
 
         logger.info(f'created stock {name} @ {exchange["name"]} -> {stock["_id"]}')
         return stock
 
+    def create_users(self, exchange_id: ObjectIdStr, names: Iterable[str],
+                     batch_size: int = 500) -> Iterator[List[dict]]:
+        '''
+        Bulk create new users. The exchange is resolved once and users are written in batches
+        with ``insert_many``. The created users are yielded one batch at a time, after the batch
+        has been written, so that callers can stream the generated tokens.
+
+        :param exchange_id: exchange id
+        :param names: user names
+        :param batch_size: number of users to write per ``insert_many`` call
+        :returns: generator of created user batches
+        '''
+        exchange = self.exchanges.find_one(ObjectId(exchange_id))
+        if not exchange:
+            raise ItemDoesNotExist('exchange')
+
+        batch = []
+        count = 0
+        for name in names:
+            batch.append({
+                'exchange_id': exchange['_id'],
+                'name': name,
+                'token': secrets.token_hex(16),
+                '_id': ObjectId()
+            })
+            if len(batch) >= batch_size:
+                self.users.insert_many(batch, ordered=False)
+                count += len(batch)
+                yield batch
+                batch = []
+
+        if batch:
+            self.users.insert_many(batch, ordered=False)
+            count += len(batch)
+            yield batch
+
+        logger.info(f'created {count} users @ {exchange["name"]}')
+
+    def create_stocks(self, exchange_id: ObjectIdStr, stocks: Iterable[dict],
+                      batch_size: int = 500) -> Iterator[List[dict]]:
+        '''
+        Bulk create new stocks. The exchange is resolved once and stocks are written in batches
+        with ``insert_many``. Each item in ``stocks`` is a dict with a ``name`` key and an
+        optional ``symbol`` key (autogenerated if not specified).
+
+        :param exchange_id: exchange id
+        :param stocks: stock names and symbols
+        :param batch_size: number of stocks to write per ``insert_many`` call
+        :returns: generator of created stock batches
+        '''
+        exchange = self.exchanges.find_one(ObjectId(exchange_id))
+        if not exchange:
+            raise ItemDoesNotExist('exchange')
+
+        batch = []
+        count = 0
+        for item in stocks:
+            batch.append({
+                'exchange_id': exchange['_id'],
+                'name': item['name'],
+                'symbol': item.get('symbol') or slugify(item['name']),
+                'ups': 0,
+                'downs': 0,
+                'votes': 0,
+                '_id': ObjectId()
+            })
+            if len(batch) >= batch_size:
+                self.stocks.insert_many(batch, ordered=False)
+                self.views.add_stocks(batch)
+                self.stock_index.add_stocks(batch)
+                self.valuations.add_stocks(batch)
+                self.response_cache.bump(exchange['_id'])
+                count += len(batch)
+                yield batch
+                batch = []
+
+        if batch:
+            self.stocks.insert_many(batch, ordered=False)
+            self.views.add_stocks(batch)
+            self.stock_index.add_stocks(batch)
+            self.valuations.add_stocks(batch)
+            self.response_cache.bump(exchange['_id'])
+            count += len(batch)
+            yield batch
+
+        logger.info(f'created {count} stocks @ {exchange["name"]}')
+
     def create_vote_label(self, name: str) -> dict:
         '''
         Create a new vote label.
@@ -364,8 +1334,56 @@ class FrumpdexDatabase:
             'symbol': slugify(name)
         }
         self.vote_labels.insert_one(label)
+        self.views.add_vote_label(label)
+        self.response_cache.bump()
         return label
 
+    def find_user_by_token(self, token: str) -> Optional[dict]:
+        '''
+        Find a user by their API token. Users are cached for a short time so that authenticating
+        each request does not require a database query.
+
+        :param token: user API token
+        :returns: the user if the token is valid
+        '''
+        user = self.user_cache.get(token)
+        if not user:
+            user = self.users.find_one({'token': token})
+            if user:
+                self.user_cache.put(token, user)
+        return user
+
+    def find_exchange(self, exchange_id: ObjectIdStr) -> Optional[dict]:
+        '''
+        Find an exchange by id. Exchanges are cached for a short time.
+
+        :param exchange_id: exchange id
+        :returns: the exchange if it exists
+        '''
+        exchange_id = ObjectId(exchange_id)
+        exchange = self.exchange_cache.get(exchange_id)
+        if not exchange:
+            exchange = self.exchanges.find_one(exchange_id)
+            if exchange:
+                self.exchange_cache.put(exchange_id, exchange)
+        return exchange
+
+    def find_stock(self, stock_id: ObjectIdStr) -> Optional[dict]:
+        '''
+        Find a stock by id. Stocks are cached for a short time, so the statistics of the returned
+        stock may be slightly out of date.
+
+        :param stock_id: stock id
+        :returns: the stock if it exists
+        '''
+        stock_id = ObjectId(stock_id)
+        stock = self.stock_cache.get(stock_id)
+        if not stock:
+            stock = self.stocks.find_one(stock_id)
+            if stock:
+                self.stock_cache.put(stock_id, stock)
+        return stock
+
     def login(self, token: str) -> Optional[dict]:
         '''
         Attempt to authenticate a user based on their API token.
@@ -374,8 +1392,10 @@ class FrumpdexDatabase:
         '''
         user = self.users.find_one({'token': token})
         if user:
-            logger.info(f'user authenticated: {user["name"]} @ exchange id {user["exchange_id"]}')
+            logger.info('user authenticated: %s @ exchange id %s', user['name'],
+                        user['exchange_id'])
         else:
-            logger.error(f'user token incorrect: {token}')
+            # never log the token itself, it may be a valid token with a typo
+            logger.warning('user token incorrect')
 
         return user
@@ -0,0 +1,84 @@
+#
+# Copyright (c) 2020, Adam Meily
+# All rights reserved.
+#
+'''
+Sequenced Socket.IO events with a bounded replay buffer per room.
+'''
+import threading
+from collections import deque
+from typing import Any, Deque, Dict, List, Optional, Tuple
+
+#: a buffered event, ``(seq, event name, data)``
+BufferedEvent = Tuple[int, str, Any]
+
+
+class RoomEventBuffer:
+    '''
+    Keeps the most recent sequenced events emitted to each room so that a client that reconnects
+    can be sent only the events it missed.
+    '''
+
+    def __init__(self, size: int = 256):
+        self.size = size
+        self.__lock = threading.Lock()
+        self.__rooms: Dict[str, Deque[BufferedEvent]] = {}
+
+    def append(self, room: str, seq: int, event: str, data: Any) -> None:
+        '''
+        Record an event.
+
+        :param room: room name
+        :param seq: event sequence number
+        :param event: event name
+        :param data: event data
+        '''
+        with self.__lock:
+            events = self.__rooms.get(room)
+            if events is None:
+                events = self.__rooms[room] = deque(maxlen=self.size)
+            events.append((seq, event, data))
+
+    def since(self, room: str, seq: int) -> Optional[List[BufferedEvent]]:
+        '''
+        Get the events emitted after a sequence number.
+
+        :param room: room name
+        :param seq: the last sequence number the client received
+        :returns: the missed events in sequence order, or ``None`` if the buffer does not reach
+            back far enough to tell
+        '''
+        with self.__lock:
+            events = list(self.__rooms.get(room) or [])
+
+        if not events:
+            return None
+
+        events.sort(key=lambda item: item[0])
+        if events[0][0] > seq + 1:
+            # the oldest buffered event is newer than the next event the client expects
+            return None
+
+        return [item for item in events if item[0] > seq]
+
+
+class EventBroadcaster:
+    '''
+    Emits sequenced events to Socket.IO rooms, recording each event in a replay buffer.
+    '''
+
+    def __init__(self, socketio, size: int = 256):
+        self.socketio = socketio
+        self.buffer = RoomEventBuffer(size)
+
+    def emit(self, room: str, seq: int, event: str, data: Any) -> None:
+        '''
+        Record and emit an event.
+
+        :param room: room name
+        :param seq: event sequence number
+        :param event: event name
+        :param data: event data
+        '''
+        self.buffer.append(room, seq, event, data)
+        self.socketio.emit(event, data, room=room)
@@ -0,0 +1,184 @@
+#
+# Copyright (c) 2020, Adam Meily
+# All rights reserved.
+#
+'''
+Cross-process cache invalidation.
+
+Every server process tails a MongoDB change stream on the collections backing its in-process
+caches and evicts or patches cached entries as documents change, so writes made by another server
+process or by the admin shell are picked up immediately. The stream's resume token is stored in
+the ``change_stream_tokens`` collection so that a restarted process resumes where it left off.
+
+Change streams require a replica set. On a standalone server the caches fall back to TTL based
+expiry.
+'''
+import logging
+import threading
+import time
+from datetime import datetime, timezone
+
+import pymongo.errors
+
+logger = logging.getLogger(__name__)
+
+#: collections whose changes invalidate cached data
+WATCHED_COLLECTIONS = ('users', 'stocks', 'vote_labels', 'stock_day_activity')
+
+#: error code returned when change streams are not supported (standalone server)
+CHANGE_STREAM_NOT_SUPPORTED = 40573
+
+#: error codes returned when a resume token is no longer in the oplog
+CHANGE_STREAM_HISTORY_LOST = (280, 286)
+
+
+class CacheInvalidator(threading.Thread):
+    '''
+    Background thread that applies change stream events to the caches of a
+    :class:`~frumpdex.db.FrumpdexDatabase`.
+
+    :param db: frumpdex database
+    :param consumer: stable name of this process, used to store the resume token
+    :param save_interval: seconds between saving the resume token
+    :param retry_interval: seconds to wait before reopening a failed change stream
+    '''
+
+    def __init__(self, db, consumer: str, save_interval: float = 5.0,
+                 retry_interval: float = 5.0):
+        super().__init__(name='cache-invalidator', daemon=True)
+        self.db = db
+        self.consumer = consumer
+        self.save_interval = save_interval
+        self.retry_interval = retry_interval
+        self.token = None
+        self.stopped = threading.Event()
+        #: set once the change stream has been opened or found to be unsupported
+        self.ready = threading.Event()
+        self.supported = None
+
+    def stop(self) -> None:
+        '''
+        Stop tailing the change stream.
+        '''
+        self.stopped.set()
+
+    def load_token(self):
+        '''
+        :returns: the stored resume token of this consumer
+        '''
+        doc = self.db.change_stream_tokens.find_one({'_id': self.consumer})
+        return doc['token'] if doc else None
+
+    def save_token(self, token) -> None:
+        '''
+        Store the resume token of this consumer.
+        '''
+        self.db.change_stream_tokens.update_one({'_id': self.consumer}, {
+            '$set': {'token': token, 'date': datetime.now(timezone.utc)}
+        }, upsert=True)
+
+    def run(self) -> None:
+        try:
+            self.token = self.load_token()
+        except pymongo.errors.PyMongoError as err:
+            logger.warning(f'failed to load the change stream resume token: {err}')
+
+        while not self.stopped.is_set():
+            try:
+                self.tail()
+            except pymongo.errors.OperationFailure as err:
+                if err.code == CHANGE_STREAM_NOT_SUPPORTED:
+                    logger.info('change streams are not supported by the MongoDB server, '
+                                'falling back to TTL caching')
+                    self.supported = False
+                    self.db.use_ttl_caching()
+                    self.ready.set()
+                    return
+
+                if err.code in CHANGE_STREAM_HISTORY_LOST:
+                    # events were missed, nothing cached can be trusted
+                    logger.warning('change stream resume token expired, clearing caches')
+                    self.token = None
+                    self.db.clear_caches()
+                    continue
+
+                logger.warning('change stream failed, retrying in %ss: %s',
+                               self.retry_interval, err)
+                self.stopped.wait(self.retry_interval)
+            except pymongo.errors.PyMongoError as err:
+                logger.warning('change stream failed, retrying in %ss: %s',
+                               self.retry_interval, err)
+                self.stopped.wait(self.retry_interval)
+
+    def tail(self) -> None:
+        '''
+        Tail the change stream, starting after the current resume token, until the invalidator
+        is stopped.
+        '''
+        pipeline = [{'$match': {'ns.coll': {'$in': list(WATCHED_COLLECTIONS)}}}]
+        with self.db.db.watch(pipeline, full_document='updateLookup', resume_after=self.token,
+                              max_await_time_ms=1000) as stream:
+            self.supported = True
+            self.ready.set()
+            saved = time.monotonic()
+            while not self.stopped.is_set():
+                change = stream.try_next()
+                if change:
+                    self.apply(change)
+                self.token = stream.resume_token or self.token
+
+                now = time.monotonic()
+                if self.token and now - saved >= self.save_interval:
+                    self.save_token(self.token)
+                    saved = now
+
+        if self.token:
+            self.save_token(self.token)
+
+    def apply(self, change: dict) -> None:
+        '''
+        Apply a single change event to the caches.
+
+        :param change: change stream event
+        '''
+        collection = change['ns']['coll']
+        operation = change['operationType']
+        doc = change.get('fullDocument')
+        doc_id = change.get('documentKey', {}).get('_id')
+
+        if collection == 'users':
+            # the user cache is keyed by token and the previous token of an updated or deleted
+            # user is not part of the event
+            if operation != 'insert':
+                self.db.user_cache.clear()
+        elif collection == 'stocks':
+            self.db.stock_cache.evict(doc_id)
+            if doc:
+                self.db.views.put_stock(doc)
+                self.db.stock_index.add_stocks([doc])
+                self.db.valuations.add_stocks([doc])
+                self.db.response_cache.bump(doc['exchange_id'])
+            else:
+                self.db.views.remove_stock(doc_id)
+                self.db.stock_index.remove_stock(doc_id)
+                self.db.valuations.clear()
+                self.db.response_cache.bump()
+        elif collection == 'vote_labels':
+            self.db.views.clear_vote_labels()
+            self.db.response_cache.bump()
+        elif collection == 'stock_day_activity':
+            if doc:
+                self.db.views.put_activity(doc)
+                self.db.leaderboards.set_activity(doc['exchange_id'], doc['stock_id'],
+                                                  doc['date'], doc.get('ups', 0),
+                                                  doc.get('downs', 0), doc.get('rating', 0))
+                self.db.valuations.set_activity(doc['exchange_id'], doc['stock_id'], doc['date'],
+                                                doc.get('ups', 0), doc.get('downs', 0),
+                                                doc.get('rating', 0),
+                                                (doc.get('gitlab_activity') or {}).get('total', 0))
+                self.db.response_cache.bump(doc['exchange_id'])
+            else:
+                self.db.views.clear()
+                self.db.leaderboards.clear()
+                self.db.valuations.clear()
+                self.db.response_cache.bump()
@@ -0,0 +1,353 @@
+#
+# Copyright (c) 2020, Adam Meily
+# All rights reserved.
+#
+'''
+Local append-only vote journal.
+
+When the journal is enabled, a vote is acknowledged as soon as it has been durably written to the
+journal. A background replayer applies journaled votes to MongoDB with at-least-once semantics,
+relying on each vote's pre-assigned ``_id`` to make the replay idempotent. The replayer's progress
+is stored in a checkpoint file so that it picks up where it left off after a restart.
+
+The journal is a directory of segment files, each holding one MongoDB extended JSON vote per line.
+A new segment is started on every open and whenever the active segment grows past the maximum
+segment size. Segments are deleted once they have been fully replayed.
+
+Only one process may write to a journal directory, which is enforced with a lock file.
+'''
+import json
+import logging
+import os
+import threading
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+from bson import ObjectId, json_util
+from pymongo.errors import PyMongoError
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+SEGMENT_PREFIX = 'votes-'
+SEGMENT_SUFFIX = '.log'
+CHECKPOINT_FILENAME = 'checkpoint.json'
+LOCK_FILENAME = 'lock'
+
+
+class JournalLocked(Exception):
+    '''
+    The vote journal is in use by another process.
+    '''
+
+
+def segment_name(index: int) -> str:
+    '''
+    :returns: the filename of a journal segment
+    '''
+    return f'{SEGMENT_PREFIX}{index:012d}{SEGMENT_SUFFIX}'
+
+
+def segment_index(filename: str) -> int:
+    '''
+    :returns: the index of a journal segment
+    '''
+    return int(filename[len(SEGMENT_PREFIX):-len(SEGMENT_SUFFIX)])
+
+
+class VoteJournal:
+    '''
+    Append-only vote journal with group commit: concurrent appends are made durable by a single
+    ``fsync`` issued by whichever writer reaches the sync first.
+
+    :param path: journal directory
+    :param max_segment_size: size in bytes at which a new segment is started
+    '''
+
+    def __init__(self, path: str, max_segment_size: int = 16 * 1024 * 1024):
+        self.path = path
+        self.max_segment_size = max_segment_size
+        self.__write_lock = threading.Lock()
+        self.__sync_lock = threading.Lock()
+        self.__fp = None
+        self.__segment = -1
+        self.__written = 0
+        self.__synced = 0
+        self.__position = 0
+        #: set whenever a vote is appended, wakes the replayer
+        self.appended = threading.Event()
+
+        os.makedirs(path, exist_ok=True)
+        self.__lock_fp = self._lock_directory()
+        segments = self.segments()
+        self._open_segment(segments[-1] + 1 if segments else 0)
+
+    def _lock_directory(self):
+        fp = open(os.path.join(self.path, LOCK_FILENAME), 'a')
+        if fcntl:
+            try:
+                fcntl.flock(fp.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                fp.close()
+                raise JournalLocked(f'vote journal is in use by another process: {self.path}')
+        return fp
+
+    def segments(self) -> List[int]:
+        '''
+        :returns: the indexes of every segment in the journal directory, in order
+        '''
+        return sorted(segment_index(name) for name in os.listdir(self.path)
+                      if name.startswith(SEGMENT_PREFIX) and name.endswith(SEGMENT_SUFFIX))
+
+    def _open_segment(self, index: int) -> None:
+        if self.__fp:
+            self.__fp.close()
+
+        self.__segment = index
+        self.__fp = open(os.path.join(self.path, segment_name(index)), 'ab')
+        self.__position = 0
+        self._fsync_directory()
+
+    def _fsync_directory(self) -> None:
+        # make the creation of a new segment durable
+        if hasattr(os, 'O_DIRECTORY'):
+            fd = os.open(self.path, os.O_RDONLY | os.O_DIRECTORY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+    @property
+    def active_segment(self) -> int:
+        '''
+        :returns: the index of the segment being written
+        '''
+        return self.__segment
+
+    def append(self, vote: dict, sequence: Callable[[dict], None] = None) -> None:
+        '''
+        Append a vote to the journal. This method returns once the vote is durable.
+
+        :param vote: the vote
+        :param sequence: called with the vote just before it is written, while the journal is
+            locked, to assign the vote's sequence number so that votes are journaled in sequence
+            order
+        '''
+        with self.__write_lock:
+            if sequence:
+                sequence(vote)
+            line = (json_util.dumps(vote, json_options=json_util.RELAXED_JSON_OPTIONS).encode() +
+                    b'\n')
+            if self.__position and self.__position + len(line) > self.max_segment_size:
+                # everything written so far lives in the segment being closed
+                os.fsync(self.__fp.fileno())
+                self.__synced = self.__written
+                self._open_segment(self.__segment + 1)
+
+            self.__fp.write(line)
+            self.__fp.flush()
+            self.__position += len(line)
+            self.__written += 1
+            ticket = self.__written
+
+        with self.__sync_lock:
+            # a single fsync covers every vote written before it, so writers that were waiting on
+            # another writer's fsync are already durable
+            if self.__synced < ticket:
+                with self.__write_lock:
+                    written = self.__written
+                    # the segment may be rotated while the fsync is in progress
+                    fd = os.dup(self.__fp.fileno())
+                try:
+                    os.fsync(fd)
+                finally:
+                    os.close(fd)
+                self.__synced = max(self.__synced, written)
+
+        self.appended.set()
+
+    def read_checkpoint(self) -> Tuple[int, int]:
+        '''
+        :returns: the ``(segment, offset)`` of the first vote that has not been replayed
+        '''
+        try:
+            with open(os.path.join(self.path, CHECKPOINT_FILENAME), 'r') as fp:
+                checkpoint = json.load(fp)
+            return checkpoint['segment'], checkpoint['offset']
+        except (OSError, ValueError, KeyError):
+            segments = self.segments()
+            return (segments[0] if segments else 0), 0
+
+    def write_checkpoint(self, segment: int, offset: int) -> None:
+        '''
+        Atomically record the replay position.
+
+        :param segment: segment index
+        :param offset: byte offset within the segment
+        '''
+        path = os.path.join(self.path, CHECKPOINT_FILENAME)
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as fp:
+            json.dump({'segment': segment, 'offset': offset}, fp)
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.replace(tmp_path, path)
+
+    def read(self, segment: int, offset: int) -> Iterator[Tuple[int, dict]]:
+        '''
+        Read complete votes from a segment. A partially written trailing line, left behind by a
+        crash, was never acknowledged and is ignored.
+
+        :param segment: segment index
+        :param offset: byte offset to start reading at
+        :returns: generator of ``(offset after the vote, vote)``
+        '''
+        filename = os.path.join(self.path, segment_name(segment))
+        with open(filename, 'rb') as fp:
+            fp.seek(offset)
+            for line in fp:
+                if not line.endswith(b'\n'):
+                    break
+                offset += len(line)
+                yield offset, json_util.loads(line)
+
+    def remove_segment(self, segment: int) -> None:
+        '''
+        Delete a fully replayed segment.
+        '''
+        try:
+            os.remove(os.path.join(self.path, segment_name(segment)))
+        except FileNotFoundError:
+            pass
+
+    def pending_sequences(self) -> Dict[ObjectId, int]:
+        '''
+        :returns: the highest vote sequence number per exchange among the votes that have not
+            been replayed
+        '''
+        sequences = {}
+        segment, offset = self.read_checkpoint()
+        for index in self.segments():
+            if index < segment:
+                continue
+            for _, vote in self.read(index, offset if index == segment else 0):
+                exchange_id = vote['exchange_id']
+                sequences[exchange_id] = max(sequences.get(exchange_id, 0), vote.get('seq', 0))
+        return sequences
+
+    def close(self) -> None:
+        '''
+        Close the active segment and release the journal directory.
+        '''
+        with self.__write_lock:
+            if self.__fp:
+                self.__fp.close()
+                self.__fp = None
+            if self.__lock_fp:
+                self.__lock_fp.close()
+                self.__lock_fp = None
+
+
+class VoteReplayer(threading.Thread):
+    '''
+    Background thread that applies journaled votes to MongoDB.
+
+    :param journal: the vote journal
+    :param apply: function that applies a single vote to the database
+    :param retry_interval: seconds to wait before retrying after a database error
+    :param heartbeat: called before every replay pass, used to renew the journal lease
+    :param checkpoint_interval: number of replayed votes between checkpoint writes
+    '''
+
+    def __init__(self, journal: VoteJournal, apply: Callable[[dict], None],
+                 retry_interval: float = 5.0, heartbeat: Optional[Callable[[], None]] = None,
+                 checkpoint_interval: int = 100):
+        super().__init__(name='vote-replayer', daemon=True)
+        self.journal = journal
+        self.apply = apply
+        self.heartbeat = heartbeat
+        self.retry_interval = retry_interval
+        self.checkpoint_interval = checkpoint_interval
+        self.stopped = threading.Event()
+        self.replayed = 0
+
+    def stop(self) -> None:
+        '''
+        Stop the replayer.
+        '''
+        self.stopped.set()
+        self.journal.appended.set()
+
+    def run(self) -> None:
+        while not self.stopped.is_set():
+            self.journal.appended.clear()
+            try:
+                if self.heartbeat:
+                    self.heartbeat()
+                self.replay()
+            except PyMongoError as err:
+                logger.warning('vote replay failed, retrying in %ss: %s', self.retry_interval, err)
+                self.stopped.wait(self.retry_interval)
+                continue
+
+            self.journal.appended.wait(1.0)
+
+    def replay(self) -> int:
+        '''
+        Apply every vote that has not been replayed yet.
+
+        :returns: the number of applied votes
+        '''
+        count = 0
+        segment, offset = self.journal.read_checkpoint()
+        for index in self.journal.segments():
+            if index < segment:
+                self.journal.remove_segment(index)
+                continue
+
+            # a segment is only complete if it was rotated out before it is read, votes that are
+            # appended to the active segment while it is being read are picked up by the next pass
+            active = self.journal.active_segment
+            position = offset if index == segment else 0
+            while True:
+                applied, position = self._replay_segment(index, position)
+                count += applied
+                if not applied or index >= active:
+                    break
+
+            if index < active:
+                self.journal.write_checkpoint(index + 1, 0)
+                self.journal.remove_segment(index)
+                segment, offset = index + 1, 0
+            else:
+                segment, offset = index, position
+
+        if count:
+            self.replayed += count
+            logger.debug('replayed %d journaled votes', count)
+        return count
+
+    def _replay_segment(self, index: int, start: int) -> Tuple[int, int]:
+        '''
+        Apply the votes of a segment from ``start`` to its current end. The checkpoint is written
+        every ``checkpoint_interval`` votes rather than after every vote, replaying the votes
+        after the checkpoint again following a crash is harmless because replay is idempotent.
+
+        :returns: a tuple of ``(number of applied votes, offset after the last applied vote)``
+        '''
+        applied = 0
+        position = start
+        try:
+            for position, vote in self.journal.read(index, start):
+                self.apply(vote)
+                applied += 1
+                if applied % self.checkpoint_interval == 0:
+                    self.journal.write_checkpoint(index, position)
+        finally:
+            if applied % self.checkpoint_interval:
+                self.journal.write_checkpoint(index, position)
+        return applied, position
+
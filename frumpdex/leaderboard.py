@@ -0,0 +1,357 @@
+#
+# Copyright (c) 2020, Adam Meily
+# All rights reserved.
+#
+'''
+In-memory per-exchange leaderboards.
+
+Each exchange keeps per-day vote tallies for every stock, back to the start of the longest
+window, along with running totals per window. The totals are updated incrementally as votes are
+cast so the top movers can be served without querying MongoDB.
+'''
+import heapq
+import logging
+import threading
+import time
+from datetime import date, datetime, timedelta
+from typing import Callable, Dict, List, Optional, Tuple
+
+import arrow
+from bson import ObjectId
+
+logger = logging.getLogger(__name__)
+
+#: supported leaderboard windows
+WINDOWS = ('today', 'week', 'month')
+
+
+def window_start(window: str, today: date) -> date:
+    '''
+    :param window: leaderboard window
+    :param today: the current day
+    :returns: the first day that is part of the window
+    '''
+    if window == 'today':
+        return today
+    if window == 'week':
+        return today - timedelta(days=today.weekday())
+    if window == 'month':
+        return today.replace(day=1)
+    raise ValueError(f'invalid leaderboard window: {window}')
+
+
+def local_date(value: datetime) -> date:
+    '''
+    :param value: a datetime from MongoDB (naive UTC) or the vote path (timezone aware)
+    :returns: the local calendar day of ``value``
+    '''
+    return arrow.get(value).to('local').date()
+
+
+class StockTally:
+    '''
+    Vote counters for a single stock.
+    '''
+    __slots__ = ('ups', 'downs', 'rating')
+
+    def __init__(self, ups: int = 0, downs: int = 0, rating: int = 0):
+        self.ups = ups
+        self.downs = downs
+        self.rating = rating
+
+    @property
+    def net(self) -> int:
+        '''
+        :returns: ups minus downs
+        '''
+        return self.ups - self.downs
+
+    def add(self, ups: int, downs: int, rating: int) -> None:
+        '''
+        Add votes to the tally.
+        '''
+        self.ups += ups
+        self.downs += downs
+        self.rating += rating
+
+
+class ExchangeLeaderboard:
+    '''
+    Leaderboards for a single exchange.
+    '''
+
+    def __init__(self, exchange_id: ObjectId, today: date):
+        self.exchange_id = exchange_id
+        self.today = today
+        self.loaded = time.monotonic()
+        self.names: Dict[ObjectId, str] = {}
+        self.days: Dict[date, Dict[ObjectId, StockTally]] = {}
+        self.totals: Dict[str, Dict[ObjectId, StockTally]] = {window: {} for window in WINDOWS}
+
+    @property
+    def first_day(self) -> date:
+        '''
+        :returns: the oldest day that is part of any window
+        '''
+        return min(window_start(window, self.today) for window in WINDOWS)
+
+    def roll(self, today: date) -> None:
+        '''
+        Advance the leaderboard to a new day, dropping days that have left every window and
+        recomputing the window totals.
+
+        :param today: the current day
+        '''
+        self.today = today
+        first_day = self.first_day
+        self.days = {day: tallies for day, tallies in self.days.items() if day >= first_day}
+        self.totals = {window: {} for window in WINDOWS}
+        for day, tallies in self.days.items():
+            for stock_id, tally in tallies.items():
+                self._add_totals(stock_id, day, tally.ups, tally.downs, tally.rating)
+
+    def add(self, stock_id: ObjectId, day: date, ups: int, downs: int, rating: int) -> None:
+        '''
+        Record votes for a stock on a specific day.
+
+        :param stock_id: stock id
+        :param day: the day the votes were cast
+        :param ups: number of up votes
+        :param downs: number of down votes
+        :param rating: total rating of the votes
+        '''
+        if day < self.first_day:
+            return
+
+        self.days.setdefault(day, {}).setdefault(stock_id, StockTally()).add(ups, downs, rating)
+        self._add_totals(stock_id, day, ups, downs, rating)
+
+    def record_vote(self, stock: dict, day: date, ups: int, downs: int, rating: int) -> None:
+        '''
+        Record a vote, advancing the leaderboard if the vote was cast on a new day.
+
+        :param stock: the stock that was voted on
+        :param day: the day of the vote
+        :param ups: number of up votes
+        :param downs: number of down votes
+        :param rating: vote rating
+        '''
+        if day > self.today:
+            self.roll(day)
+        self.names[stock['_id']] = stock['name']
+        self.add(stock['_id'], day, ups, downs, rating)
+
+    def set_activity(self, stock_id: ObjectId, day: date, ups: int, downs: int,
+                     rating: int) -> None:
+        '''
+        Set the vote tally of a stock on a specific day.
+
+        :param stock_id: stock id
+        :param day: the day of the activity
+        :param ups: number of up votes
+        :param downs: number of down votes
+        :param rating: total rating
+        '''
+        if day > self.today:
+            self.roll(day)
+
+        tally = self.days.get(day, {}).get(stock_id) or StockTally()
+        self.add(stock_id, day, ups - tally.ups, downs - tally.downs, rating - tally.rating)
+
+    def _add_totals(self, stock_id: ObjectId, day: date, ups: int, downs: int,
+                    rating: int) -> None:
+        for window, totals in self.totals.items():
+            if window_start(window, self.today) <= day <= self.today:
+                totals.setdefault(stock_id, StockTally()).add(ups, downs, rating)
+
+    def top(self, window: str, limit: int) -> dict:
+        '''
+        :param window: leaderboard window
+        :param limit: maximum number of stocks per leaderboard
+        :returns: the top stocks in the window ranked by net votes and by rating
+        '''
+        totals = self.totals[window]
+
+        def serialize(item) -> dict:
+            stock_id, tally = item
+            return {
+                'stock_id': stock_id,
+                'name': self.names.get(stock_id),
+                'ups': tally.ups,
+                'downs': tally.downs,
+                'net': tally.net,
+                'rating': tally.rating
+            }
+
+        return {
+            'window': window,
+            'net': [serialize(item) for item in
+                    heapq.nlargest(limit, totals.items(), key=lambda item: item[1].net)],
+            'rating': [serialize(item) for item in
+                       heapq.nlargest(limit, totals.items(), key=lambda item: item[1].rating)]
+        }
+
+
+class LeaderboardCache:
+    '''
+    Leaderboards for every exchange, rebuilt from ``stock_day_activity`` and kept up to date by
+    the vote path.
+
+    Votes recorded while leaderboards are loading are buffered and applied to the loaded
+    leaderboards before they replace the previous ones, so they are not lost. A vote that had
+    already been read from ``stock_day_activity`` when it was recorded is counted twice until the
+    leaderboard is reloaded.
+    '''
+
+    def __init__(self):
+        #: seconds before a leaderboard is reloaded, ``None`` to keep leaderboards until cleared
+        self.max_age: Optional[float] = None
+        self.__lock = threading.Lock()
+        self.__boards: Dict[ObjectId, ExchangeLeaderboard] = {}
+        #: (exchange id, or ``None`` for every exchange, buffered updates) of each running load
+        self.__loads: List[Tuple[Optional[ObjectId], list]] = []
+
+    def load(self, db, exchange_id: ObjectId = None) -> Dict[ObjectId, ExchangeLeaderboard]:
+        '''
+        Rebuild leaderboards from the ``stock_day_activity`` collection.
+
+        :param db: frumpdex database
+        :param exchange_id: the exchange to rebuild, or every exchange if not specified
+        :returns: the loaded leaderboards, including those that were cleared while loading and
+            are not cached
+        '''
+        load = (exchange_id, [])
+        with self.__lock:
+            self.__loads.append(load)
+
+        try:
+            boards = self._read(db, exchange_id)
+        except Exception:
+            with self.__lock:
+                self.__loads.remove(load)
+            raise
+
+        with self.__lock:
+            self.__loads.remove(load)
+            cleared = set()
+            for update_exchange_id, method, args in load[1]:
+                if method is None:
+                    cleared.update([update_exchange_id] if update_exchange_id else boards)
+                elif update_exchange_id in boards:
+                    method(boards[update_exchange_id], *args)
+
+            self.__boards.update({key: board for key, board in boards.items()
+                                  if key not in cleared})
+
+        logger.info(f'loaded leaderboards for {len(boards)} exchanges')
+        return boards
+
+    def _read(self, db, exchange_id: Optional[ObjectId]) -> Dict[ObjectId, ExchangeLeaderboard]:
+        today = arrow.now().date()
+        boards = {}
+        stocks_q = {'exchange_id': exchange_id} if exchange_id else {}
+        for stock in db.stocks.find(stocks_q, {'name': 1, 'exchange_id': 1}):
+            board = boards.get(stock['exchange_id'])
+            if not board:
+                board = boards[stock['exchange_id']] = ExchangeLeaderboard(stock['exchange_id'],
+                                                                           today)
+            board.names[stock['_id']] = stock['name']
+
+        if exchange_id and exchange_id not in boards:
+            boards[exchange_id] = ExchangeLeaderboard(exchange_id, today)
+
+        first_day = min(board.first_day for board in boards.values()) if boards else today
+        activity_q = dict(stocks_q)
+        activity_q['date'] = {'$gte': arrow.get(first_day, tzinfo='local').datetime}
+        projection = {'exchange_id': 1, 'stock_id': 1, 'date': 1, 'ups': 1, 'downs': 1,
+                      'rating': 1}
+        for activity in db.stock_day_activity.find(activity_q, projection):
+            board = boards.get(activity['exchange_id'])
+            if board:
+                board.add(activity['stock_id'], local_date(activity['date']),
+                          activity.get('ups', 0), activity.get('downs', 0),
+                          activity.get('rating', 0))
+        return boards
+
+    def _update(self, exchange_id: ObjectId, method: Optional[Callable], *args) -> None:
+        # must be called with the lock held, a method of None clears the exchange
+        for load_exchange_id, updates in self.__loads:
+            if load_exchange_id in (None, exchange_id):
+                updates.append((exchange_id, method, args))
+
+        board = self.__boards.get(exchange_id)
+        if board and method:
+            method(board, *args)
+
+    def record_vote(self, stock: dict, day: datetime, ups: int, downs: int, rating: int) -> None:
+        '''
+        Record a vote. Votes for exchanges that have not been loaded, and are not loading, are
+        ignored since they will be read from ``stock_day_activity`` when the exchange is loaded.
+
+        :param stock: the stock that was voted on
+        :param day: the day of the vote
+        :param ups: number of up votes
+        :param downs: number of down votes
+        :param rating: vote rating
+        '''
+        with self.__lock:
+            self._update(stock['exchange_id'], ExchangeLeaderboard.record_vote, stock,
+                         local_date(day), ups, downs, rating)
+
+    def set_activity(self, exchange_id: ObjectId, stock_id: ObjectId, day: datetime, ups: int,
+                     downs: int, rating: int) -> None:
+        '''
+        Set the vote tally of a stock on a specific day to the values stored in the database.
+        Unlike :meth:`record_vote`, this is idempotent and is used to apply changes made by other
+        processes.
+
+        :param exchange_id: exchange id
+        :param stock_id: stock id
+        :param day: the day of the activity
+        :param ups: number of up votes
+        :param downs: number of down votes
+        :param rating: total rating
+        '''
+        with self.__lock:
+            self._update(exchange_id, ExchangeLeaderboard.set_activity, stock_id,
+                         local_date(day), ups, downs, rating)
+
+    def top(self, db, exchange_id: ObjectId, window: str, limit: int) -> Optional[dict]:
+        '''
+        Get the leaderboards for an exchange, loading the exchange if it has not been loaded.
+
+        :param db: frumpdex database
+        :param exchange_id: exchange id
+        :param window: leaderboard window
+        :param limit: maximum number of stocks per leaderboard
+        :returns: the leaderboards
+        '''
+        with self.__lock:
+            board = self.__boards.get(exchange_id)
+
+        loaded = None
+        if not board or (self.max_age and time.monotonic() - board.loaded > self.max_age):
+            loaded = self.load(db, exchange_id)[exchange_id]
+
+        today = arrow.now().date()
+        with self.__lock:
+            board = self.__boards.get(exchange_id) or loaded
+            if today > board.today:
+                board.roll(today)
+            return board.top(window, limit)
+
+    def clear(self, exchange_id: ObjectId = None) -> None:
+        '''
+        Drop cached leaderboards so they are reloaded on next access.
+
+        :param exchange_id: the exchange to drop, or every exchange if not specified
+        '''
+        with self.__lock:
+            for load_exchange_id, updates in self.__loads:
+                if not exchange_id or load_exchange_id in (None, exchange_id):
+                    updates.append((exchange_id, None, ()))
+
+            if exchange_id:
+                self.__boards.pop(exchange_id, None)
+            else:
+                self.__boards.clear()
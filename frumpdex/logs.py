@@ -0,0 +1,119 @@
+#
+# Copyright (c) 2020, Adam Meily
+# All rights reserved.
+#
+'''
+Asynchronous, sampled logging.
+
+Log records are put on a bounded queue by the thread that logs them and are formatted and written
+by a single background listener thread, so request threads never block on stdout or disk. When
+the queue is full, records are dropped and counted rather than blocking the caller.
+
+Each message type, identified by the logger and the unformatted message template, may be logged
+a limited number of times per sampling interval. Additional records are suppressed and the
+number of suppressed records is appended to the next record of that type that is logged. This
+keeps a flood of identical messages, such as failed logins during a brute force attempt, from
+saturating the pipeline.
+'''
+import logging
+import logging.handlers
+import queue
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+from .metrics import metrics
+
+
+class SamplingFilter(logging.Filter):
+    '''
+    Rate limits log records per message type.
+
+    :param burst: number of records of each message type allowed per interval
+    :param interval: sampling interval in seconds
+    :param max_level: records above this level are never sampled
+    '''
+
+    def __init__(self, burst: int = 20, interval: float = 60.0,
+                 max_level: int = logging.WARNING):
+        super().__init__()
+        self.burst = burst
+        self.interval = interval
+        self.max_level = max_level
+        self.__lock = threading.Lock()
+        #: (logger name, message template) -> [window start, count, suppressed]
+        self.__windows: Dict[Tuple[str, str], list] = {}
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno > self.max_level:
+            return True
+
+        key = (record.name, str(record.msg))
+        now = time.monotonic()
+        with self.__lock:
+            window = self.__windows.get(key)
+            if not window or now - window[0] >= self.interval:
+                suppressed = window[2] if window else 0
+                if len(self.__windows) > 10000:
+                    # templates should be a small fixed set, don't grow without bound if not
+                    self.__windows.clear()
+                self.__windows[key] = [now, 1, 0]
+            elif window[1] < self.burst:
+                window[1] += 1
+                suppressed = 0
+            else:
+                window[2] += 1
+                metrics.increment('logging.suppressed')
+                return False
+
+        if suppressed:
+            record.msg = f'{record.msg} [{suppressed} similar messages suppressed]'
+        return True
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    '''
+    Queue handler that drops records when the queue is full instead of blocking or raising, and
+    leaves formatting to the listener thread.
+    '''
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # the record is handled in-process, so the message does not need to be formatted, and
+        # its arguments made picklable, by the logging thread
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            metrics.increment('logging.dropped')
+
+
+class AsyncLogging:
+    '''
+    Routes the records of a logger through a bounded queue to its handlers, which are run by a
+    background listener thread.
+
+    :param logger: the logger
+    :param handlers: the handlers that write the records
+    :param queue_size: maximum number of records waiting to be written
+    :param sampling: sampling filter applied before records are queued
+    '''
+
+    def __init__(self, logger: logging.Logger, handlers: List[logging.Handler],
+                 queue_size: int = 10000, sampling: Optional[SamplingFilter] = None):
+        self.queue: queue.Queue = queue.Queue(maxsize=queue_size)
+        self.handler = DroppingQueueHandler(self.queue)
+        if sampling:
+            self.handler.addFilter(sampling)
+
+        self.listener = logging.handlers.QueueListener(self.queue, *handlers,
+                                                       respect_handler_level=True)
+        logger.addHandler(self.handler)
+        self.listener.start()
+
+    def stop(self) -> None:
+        '''
+        Flush the queued records and stop the listener thread.
+        '''
+        self.listener.stop()
@@ -0,0 +1,443 @@
+#
+# Copyright (c) 2020, Adam Meily
+# All rights reserved.
+#
+'''
+In-memory materialized view of exchange state.
+
+Each exchange view holds the exchange's stocks and today's ``stock_day_activity`` counters as
+compact ``__slots__`` records. Views are loaded on first access, kept current by the write paths
+in :class:`~frumpdex.db.FrumpdexDatabase`, and periodically reloaded from MongoDB to reconcile
+any drift, such as writes made by another process. The vote labels, which are shared by every
+exchange, are held alongside the exchange views.
+'''
+import logging
+import threading
+import time
+from datetime import date, datetime
+from typing import Dict, Iterable, List, Optional
+
+import arrow
+from bson import ObjectId
+
+from .leaderboard import local_date
+from .metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+#: marks a document field that is not set
+MISSING = object()
+
+
+class Record:
+    '''
+    Base class of a materialized document. Fields that are not set on the document are
+    :data:`MISSING` and are omitted when the record is serialized.
+    '''
+    __slots__ = ()
+
+    #: fields that are compared when reconciling against the database
+    COUNTERS = ()
+
+    def __init__(self, doc: dict):
+        for field in self.__slots__:
+            setattr(self, field, doc.get(field, MISSING))
+
+    def to_dict(self, projection: dict = None) -> dict:
+        '''
+        Serialize the record, applying a MongoDB style inclusion projection.
+
+        :param projection: projection from :func:`~frumpdex.api.lib.parse_fields_projection`
+        :returns: the document
+        '''
+        if projection:
+            fields = [field for field in self.__slots__
+                      if projection.get(field) or (field == '_id' and projection.get('_id', 1))]
+        else:
+            fields = self.__slots__
+
+        doc = {}
+        for field in fields:
+            value = getattr(self, field)
+            if value is not MISSING:
+                doc[field] = dict(value) if isinstance(value, dict) else value
+        return doc
+
+    def inc(self, field: str, value: int) -> None:
+        '''
+        Increment a counter, as ``$inc`` would.
+        '''
+        current = getattr(self, field)
+        setattr(self, field, value if current is MISSING else current + value)
+
+    def counters(self) -> tuple:
+        '''
+        :returns: the counter values that are compared during reconciliation
+        '''
+        return tuple(getattr(self, field) for field in self.COUNTERS)
+
+
+class StockRecord(Record):
+    '''
+    Materialized ``stocks`` document.
+    '''
+    __slots__ = ('_id', 'exchange_id', 'name', 'symbol', 'ups', 'downs', 'votes', 'rating',
+                 'ratings', 'gitlab')
+    COUNTERS = ('ups', 'downs', 'rating')
+
+
+class ActivityRecord(Record):
+    '''
+    Materialized ``stock_day_activity`` document.
+    '''
+    __slots__ = ('_id', 'stock_id', 'exchange_id', 'date', 'ups', 'downs', 'rating', 'ratings',
+                 'labels', 'gitlab_activity')
+    COUNTERS = ('ups', 'downs', 'rating', 'labels')
+
+
+class VoteLabelRecord(Record):
+    '''
+    Materialized ``vote_labels`` document.
+    '''
+    __slots__ = ('_id', 'name', 'symbol')
+
+
+class ExchangeView:
+    '''
+    Materialized state of a single exchange.
+
+    :param exchange_id: exchange id
+    :param day: the local day that the activity records belong to
+    :param expires: monotonic time at which the view is reconciled against the database
+    '''
+
+    def __init__(self, exchange_id: ObjectId, day: date, expires: float):
+        self.exchange_id = exchange_id
+        self.day = day
+        self.expires = expires
+        self.stocks: Dict[ObjectId, StockRecord] = {}
+        self.activity: Dict[ObjectId, ActivityRecord] = {}
+
+    @classmethod
+    def load(cls, db, exchange_id: ObjectId, expires: float) -> 'ExchangeView':
+        '''
+        Load an exchange view from the database.
+
+        :param db: frumpdex database
+        :param exchange_id: exchange id
+        :param expires: monotonic time at which the view is reconciled
+        :returns: the exchange view
+        '''
+        today = arrow.now().floor('day')
+        view = cls(exchange_id, today.date(), expires)
+        for doc in db.stocks.find({'exchange_id': exchange_id}):
+            view.stocks[doc['_id']] = StockRecord(doc)
+
+        q = {'exchange_id': exchange_id, 'date': {'$gte': today.datetime}}
+        for doc in db.stock_day_activity.find(q):
+            view.activity[doc['stock_id']] = ActivityRecord(doc)
+        return view
+
+    def drift(self, other: 'ExchangeView') -> int:
+        '''
+        :param other: a freshly loaded view of the same exchange
+        :returns: the number of records that differ between the two views
+        '''
+        count = 0
+        for records, other_records in ((self.stocks, other.stocks),
+                                       (self.activity, other.activity)):
+            for key in records.keys() | other_records.keys():
+                record, other_record = records.get(key), other_records.get(key)
+                if not record or not other_record or record.counters() != other_record.counters():
+                    count += 1
+        return count
+
+    def record_vote(self, vote: dict, inc_doc: dict, day_inc_doc: dict,
+                    activity_id: ObjectId = None) -> bool:
+        '''
+        Apply a vote that was written to the database.
+
+        :param vote: the vote
+        :param inc_doc: the ``$inc`` document applied to the stock
+        :param day_inc_doc: the ``$inc`` document applied to the day activity
+        :param activity_id: the id of the day activity document, if the vote created it
+        :returns: ``False`` if the view is missing records and must be reloaded
+        '''
+        stock = self.stocks.get(vote['stock_id'])
+        if not stock:
+            # the stock was created elsewhere
+            return False
+
+        for field, value in inc_doc.items():
+            stock.inc(field, value)
+
+        if local_date(vote['date']) != self.day:
+            return True
+
+        activity = self.activity.get(vote['stock_id'])
+        if not activity:
+            if not activity_id:
+                # the day activity was created elsewhere
+                return False
+
+            activity = self.activity[vote['stock_id']] = ActivityRecord({
+                '_id': activity_id,
+                'stock_id': vote['stock_id'],
+                'exchange_id': vote['exchange_id'],
+                'date': _utc_naive(vote['date'])
+            })
+
+        for field, value in day_inc_doc.items():
+            if field.startswith('labels.'):
+                if activity.labels is MISSING:
+                    activity.labels = {}
+                symbol = field[len('labels.'):]
+                activity.labels[symbol] = activity.labels.get(symbol, 0) + value
+            else:
+                activity.inc(field, value)
+        return True
+
+    def put_stock(self, doc: dict) -> bool:
+        '''
+        Add or replace the record of a stock.
+        '''
+        self.stocks[doc['_id']] = StockRecord(doc)
+        return True
+
+    def remove_stock(self, stock_id: ObjectId) -> bool:
+        '''
+        Remove the records of a stock.
+        '''
+        self.stocks.pop(stock_id, None)
+        self.activity.pop(stock_id, None)
+        return True
+
+    def put_activity(self, doc: dict) -> bool:
+        '''
+        Replace the record of a day activity, if it belongs to the view's day.
+        '''
+        if local_date(doc['date']) == self.day:
+            self.activity[doc['stock_id']] = ActivityRecord(doc)
+        return True
+
+    def invalidate(self) -> bool:
+        '''
+        :returns: ``False``, the view must be reloaded
+        '''
+        return False
+
+
+class MaterializedViews:
+    '''
+    Materialized views of every exchange that has been accessed.
+
+    A view is loaded without holding the lock, so that writes are not blocked by a slow load.
+    Updates made while a view is loading are recorded and replayed on the loaded view before it
+    replaces the previous one. A vote whose counters were written just before the load read them
+    but which is recorded after the load started is counted twice until the next refresh.
+
+    :param refresh_interval: seconds between reconciling a view against the database
+    '''
+
+    def __init__(self, refresh_interval: float = 300):
+        self.refresh_interval = refresh_interval
+        self.__lock = threading.Lock()
+        self.__views: Dict[ObjectId, ExchangeView] = {}
+        self.__labels: Optional[List[VoteLabelRecord]] = None
+        #: held while an exchange's view is loading
+        self.__load_locks: Dict[ObjectId, threading.Lock] = {}
+        #: updates made to each exchange while its view is loading
+        self.__pending: Dict[ObjectId, List[tuple]] = {}
+
+    def _current(self, exchange_id: ObjectId) -> Optional[ExchangeView]:
+        # must be called with the lock held
+        view = self.__views.get(exchange_id)
+        if view and view.expires > time.monotonic() and view.day == arrow.now().date():
+            return view
+        return None
+
+    def _get(self, db, exchange_id: ObjectId) -> ExchangeView:
+        # must be called without the lock held
+        with self.__lock:
+            view = self._current(exchange_id)
+            if view:
+                metrics.increment('view.hits')
+                return view
+            load_lock = self.__load_locks.setdefault(exchange_id, threading.Lock())
+
+        with load_lock:
+            with self.__lock:
+                # another thread may have loaded the view while this one waited
+                view = self._current(exchange_id)
+                if view:
+                    metrics.increment('view.hits')
+                    return view
+                self.__pending[exchange_id] = []
+
+            try:
+                fresh = ExchangeView.load(db, exchange_id,
+                                          time.monotonic() + self.refresh_interval)
+            except Exception:
+                with self.__lock:
+                    self.__pending.pop(exchange_id)
+                raise
+
+            with self.__lock:
+                # replay every update made during the load, even after one invalidates the view
+                pending = self.__pending.pop(exchange_id)
+                valid = all([method(fresh, *args) for method, args in pending])
+                view = self.__views.get(exchange_id)
+                if view and view.day == fresh.day:
+                    drift = view.drift(fresh)
+                    if drift:
+                        metrics.increment('view.drift', drift)
+                        logger.warning(f'materialized view of exchange {exchange_id} drifted '
+                                       f'from the database: {drift} records reconciled')
+
+                metrics.increment('view.loads')
+                if valid:
+                    self.__views[exchange_id] = fresh
+                else:
+                    self.__views.pop(exchange_id, None)
+                return fresh
+
+    def _update(self, exchange_id: ObjectId, method, *args) -> None:
+        # must be called with the lock held
+        pending = self.__pending.get(exchange_id)
+        if pending is not None:
+            pending.append((method, args))
+
+        view = self.__views.get(exchange_id)
+        if view and not method(view, *args):
+            # reload the view on next access
+            self.__views.pop(exchange_id)
+
+    def stocks(self, db, exchange_id: ObjectId, projection: dict = None) -> List[dict]:
+        '''
+        :param db: frumpdex database
+        :param exchange_id: exchange id
+        :param projection: field projection
+        :returns: every stock in the exchange
+        '''
+        view = self._get(db, exchange_id)
+        with self.__lock:
+            return [stock.to_dict(projection) for stock in view.stocks.values()]
+
+    def stock(self, db, exchange_id: ObjectId, stock_id: ObjectId,
+              projection: dict = None) -> Optional[dict]:
+        '''
+        :param db: frumpdex database
+        :param exchange_id: exchange id
+        :param stock_id: stock id
+        :param projection: field projection
+        :returns: the stock, or ``None`` if it does not exist in the exchange
+        '''
+        view = self._get(db, exchange_id)
+        with self.__lock:
+            stock = view.stocks.get(stock_id)
+            return stock.to_dict(projection) if stock else None
+
+    def today_activity(self, db, exchange_id: ObjectId, projection: dict = None) -> List[dict]:
+        '''
+        :param db: frumpdex database
+        :param exchange_id: exchange id
+        :param projection: field projection
+        :returns: today's activity of every stock in the exchange that has activity
+        '''
+        view = self._get(db, exchange_id)
+        with self.__lock:
+            return [activity.to_dict(projection) for activity in view.activity.values()]
+
+    def vote_labels(self, db, projection: dict = None) -> List[dict]:
+        '''
+        :param db: frumpdex database
+        :param projection: field projection
+        :returns: every vote label
+        '''
+        with self.__lock:
+            if self.__labels is None:
+                self.__labels = [VoteLabelRecord(doc) for doc in db.vote_labels.find()]
+            return [label.to_dict(projection) for label in self.__labels]
+
+    def record_vote(self, vote: dict, inc_doc: dict, day_inc_doc: dict,
+                    activity_id: ObjectId = None) -> None:
+        '''
+        Apply a vote that was written to the database.
+
+        :param vote: the vote
+        :param inc_doc: the ``$inc`` document applied to the stock
+        :param day_inc_doc: the ``$inc`` document applied to the day activity
+        :param activity_id: the id of the day activity document, if the vote created it
+        '''
+        with self.__lock:
+            self._update(vote['exchange_id'], ExchangeView.record_vote, vote, inc_doc,
+                         day_inc_doc, activity_id)
+
+    def add_stocks(self, stocks: Iterable[dict]) -> None:
+        '''
+        Add newly created stocks to their exchange views.
+        '''
+        with self.__lock:
+            for doc in stocks:
+                self._update(doc['exchange_id'], ExchangeView.put_stock, doc)
+
+    def put_stock(self, doc: dict) -> None:
+        '''
+        Replace the record of a stock that changed in the database.
+        '''
+        with self.__lock:
+            self._update(doc['exchange_id'], ExchangeView.put_stock, doc)
+
+    def remove_stock(self, stock_id: ObjectId) -> None:
+        '''
+        Remove a stock that was deleted from the database.
+        '''
+        with self.__lock:
+            for exchange_id in self.__views.keys() | self.__pending.keys():
+                self._update(exchange_id, ExchangeView.remove_stock, stock_id)
+
+    def put_activity(self, doc: dict) -> None:
+        '''
+        Replace the record of a day activity that changed in the database.
+        '''
+        with self.__lock:
+            self._update(doc['exchange_id'], ExchangeView.put_activity, doc)
+
+    def add_vote_label(self, label: dict) -> None:
+        '''
+        Add a newly created vote label.
+        '''
+        with self.__lock:
+            if self.__labels is not None:
+                self.__labels.append(VoteLabelRecord(label))
+
+    def clear_vote_labels(self) -> None:
+        '''
+        Drop the vote labels so they are reloaded on next access.
+        '''
+        with self.__lock:
+            self.__labels = None
+
+    def clear(self, exchange_id: ObjectId = None) -> None:
+        '''
+        Drop materialized views so they are reloaded on next access. Views that are loading are
+        not kept once loaded.
+
+        :param exchange_id: the exchange to drop, or every exchange and the vote labels if not
+            specified
+        '''
+        with self.__lock:
+            for loading in ([exchange_id] if exchange_id else list(self.__pending)):
+                if loading in self.__pending:
+                    self.__pending[loading].append((ExchangeView.invalidate, ()))
+
+            if exchange_id:
+                self.__views.pop(exchange_id, None)
+            else:
+                self.__views.clear()
+                self.__labels = None
+
+
+def _utc_naive(value: datetime) -> datetime:
+    # match how dates are read back from MongoDB
+    return arrow.get(value).to('utc').naive
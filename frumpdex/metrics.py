@@ -0,0 +1,92 @@
+#
+# Copyright (c) 2020, Adam Meily
+# All rights reserved.
+#
+'''
+Lightweight in-process metrics.
+'''
+import threading
+from typing import Dict
+
+
+class Summary:
+    '''
+    Running summary of observed values.
+    '''
+    __slots__ = ('count', 'total', 'min', 'max')
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def observe(self, value: float) -> None:
+        '''
+        Record a value.
+        '''
+        self.count += 1
+        self.total += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    def to_dict(self) -> dict:
+        '''
+        :returns: the summary as a dictionary
+        '''
+        return {
+            'count': self.count,
+            'total': self.total,
+            'min': self.min,
+            'max': self.max,
+            'mean': self.total / self.count if self.count else None
+        }
+
+
+class MetricsRegistry:
+    '''
+    Thread safe registry of counters and summaries.
+    '''
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__counters: Dict[str, int] = {}
+        self.__summaries: Dict[str, Summary] = {}
+
+    def increment(self, name: str, value: int = 1) -> None:
+        '''
+        Increment a counter.
+
+        :param name: counter name
+        :param value: amount to increment by
+        '''
+        with self.__lock:
+            self.__counters[name] = self.__counters.get(name, 0) + value
+
+    def observe(self, name: str, value: float) -> None:
+        '''
+        Record a value in a summary.
+
+        :param name: summary name
+        :param value: observed value
+        '''
+        with self.__lock:
+            summary = self.__summaries.get(name)
+            if not summary:
+                summary = self.__summaries[name] = Summary()
+            summary.observe(value)
+
+    def snapshot(self) -> dict:
+        '''
+        :returns: the current value of every counter and summary
+        '''
+        with self.__lock:
+            return {
+                'counters': dict(self.__counters),
+                'summaries': {name: summary.to_dict()
+                              for name, summary in self.__summaries.items()}
+            }
+
+
+#: process wide metrics registry
+metrics = MetricsRegistry()
@@ -0,0 +1,116 @@
+#
+# Copyright (c) 2020, Adam Meily
+# All rights reserved.
+#
+'''
+In-memory rate limiting and load shedding.
+'''
+import threading
+import time
+from typing import Dict, Hashable
+
+
+class TokenBucket:
+    '''
+    A token bucket that refills at a constant rate up to its capacity.
+    '''
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated')
+
+    def __init__(self, rate: float, capacity: float, now: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = now
+
+    def refill(self, now: float) -> None:
+        '''
+        Add the tokens accumulated since the last update.
+        '''
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self, now: float) -> float:
+        '''
+        Attempt to take a token from the bucket.
+
+        :param now: current monotonic time
+        :returns: ``0`` if a token was taken, otherwise the number of seconds until a token will
+            be available
+        '''
+        self.refill(now)
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+
+class RateLimiter:
+    '''
+    Token bucket rate limiter with a bucket per key.
+
+    :param rate: number of requests allowed per second
+    :param burst: maximum number of requests allowed in a burst
+    :param max_keys: number of buckets to keep before idle buckets are dropped
+    '''
+
+    def __init__(self, rate: float, burst: int, max_keys: int = 10000):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.max_keys = max_keys
+        self.__lock = threading.Lock()
+        self.__buckets: Dict[Hashable, TokenBucket] = {}
+
+    def check(self, key: Hashable) -> float:
+        '''
+        Check whether a request is allowed, consuming a token if it is.
+
+        :param key: rate limit key, such as a user id
+        :returns: ``0`` if the request is allowed, otherwise the number of seconds to wait before
+            retrying
+        '''
+        now = time.monotonic()
+        with self.__lock:
+            bucket = self.__buckets.get(key)
+            if not bucket:
+                if len(self.__buckets) >= self.max_keys:
+                    self._prune(now)
+                bucket = self.__buckets[key] = TokenBucket(self.rate, self.burst, now)
+            return bucket.take(now)
+
+    def _prune(self, now: float) -> None:
+        # a full bucket behaves exactly like a new one, so it's safe to drop
+        for key, bucket in list(self.__buckets.items()):
+            bucket.refill(now)
+            if bucket.tokens >= bucket.capacity:
+                del self.__buckets[key]
+
+
+class InflightLimiter:
+    '''
+    Caps the number of requests being processed at the same time.
+
+    :param limit: maximum number of concurrent requests
+    '''
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.inflight = 0
+        self.__lock = threading.Lock()
+
+    def acquire(self) -> bool:
+        '''
+        :returns: ``True`` if the request may proceed, in which case :meth:`release` must be
+            called when it completes
+        '''
+        with self.__lock:
+            if self.inflight >= self.limit:
+                return False
+            self.inflight += 1
+            return True
+
+    def release(self) -> None:
+        '''
+        Mark a request as complete.
+        '''
+        with self.__lock:
+            self.inflight -= 1
@@ -0,0 +1,452 @@
+#
+# Copyright (c) 2020, Adam Meily
+# All rights reserved.
+#
+'''
+Stock and user counter reconciliation.
+
+The ``ups``, ``downs``, and ``rating`` counters of the ``stocks`` and ``stock_day_activity``
+collections, and the per user counters of the ``user_day_activity`` collection, are maintained by
+independent ``$inc`` updates and can drift from the votes that produced them. Reconciliation
+recomputes the expected counters of an exchange from its votes, wherever they are stored
+(``votes``, ``vote_buckets``, and ``votes_archive``), with aggregation pipelines and reports every
+counter that differs. A missing counter document is a discrepancy too, so fixing an exchange also
+backfills the ``user_day_activity`` documents of votes cast before the collection existed.
+
+Reconciliation is safe to run while the server is live. Fixes are applied as ``$inc`` deltas so
+concurrent votes are never overwritten. A discrepancy is only fixed if the exchange is checked a
+second time and neither the stored nor the expected counters changed in between, and the ``$inc``
+only matches the document if its counters still have the values that were read. A document that
+is updated during the check, such as by a vote that was counted by the aggregation but had not yet
+been applied to the counters when they were read, is therefore left alone rather than double
+counted. Stocks and users with journaled votes whose counter updates are still pending are skipped
+until the replay finishes.
+'''
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from bson import ObjectId
+from pymongo import UpdateOne
+
+from .db import FrumpdexDatabase, ItemDoesNotExist, ObjectIdStr
+
+logger = logging.getLogger(__name__)
+
+#: stock counters that are reconciled
+COUNTERS = ('ups', 'downs', 'rating')
+
+#: user day activity counters that are reconciled
+USER_COUNTERS = ('votes', 'ups', 'downs', 'rating')
+
+#: (stock id, day), the day is ``None`` for the lifetime counters of the stock
+CounterKey = Tuple[ObjectId, Optional[datetime]]
+
+#: pipeline stage that totals individual vote documents per stock and day
+VOTE_TOTALS_GROUP = {'$group': {
+    '_id': {'stock_id': '$stock_id', 'date': '$date'},
+    'ups': {'$sum': {'$cond': [{'$gt': ['$rating', 0]}, 1, 0]}},
+    'downs': {'$sum': {'$cond': [{'$gt': ['$rating', 0]}, 0, 1]}},
+    'rating': {'$sum': '$rating'}
+}}
+
+#: pipeline stage that totals vote bucket summaries per stock and day
+BUCKET_TOTALS_GROUP = {'$group': {
+    '_id': {'stock_id': '$stock_id', 'date': '$date'},
+    'ups': {'$sum': '$ups'},
+    'downs': {'$sum': '$downs'},
+    'rating': {'$sum': '$rating'}
+}}
+
+#: pipeline stage that totals individual vote documents per user and day
+USER_VOTE_TOTALS_GROUP = {'$group': {
+    '_id': {'user_id': '$user_id', 'date': '$date'},
+    'votes': {'$sum': 1},
+    'ups': {'$sum': {'$cond': [{'$gt': ['$rating', 0]}, 1, 0]}},
+    'downs': {'$sum': {'$cond': [{'$gt': ['$rating', 0]}, 0, 1]}},
+    'rating': {'$sum': '$rating'}
+}}
+
+#: pipeline stages that turn vote buckets into one document per vote for USER_VOTE_TOTALS_GROUP
+BUCKET_USER_VOTES = [
+    {'$unwind': '$votes'},
+    {'$project': {'user_id': '$votes.user_id', 'rating': '$votes.rating', 'date': 1}}
+]
+
+
+class Discrepancy:
+    '''
+    A counter document whose values differ from the votes.
+
+    :param collection: ``stocks`` or ``stock_day_activity``
+    :param stock_id: stock id
+    :param day: the day of a ``stock_day_activity`` document
+    :param expected: counters computed from the votes
+    :param actual: counters stored in the document, ``None`` if the document does not exist
+    '''
+
+    #: the counters of the document
+    counters = COUNTERS
+
+    def __init__(self, collection: str, stock_id: ObjectId, day: Optional[datetime],
+                 expected: Dict[str, int], actual: Optional[Dict[str, int]]):
+        self.collection = collection
+        self.stock_id = stock_id
+        self.day = day
+        self.expected = expected
+        self.actual = actual
+
+    @property
+    def delta(self) -> Dict[str, int]:
+        '''
+        :returns: the ``$inc`` document that fixes the counters
+        '''
+        actual = self.actual or {}
+        return {counter: self.expected[counter] - actual.get(counter, 0)
+                for counter in self.counters if self.expected[counter] != actual.get(counter, 0)}
+
+
+class UserDiscrepancy(Discrepancy):
+    '''
+    A ``user_day_activity`` document whose values differ from the votes.
+
+    :param user_id: user id
+    :param day: the day of the document
+    :param expected: counters computed from the votes
+    :param actual: counters stored in the document, ``None`` if the document does not exist
+    '''
+
+    counters = USER_COUNTERS
+
+    def __init__(self, user_id: ObjectId, day: datetime, expected: Dict[str, int],
+                 actual: Optional[Dict[str, int]]):
+        super().__init__('user_day_activity', None, day, expected, actual)
+        self.user_id = user_id
+
+
+class ReconcileReport:
+    '''
+    Result of reconciling a single exchange.
+    '''
+
+    def __init__(self, exchange_id: ObjectId):
+        self.exchange_id = exchange_id
+        self.checked = 0
+        self.discrepancies: List[Discrepancy] = []
+        self.user_discrepancies: List[UserDiscrepancy] = []
+        self.fixed = 0
+
+
+def _vote_totals(db: FrumpdexDatabase, exchange_id: ObjectId,
+                 stock_ids: Iterable[ObjectId] = None) -> Dict[CounterKey, Dict[str, int]]:
+    '''
+    :returns: the expected counters of every stock and day with votes, along with the lifetime
+        counters of each stock
+    '''
+    match = {'exchange_id': exchange_id}
+    if stock_ids is not None:
+        match['stock_id'] = {'$in': list(stock_ids)}
+
+    sources = (
+        (db.votes, VOTE_TOTALS_GROUP),
+        (db.votes_archive, VOTE_TOTALS_GROUP),
+        (db.vote_buckets, BUCKET_TOTALS_GROUP)
+    )
+
+    totals: Dict[CounterKey, Dict[str, int]] = {}
+    for collection, group in sources:
+        for row in collection.aggregate([{'$match': match}, group], allowDiskUse=True):
+            stock_id = row['_id']['stock_id']
+            for key in ((stock_id, row['_id']['date']), (stock_id, None)):
+                total = totals.setdefault(key, dict.fromkeys(COUNTERS, 0))
+                for counter in COUNTERS:
+                    total[counter] += row[counter]
+    return totals
+
+
+def _stored_counters(db: FrumpdexDatabase, exchange_id: ObjectId,
+                     stock_ids: Iterable[ObjectId] = None) -> Dict[CounterKey, Dict[str, int]]:
+    '''
+    :returns: the counters currently stored in the ``stocks`` and ``stock_day_activity``
+        collections
+    '''
+    projection = {counter: 1 for counter in COUNTERS}
+    activity_q = {'exchange_id': exchange_id}
+    stocks_q = {'exchange_id': exchange_id}
+    if stock_ids is not None:
+        activity_q['stock_id'] = {'$in': list(stock_ids)}
+        stocks_q['_id'] = {'$in': list(stock_ids)}
+
+    stored: Dict[CounterKey, Dict[str, int]] = {}
+    for doc in db.stock_day_activity.find(activity_q, dict(projection, stock_id=1, date=1)):
+        stored[(doc['stock_id'], doc['date'])] = {counter: doc.get(counter, 0)
+                                                  for counter in COUNTERS}
+
+    for doc in db.stocks.find(stocks_q, projection):
+        stored[(doc['_id'], None)] = {counter: doc.get(counter, 0) for counter in COUNTERS}
+    return stored
+
+
+def _pending_stocks(db: FrumpdexDatabase, exchange_id: ObjectId) -> set:
+    '''
+    :returns: the stocks with votes whose counter updates have not all been applied yet
+    '''
+    match = {'exchange_id': exchange_id}
+    stock_ids = set(db.votes.distinct('stock_id', dict(match, pending={'$exists': True})))
+    stock_ids.update(db.vote_buckets.distinct('stock_id', dict(match, **{
+        'votes.pending': {'$exists': True}
+    })))
+    return stock_ids
+
+
+def find_discrepancies(db: FrumpdexDatabase, exchange_id: ObjectId,
+                       stock_ids: Iterable[ObjectId] = None) -> Tuple[int, List[Discrepancy]]:
+    '''
+    Compare the stored counters of an exchange against its votes.
+
+    :param db: frumpdex database
+    :param exchange_id: exchange id
+    :param stock_ids: only check these stocks
+    :returns: a tuple of ``(number of counter documents checked, discrepancies)``
+    '''
+    # read the counters first: a vote is stored before its counters are incremented, so a vote
+    # that lands in between is seen by the aggregation and shows up as a transient discrepancy
+    stored = _stored_counters(db, exchange_id, stock_ids)
+    expected = _vote_totals(db, exchange_id, stock_ids)
+    pending = _pending_stocks(db, exchange_id)
+
+    discrepancies = []
+    zero = dict.fromkeys(COUNTERS, 0)
+    for key in stored.keys() | expected.keys():
+        stock_id, day = key
+        if day is None and key not in stored:
+            # votes for a stock that was deleted
+            continue
+
+        if stock_id in pending:
+            # the replay of a journaled vote will update the counters
+            continue
+
+        actual = stored.get(key)
+        if (actual or zero) != expected.get(key, zero):
+            collection = 'stocks' if day is None else 'stock_day_activity'
+            discrepancies.append(Discrepancy(collection, stock_id, day, expected.get(key, zero),
+                                             actual))
+
+    discrepancies.sort(key=lambda item: (str(item.stock_id), item.day or datetime.min))
+    return len(stored), discrepancies
+
+
+def _user_vote_totals(db: FrumpdexDatabase, exchange_id: ObjectId,
+                      user_ids: Iterable[ObjectId] = None) -> Dict[CounterKey, Dict[str, int]]:
+    '''
+    :returns: the expected counters of every user and day with votes
+    '''
+    match = {'exchange_id': exchange_id}
+    bucket_match = {'exchange_id': exchange_id}
+    user_match = {}
+    if user_ids is not None:
+        match['user_id'] = user_match['user_id'] = {'$in': list(user_ids)}
+        # only read buckets that contain a vote of the users
+        bucket_match['votes.user_id'] = match['user_id']
+
+    pipelines = (
+        (db.votes, [{'$match': match}, USER_VOTE_TOTALS_GROUP]),
+        (db.votes_archive, [{'$match': match}, USER_VOTE_TOTALS_GROUP]),
+        (db.vote_buckets, [{'$match': bucket_match}, *BUCKET_USER_VOTES, {'$match': user_match},
+                           USER_VOTE_TOTALS_GROUP])
+    )
+
+    totals: Dict[CounterKey, Dict[str, int]] = {}
+    for collection, pipeline in pipelines:
+        for row in collection.aggregate(pipeline, allowDiskUse=True):
+            key = (row['_id']['user_id'], row['_id']['date'])
+            total = totals.setdefault(key, dict.fromkeys(USER_COUNTERS, 0))
+            for counter in USER_COUNTERS:
+                total[counter] += row[counter]
+    return totals
+
+
+def _stored_user_counters(db: FrumpdexDatabase, exchange_id: ObjectId,
+                          user_ids: Iterable[ObjectId] = None) -> Dict[CounterKey, Dict[str, int]]:
+    '''
+    :returns: the counters currently stored in the ``user_day_activity`` collection
+    '''
+    q = {'exchange_id': exchange_id}
+    if user_ids is not None:
+        q['user_id'] = {'$in': list(user_ids)}
+
+    projection = dict({counter: 1 for counter in USER_COUNTERS}, user_id=1, date=1)
+    return {(doc['user_id'], doc['date']): {counter: doc.get(counter, 0)
+                                            for counter in USER_COUNTERS}
+            for doc in db.user_day_activity.find(q, projection)}
+
+
+def _pending_users(db: FrumpdexDatabase, exchange_id: ObjectId) -> set:
+    '''
+    :returns: the users with votes whose counter updates have not all been applied yet
+    '''
+    match = {'exchange_id': exchange_id}
+    user_ids = set(db.votes.distinct('user_id', dict(match, pending={'$exists': True})))
+    # every voter of a bucket with a pending vote, the pending vote can't be singled out
+    user_ids.update(db.vote_buckets.distinct('votes.user_id', dict(match, **{
+        'votes.pending': {'$exists': True}
+    })))
+    return user_ids
+
+
+def find_user_discrepancies(db: FrumpdexDatabase, exchange_id: ObjectId,
+                            user_ids: Iterable[ObjectId] = None
+                            ) -> Tuple[int, List[UserDiscrepancy]]:
+    '''
+    Compare the stored user day activity counters of an exchange against its votes.
+
+    :param db: frumpdex database
+    :param exchange_id: exchange id
+    :param user_ids: only check these users
+    :returns: a tuple of ``(number of counter documents checked, discrepancies)``
+    '''
+    # read the counters first, see find_discrepancies
+    stored = _stored_user_counters(db, exchange_id, user_ids)
+    expected = _user_vote_totals(db, exchange_id, user_ids)
+    pending = _pending_users(db, exchange_id)
+
+    discrepancies = []
+    zero = dict.fromkeys(USER_COUNTERS, 0)
+    for key in stored.keys() | expected.keys():
+        user_id, day = key
+        if user_id in pending:
+            continue
+
+        actual = stored.get(key)
+        if (actual or zero) != expected.get(key, zero):
+            discrepancies.append(UserDiscrepancy(user_id, day, expected.get(key, zero), actual))
+
+    discrepancies.sort(key=lambda item: (str(item.user_id), item.day))
+    return len(stored), discrepancies
+
+
+def _unchanged(discrepancy: Discrepancy) -> dict:
+    '''
+    :returns: query conditions that only match the counter document if its counters still have the
+        values that were read
+    '''
+    # a counter that is not set was read as 0
+    return {counter: {'$in': [0, None]} if value == 0 else value
+            for counter, value in (discrepancy.actual or {}).items()}
+
+
+def _fix(db: FrumpdexDatabase, exchange_id: ObjectId, discrepancies: List[Discrepancy]) -> int:
+    stock_updates = []
+    activity_updates = []
+    user_updates = []
+    for discrepancy in discrepancies:
+        if isinstance(discrepancy, UserDiscrepancy):
+            user_updates.append(UpdateOne(dict(
+                _unchanged(discrepancy),
+                user_id=discrepancy.user_id,
+                date=discrepancy.day
+            ), {
+                '$inc': discrepancy.delta,
+                '$setOnInsert': {'exchange_id': exchange_id}
+            }, upsert=discrepancy.actual is None))
+        elif discrepancy.collection == 'stocks':
+            stock_updates.append(UpdateOne(dict(_unchanged(discrepancy), _id=discrepancy.stock_id),
+                                           {'$inc': discrepancy.delta}))
+        else:
+            activity_updates.append(UpdateOne(dict(
+                _unchanged(discrepancy),
+                stock_id=discrepancy.stock_id,
+                exchange_id=exchange_id,
+                date=discrepancy.day
+            ), {
+                '$inc': discrepancy.delta
+            }, upsert=discrepancy.actual is None))
+
+    fixed = 0
+    for collection, updates in ((db.stocks, stock_updates),
+                                (db.stock_day_activity, activity_updates),
+                                (db.user_day_activity, user_updates)):
+        if updates:
+            result = collection.bulk_write(updates, ordered=False)
+            # updates of documents that changed since they were read do not match
+            fixed += result.modified_count + result.upserted_count
+
+    for discrepancy in discrepancies:
+        if discrepancy.collection == 'stocks':
+            db.stock_cache.evict(discrepancy.stock_id)
+    db.views.clear(exchange_id)
+    db.leaderboards.clear(exchange_id)
+    db.valuations.clear(exchange_id)
+    db.response_cache.bump(exchange_id)
+    return fixed
+
+
+def reconcile_exchange(db: FrumpdexDatabase, exchange_id: ObjectIdStr, fix: bool = False,
+                       settle: float = 1.0) -> ReconcileReport:
+    '''
+    Reconcile the counters of an exchange.
+
+    :param db: frumpdex database
+    :param exchange_id: exchange id
+    :param fix: fix the discrepancies
+    :param settle: seconds to wait before checking discrepancies a second time prior to fixing
+        them, documents that are updated in between are not fixed
+    :returns: the reconciliation report
+    '''
+    exchange_id = ObjectId(exchange_id)
+    if not db.exchanges.find_one(exchange_id, {'_id': 1}):
+        raise ItemDoesNotExist('exchange')
+
+    report = ReconcileReport(exchange_id)
+    report.checked, report.discrepancies = find_discrepancies(db, exchange_id)
+    user_checked, report.user_discrepancies = find_user_discrepancies(db, exchange_id)
+    report.checked += user_checked
+    found = report.discrepancies + report.user_discrepancies
+    if not fix or not found:
+        return report
+
+    time.sleep(settle)
+    confirmed = []
+    if report.discrepancies:
+        confirmed += find_discrepancies(db, exchange_id,
+                                        {item.stock_id for item in report.discrepancies})[1]
+    if report.user_discrepancies:
+        user_ids = {item.user_id for item in report.user_discrepancies}
+        confirmed += find_user_discrepancies(db, exchange_id, user_ids)[1]
+
+    def identity(item: Discrepancy) -> tuple:
+        return (item.collection, item.stock_id, getattr(item, 'user_id', None), item.day)
+
+    # a document whose stored or expected counters changed between the checks has votes in flight
+    counters = {identity(item): (item.expected, item.actual) for item in found}
+    stable = [item for item in confirmed
+              if counters.get(identity(item)) == (item.expected, item.actual)]
+
+    report.fixed = _fix(db, exchange_id, stable)
+    logger.info(f'reconciled exchange {exchange_id}: {len(found)} discrepancies found, '
+                f'{report.fixed} fixed')
+    return report
+
+
+def reconcile(db: FrumpdexDatabase, exchange_ids: Iterable[ObjectIdStr] = None, fix: bool = False,
+              workers: int = 4, settle: float = 1.0) -> List[ReconcileReport]:
+    '''
+    Reconcile the counters of several exchanges in parallel.
+
+    :param db: frumpdex database
+    :param exchange_ids: the exchanges to reconcile, or every exchange if not specified
+    :param fix: fix the discrepancies
+    :param workers: number of exchanges reconciled at a time
+    :param settle: see :func:`reconcile_exchange`
+    :returns: the report of each exchange
+    '''
+    if exchange_ids is None:
+        exchange_ids = [exchange['_id'] for exchange in db.exchanges.find({}, {'_id': 1})]
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(reconcile_exchange, db, exchange_id, fix, settle)
+                   for exchange_id in exchange_ids]
+        return [future.result() for future in futures]
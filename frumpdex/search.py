@@ -0,0 +1,331 @@
+#
+# Copyright (c) 2020, Adam Meily
+# All rights reserved.
+#
+'''
+In-memory stock search.
+
+Each exchange has a prefix index over the slugified stock names and symbols. Names are also
+indexed from the start of every word, so "parser" finds "Frumpdex Parser". Queries that do not
+produce enough prefix matches fall back to fuzzy matching of the name, its words, or the symbol.
+
+Vote comments are searched by MongoDB text indexes. This module matches the individual votes of a
+vote bucket against the search the same way and extracts the matching snippets of the comments.
+'''
+import difflib
+import re
+import threading
+import time
+import unicodedata
+from bisect import bisect_left, insort
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from bson import ObjectId
+from slugify import slugify
+
+from .stemmer import stem
+
+#: match ranks, lower is better
+EXACT_MATCH = 0
+PREFIX_MATCH = 1
+WORD_PREFIX_MATCH = 2
+FUZZY_MATCH = 3
+
+#: names of the match ranks, as returned by a search
+MATCH_NAMES = ('exact', 'prefix', 'word', 'fuzzy')
+
+#: minimum similarity, between 0 and 1, of a fuzzy match
+FUZZY_CUTOFF = 0.6
+
+#: maximum length of a comment snippet
+SNIPPET_LENGTH = 120
+
+#: a quoted phrase, negated term, or term of a MongoDB ``$text`` search
+TEXT_SEARCH_TOKEN = re.compile(r'(-?)"([^"]*)"|(-?)(\S+)')
+
+#: a word as delimited by a MongoDB text index, which splits on whitespace and punctuation
+TEXT_SEARCH_WORD = re.compile(r'[^\W_]+')
+
+
+class StockSearchIndex:
+    '''
+    Prefix index of the stocks in a single exchange.
+    '''
+
+    def __init__(self, expires: float = None):
+        self.expires = expires
+        self.stocks: Dict[ObjectId, Tuple[str, str]] = {}
+        #: sorted (key, rank, stock id), rank is PREFIX_MATCH or WORD_PREFIX_MATCH
+        self.keys: List[Tuple[str, int, ObjectId]] = []
+        #: sorted (symbol, stock id)
+        self.symbols: List[Tuple[str, ObjectId]] = []
+        #: full name and symbol slugs, used for exact matching
+        self.names: Dict[str, Set[ObjectId]] = {}
+        #: full name and symbol slugs and the individual name words, used for fuzzy matching
+        self.terms: Dict[str, Set[ObjectId]] = {}
+
+    @staticmethod
+    def stock_keys(name: str, symbol: str) -> Set[Tuple[str, int]]:
+        '''
+        :returns: the index keys and ranks of a stock
+        '''
+        slug = slugify(name)
+        keys = {(slug, PREFIX_MATCH), (symbol, PREFIX_MATCH)}
+        words = slug.split('-')
+        for i in range(1, len(words)):
+            keys.add(('-'.join(words[i:]), WORD_PREFIX_MATCH))
+        return {key for key in keys if key[0]}
+
+    def add(self, stock: dict) -> None:
+        '''
+        Add a stock to the index, replacing it if it is already indexed.
+        '''
+        stock_id = stock['_id']
+        if stock_id in self.stocks:
+            self.remove(stock_id)
+
+        name, symbol = stock['name'], stock.get('symbol') or slugify(stock['name'])
+        self.stocks[stock_id] = (name, symbol)
+        for key, rank in self.stock_keys(name, symbol):
+            insort(self.keys, (key, rank, stock_id))
+            if rank == PREFIX_MATCH:
+                self.names.setdefault(key, set()).add(stock_id)
+                self.terms.setdefault(key, set()).add(stock_id)
+        for word in slugify(name).split('-'):
+            if word:
+                self.terms.setdefault(word, set()).add(stock_id)
+        insort(self.symbols, (symbol, stock_id))
+
+    def remove(self, stock_id: ObjectId) -> None:
+        '''
+        Remove a stock from the index.
+        '''
+        if self.stocks.pop(stock_id, None) is None:
+            return
+
+        self.keys = [item for item in self.keys if item[2] != stock_id]
+        self.symbols = [item for item in self.symbols if item[1] != stock_id]
+        for mapping in (self.names, self.terms):
+            for key in [key for key, ids in mapping.items() if stock_id in ids]:
+                mapping[key].discard(stock_id)
+                if not mapping[key]:
+                    del mapping[key]
+
+    def search(self, query: str, limit: int) -> List[dict]:
+        '''
+        :param query: search query
+        :param limit: maximum number of results
+        :returns: the matching stocks, best match first
+        '''
+        query = slugify(query)
+        if not query:
+            return []
+
+        ranks: Dict[ObjectId, int] = {}
+        for stock_id in self.names.get(query, ()):
+            ranks[stock_id] = EXACT_MATCH
+
+        i = bisect_left(self.keys, (query,))
+        while i < len(self.keys) and self.keys[i][0].startswith(query):
+            _, rank, stock_id = self.keys[i]
+            ranks[stock_id] = min(ranks.get(stock_id, rank), rank)
+            i += 1
+
+        if len(ranks) < limit:
+            for key in difflib.get_close_matches(query, list(self.terms), n=limit,
+                                                 cutoff=FUZZY_CUTOFF):
+                for stock_id in self.terms[key]:
+                    ranks.setdefault(stock_id, FUZZY_MATCH)
+
+        results = sorted(ranks.items(),
+                         key=lambda item: (item[1], self.stocks[item[0]][0].lower()))
+        return [{
+            '_id': stock_id,
+            'name': self.stocks[stock_id][0],
+            'symbol': self.stocks[stock_id][1],
+            'match': MATCH_NAMES[rank]
+        } for stock_id, rank in results[:limit]]
+
+    def complete(self, prefix: str) -> List[str]:
+        '''
+        :param prefix: symbol prefix
+        :returns: the symbols that start with ``prefix``
+        '''
+        completions = []
+        i = bisect_left(self.symbols, (prefix,))
+        while i < len(self.symbols) and self.symbols[i][0].startswith(prefix):
+            completions.append(self.symbols[i][0])
+            i += 1
+        return completions
+
+
+class StockSearchIndexes:
+    '''
+    Stock search indexes of every exchange that has been searched. An index is built from the
+    database on first access, kept current by the stock write paths, and rebuilt periodically to
+    pick up changes made by other processes.
+
+    :param refresh_interval: seconds between rebuilding an index
+    '''
+
+    def __init__(self, refresh_interval: float = 300):
+        self.refresh_interval = refresh_interval
+        self.__lock = threading.Lock()
+        self.__indexes: Dict[ObjectId, StockSearchIndex] = {}
+
+    def _get(self, db, exchange_id: ObjectId) -> StockSearchIndex:
+        # must be called with the lock held
+        now = time.monotonic()
+        index = self.__indexes.get(exchange_id)
+        if not index or index.expires <= now:
+            index = StockSearchIndex(now + self.refresh_interval)
+            for stock in db.stocks.find({'exchange_id': exchange_id},
+                                        {'name': 1, 'symbol': 1}):
+                index.add(stock)
+            self.__indexes[exchange_id] = index
+        return index
+
+    def search(self, db, exchange_id: ObjectId, query: str, limit: int = 10) -> List[dict]:
+        '''
+        Search the stocks of an exchange by name and symbol.
+
+        :param db: frumpdex database
+        :param exchange_id: exchange id
+        :param query: search query
+        :param limit: maximum number of results
+        :returns: the matching stocks, best match first
+        '''
+        with self.__lock:
+            return self._get(db, exchange_id).search(query, limit)
+
+    def complete(self, db, exchange_id: ObjectId, prefix: str) -> List[str]:
+        '''
+        :param db: frumpdex database
+        :param exchange_id: exchange id
+        :param prefix: symbol prefix
+        :returns: the symbols in the exchange that start with ``prefix``
+        '''
+        with self.__lock:
+            return self._get(db, exchange_id).complete(prefix)
+
+    def add_stocks(self, stocks: Iterable[dict]) -> None:
+        '''
+        Add new or updated stocks to their exchange indexes.
+        '''
+        with self.__lock:
+            for stock in stocks:
+                index = self.__indexes.get(stock['exchange_id'])
+                if index:
+                    index.add(stock)
+
+    def remove_stock(self, stock_id: ObjectId) -> None:
+        '''
+        Remove a deleted stock.
+        '''
+        with self.__lock:
+            for index in self.__indexes.values():
+                index.remove(stock_id)
+
+    def clear(self, exchange_id: Optional[ObjectId] = None) -> None:
+        '''
+        Drop indexes so they are rebuilt on next access.
+
+        :param exchange_id: the exchange to drop, or every exchange if not specified
+        '''
+        with self.__lock:
+            if exchange_id:
+                self.__indexes.pop(exchange_id, None)
+            else:
+                self.__indexes.clear()
+
+
+def fold_text(text: str) -> str:
+    '''
+    :param text: text
+    :returns: the text in lower case with diacritics removed, as compared by a text index
+    '''
+    decomposed = unicodedata.normalize('NFKD', text)
+    return ''.join(char for char in decomposed if not unicodedata.combining(char)).lower()
+
+
+class TextSearch:
+    '''
+    A MongoDB ``$text`` search string that is matched against a single text the way an English
+    text index matches a document: words are split on whitespace and punctuation, case and
+    diacritics are ignored, and words are compared by their Snowball English stems, the same
+    stemmer that MongoDB uses. A text matches if it contains any of the terms, or every phrase if
+    there are phrases, and none of the negated terms and phrases. Stop words are not removed, so
+    a text that only shares a stop word with the search string matches here but not in a text
+    index.
+
+    :param query: MongoDB ``$text`` search string
+    '''
+
+    def __init__(self, query: str):
+        self.terms: Set[str] = set()
+        self.phrases: List[str] = []
+        self.excluded_terms: Set[str] = set()
+        self.excluded_phrases: List[str] = []
+        for match in TEXT_SEARCH_TOKEN.finditer(query):
+            if match.group(2) is not None:
+                phrase = fold_text(match.group(2).strip())
+                if phrase:
+                    phrases = self.excluded_phrases if match.group(1) else self.phrases
+                    phrases.append(phrase)
+            else:
+                terms = self.excluded_terms if match.group(3) else self.terms
+                terms.update(self.stems(match.group(4)))
+
+    @staticmethod
+    def stems(text: str) -> Set[str]:
+        '''
+        :returns: the stems of the words in the text
+        '''
+        return {stem(fold_text(word)) for word in TEXT_SEARCH_WORD.findall(text)}
+
+    def matches(self, text: str) -> bool:
+        '''
+        :param text: text to match, such as a vote comment
+        :returns: whether the text index would match a document holding only this text
+        '''
+        stems = self.stems(text)
+        folded = fold_text(text)
+        if stems & self.excluded_terms or any(phrase in folded for phrase in self.excluded_phrases):
+            return False
+        if self.phrases:
+            return all(phrase in folded for phrase in self.phrases)
+        return bool(stems & self.terms)
+
+    def position(self, text: str) -> Optional[int]:
+        '''
+        :param text: text to search
+        :returns: the offset of the first term or phrase found in the text, ``None`` if there is
+            none
+        '''
+        positions = [match.start() for match in TEXT_SEARCH_WORD.finditer(text)
+                     if stem(fold_text(match.group())) in self.terms]
+        folded = fold_text(text)
+        positions += [folded.find(phrase) for phrase in self.phrases if phrase in folded]
+        return min(positions) if positions else None
+
+
+def comment_snippet(comment: str, search: Optional[TextSearch],
+                    length: int = SNIPPET_LENGTH) -> str:
+    '''
+    :param comment: vote comment
+    :param search: the search that matched the comment
+    :param length: maximum snippet length
+    :returns: the part of the comment around the first match of ``search``
+    '''
+    if len(comment) <= length:
+        return comment
+
+    position = search.position(comment) if search else None
+    start = max(0, (position or 0) - length // 4)
+    start = min(start, len(comment) - length)
+    snippet = comment[start:start + length].strip()
+    if start > 0:
+        snippet = '...' + snippet
+    if start + length < len(comment):
+        snippet += '...'
+    return snippet
@@ -0,0 +1,93 @@
+#
+# Copyright (c) 2020, Adam Meily
+# All rights reserved.
+#
+'''
+Applied vote sequence numbers.
+
+A vote's sequence number is allocated before the vote is written and votes are written
+concurrently, so the allocated sequence number of an exchange runs ahead of the votes in the
+database. The exchange snapshot must pair its activity counters with the sequence number of
+exactly the votes they include, otherwise a client counts a vote twice or not at all.
+:class:`AppliedSequences` tracks the votes being written by this process and lets the snapshot
+wait for a moment when none are in flight.
+
+Votes written by other server processes are not tracked, their clients are sent their votes by
+the server that accepted them.
+'''
+import threading
+from contextlib import contextmanager
+from typing import Dict, Iterator, Optional
+
+from bson import ObjectId
+
+
+class AppliedSequences:
+    '''
+    Per exchange gate between vote writers, which run concurrently, and snapshot readers, which
+    wait for the writers in flight to finish and hold off new ones while they read.
+    '''
+
+    def __init__(self):
+        self.__cond = threading.Condition()
+        self.__inflight: Dict[ObjectId, int] = {}
+        self.__readers: Dict[ObjectId, int] = {}
+        self.__applied: Dict[ObjectId, int] = {}
+
+    def begin(self, exchange_id: ObjectId, blocking: bool = True) -> bool:
+        '''
+        Start writing a vote. The vote's sequence number must be allocated after this returns.
+
+        :param exchange_id: exchange id
+        :param blocking: wait while a snapshot of the exchange is being read
+        :returns: ``False`` if ``blocking`` is false and a snapshot is being read
+        '''
+        with self.__cond:
+            while self.__readers.get(exchange_id):
+                if not blocking:
+                    return False
+                self.__cond.wait()
+            self.__inflight[exchange_id] = self.__inflight.get(exchange_id, 0) + 1
+            return True
+
+    def end(self, exchange_id: ObjectId, seq: Optional[int]) -> None:
+        '''
+        Finish writing a vote, whether or not the write succeeded. A sequence number that was
+        allocated for a vote that could not be written is never used, so it is treated as
+        applied.
+
+        :param exchange_id: exchange id
+        :param seq: the vote's sequence number, ``None`` if it was never allocated
+        '''
+        with self.__cond:
+            self.__inflight[exchange_id] -= 1
+            if not self.__inflight[exchange_id]:
+                del self.__inflight[exchange_id]
+            if seq is not None:
+                self.__applied[exchange_id] = max(self.__applied.get(exchange_id, 0), seq)
+            self.__cond.notify_all()
+
+    @contextmanager
+    def quiesce(self, exchange_id: ObjectId) -> Iterator[Optional[int]]:
+        '''
+        Wait until no votes of the exchange are being written and hold off new votes until the
+        context exits.
+
+        :param exchange_id: exchange id
+        :returns: the highest sequence number written by this process, ``None`` if it has not
+            written any votes of the exchange
+        '''
+        with self.__cond:
+            self.__readers[exchange_id] = self.__readers.get(exchange_id, 0) + 1
+            while self.__inflight.get(exchange_id):
+                self.__cond.wait()
+            seq = self.__applied.get(exchange_id)
+
+        try:
+            yield seq
+        finally:
+            with self.__cond:
+                self.__readers[exchange_id] -= 1
+                if not self.__readers[exchange_id]:
+                    del self.__readers[exchange_id]
+                self.__cond.notify_all()
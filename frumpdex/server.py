@@ -2,21 +2,31 @@
 # Copyright (c) 2020, Adam Meily
 # All rights reserved.
 #
+import atexit
 import logging
+import math
 import sys
+import socket
 import json
 from typing import List, Optional
 
 from flask import Flask, g, request, session, Blueprint, Response
 import flask.json
 from flask_restful import Api
-from flask_socketio import SocketIO, join_room, leave_room
+from flask_socketio import SocketIO, join_room, leave_room, emit
 from bson import ObjectId
+import bson
+import msgpack
 
 from .db import FrumpdexDatabase
-from .api.lib import serialize_extra_types, get_registered_resources
+from .api.lib import serialize_extra_types, pack_extra_types, get_registered_resources
 from .views.lib import get_blueprints
 from .config import config
+from .events import EventBroadcaster
+from .logs import AsyncLogging, SamplingFilter
+from .compression import ResponseCompression
+from .metrics import metrics
+from .ratelimit import RateLimiter, InflightLimiter
 
 logger = logging.getLogger('frumpdex')
 
@@ -37,6 +47,13 @@ app.secret_key = b'\x89i\xc1\x1f 8B?\xbd\x0b\x95\xa7;0\xd2K'
 app.json_encoder = FrumpdexJsonEncoder
 
 socketio = SocketIO(app, json=flask.json)
+events = EventBroadcaster(socketio, size=config.socketio.replay_buffer_size)
+
+user_vote_limiter = RateLimiter(config.ratelimit.user_votes_per_minute / 60,
+                                config.ratelimit.user_burst)
+exchange_vote_limiter = RateLimiter(config.ratelimit.exchange_votes_per_minute / 60,
+                                    config.ratelimit.exchange_burst)
+inflight_limiter = InflightLimiter(config.ratelimit.max_inflight)
 
 
 @api.representation('application/json')
@@ -45,7 +62,29 @@ def api_json_serializer(data, code, headers=None) -> Response:
     Handles JSON serialization from the REST API.
     '''
     return Response(json.dumps(data, default=serialize_extra_types), code,
-                    mimetype='application/json')
+                    mimetype='application/json', headers=headers)
+
+
+@api.representation('application/bson')
+def api_bson_serializer(data, code, headers=None) -> Response:
+    '''
+    Handles BSON serialization from the REST API. ObjectIds and datetimes are passed through in
+    their native BSON form. BSON documents must be objects so lists are wrapped in an
+    ``{"items": [...]}`` document.
+    '''
+    if not isinstance(data, dict):
+        data = {'items': data}
+    return Response(bson.encode(data), code, mimetype='application/bson', headers=headers)
+
+
+@api.representation('application/msgpack')
+@api.representation('application/x-msgpack')
+def api_msgpack_serializer(data, code, headers=None) -> Response:
+    '''
+    Handles MessagePack serialization from the REST API.
+    '''
+    return Response(msgpack.packb(data, default=pack_extra_types, use_bin_type=True), code,
+                    mimetype='application/msgpack', headers=headers)
 
 
 def get_request_user(db: FrumpdexDatabase) -> Optional[dict]:
@@ -62,19 +101,88 @@ def get_request_user(db: FrumpdexDatabase) -> Optional[dict]:
         if len(parts) == 2 and parts[0] == 'Bearer':
             token = parts[1]
 
-    return db.users.find_one({'token': token}) if token else None
+    return db.find_user_by_token(token) if token else None
+
+
+def error_response(code: int, message: str, retry_after: float) -> Response:
+    '''
+    Build a JSON error response with a ``Retry-After`` header.
+
+    :param code: HTTP status code
+    :param message: error message
+    :param retry_after: number of seconds the client should wait before retrying
+    '''
+    response = Response(json.dumps({'message': message}), code, mimetype='application/json')
+    response.headers['Retry-After'] = str(max(1, math.ceil(retry_after)))
+    return response
+
+
+def is_rate_limited_request() -> bool:
+    '''
+    :returns: the active request is handled by a resource method that is rate limited (listed in
+        the resource's ``RATE_LIMITED_METHODS``)
+    '''
+    view = app.view_functions.get(request.endpoint)
+    view_class = getattr(view, 'view_class', None)
+    return request.method in getattr(view_class, 'RATE_LIMITED_METHODS', ())
+
+
+def check_rate_limits() -> Optional[Response]:
+    '''
+    Check the per-user and per-exchange rate limits of the active request.
+
+    :returns: an error response if the request exceeds a rate limit
+    '''
+    if not g.user or not is_rate_limited_request():
+        return None
+
+    retry_after = user_vote_limiter.check(g.user['_id'])
+    if retry_after:
+        metrics.increment('ratelimit.rejected.user')
+        return error_response(429, 'rate limit exceeded', retry_after)
+
+    retry_after = exchange_vote_limiter.check(g.user['exchange_id'])
+    if retry_after:
+        metrics.increment('ratelimit.rejected.exchange')
+        return error_response(429, 'exchange rate limit exceeded', retry_after)
+
+    return None
 
 
 @app.before_request
-def before_request() -> None:
+def before_request() -> Optional[Response]:
     '''
     Populate the global ``g`` object
     '''
+    g.inflight = False
+    if config.ratelimit.enabled and request.path.startswith('/api/'):
+        # shed load before doing any database work
+        if not inflight_limiter.acquire():
+            metrics.increment('ratelimit.rejected.inflight')
+            return error_response(503, 'server is busy', 1)
+        g.inflight = True
+
     g.db = FrumpdexDatabase.instance()
     g.socketio = socketio
+    g.events = events
+    g.api = api
 
     g.user = get_request_user(g.db)
-    g.exchange = g.db.exchanges.find_one({'_id': g.user['exchange_id']}) if g.user else None
+    g.exchange = g.db.find_exchange(g.user['exchange_id']) if g.user else None
+
+    if config.ratelimit.enabled:
+        return check_rate_limits()
+    return None
+
+
+@app.teardown_request
+def teardown_request(exc) -> None:  # pylint: disable=unused-argument
+    '''
+    Release the in-flight request slot.
+    '''
+    if g.get('inflight'):
+        inflight_limiter.release()
+        g.inflight = False
 
 
 @socketio.on('connect')
@@ -92,23 +200,57 @@ def handle_join_room(data) -> None:
     '''
     Authenticate the user attempting to join a web socket room and verify that they have proper
     authorization (belong to the correct Exchange).
+
+    A client that is rejoining after a reconnect sends the sequence number of the last vote it
+    received in ``since_seq``. The missed votes are replayed from the room's event buffer, or, if
+    the buffer doesn't reach back far enough, a ``resync`` event with a full exchange snapshot is
+    sent instead.
     '''
     room = data["room"]
-    user = get_request_user(FrumpdexDatabase.instance())
+    db = FrumpdexDatabase.instance()
+    user = get_request_user(db)
 
     if room.startswith('exchange.'):
         exchange_id = room.split('.', 1)[1]
         if user and exchange_id == str(user['exchange_id']):
-            logger.debug(f'join room: {room}')
+            logger.debug('join room: %s', room)
             join_room(room)
 
+            since_seq = data.get('since_seq')
+            if isinstance(since_seq, int):
+                resync_room(db, room, user['exchange_id'], since_seq)
+
+
+def resync_room(db: FrumpdexDatabase, room: str, exchange_id: ObjectId, since_seq: int) -> None:
+    '''
+    Send the events a rejoining client missed.
+
+    :param db: frumpdex database
+    :param room: room name
+    :param exchange_id: the room's exchange id
+    :param since_seq: the last sequence number the client received
+    '''
+    missed = events.buffer.since(room, since_seq)
+    if missed is None and db.vote_sequence(exchange_id) == since_seq:
+        # nothing has been buffered since the server started and the client is up to date
+        missed = []
+
+    if missed is None:
+        logger.debug('resync room %s from snapshot: seq %s is not buffered', room, since_seq)
+        emit('resync', db.exchange_snapshot(exchange_id))
+        return
+
+    logger.debug('replaying %d events to room %s since seq %s', len(missed), room, since_seq)
+    for _, event, event_data in missed:
+        emit(event, event_data)
+
 
 @socketio.on('leave')
 def handle_leave_room(data):
     '''
     Websocket client leave room.
     '''
-    logger.debug(f'leave room: {data["room"]}')
+    logger.debug('leave room: %s', data['room'])
     leave_room(data['room'])
 
 
@@ -139,15 +281,29 @@ def setup_logging(logfile: str, debug: bool, silent: bool) -> None:
     :param silent: don't print anything to stdout/stderr
     '''
     fmt = '[%(asctime)s] %(levelname)s: %(message)s'
+    handlers = []
     if not silent:
         handler = logging.StreamHandler(sys.stdout)
         handler.setFormatter(logging.Formatter(fmt))
-        logger.addHandler(handler)
+        handlers.append(handler)
 
     if logfile:
         handler = logging.FileHandler(logfile, 'a')
         handler.setFormatter(logging.Formatter(fmt))
-        logger.addHandler(handler)
+        handlers.append(handler)
+
+    sampling = None
+    if config.logging.sample_burst:
+        sampling = SamplingFilter(config.logging.sample_burst, config.logging.sample_interval)
+
+    if config.logging.asynchronous:
+        pipeline = AsyncLogging(logger, handlers, config.logging.queue_size, sampling)
+        atexit.register(pipeline.stop)
+    else:
+        for handler in handlers:
+            if sampling:
+                handler.addFilter(sampling)
+            logger.addHandler(handler)
 
     logger.setLevel(logging.DEBUG if debug else logging.INFO)
 
@@ -159,19 +315,43 @@ def run_server(debug: bool = False, host: str = '127.0.0.1', port: int = 5000,
     Run the frumpdex server.
     '''
     setup_logging(logfile, debug=debug, silent=silent)
+    setup_server(mongo_uri, port)
+
+    if cors_allowed_origins:
+        # is this a hack? idk
+        socketio.server.eio.cors_allowed_origins = cors_allowed_origins
+
+    logger.info(f'starting frumpdex server: http://{host}:{port}')
+    socketio.run(app, debug=debug, host=host, port=port)
+
+
+def setup_server(mongo_uri: str, port: int) -> FrumpdexDatabase:
+    '''
+    Connect to the database, start the background workers, and register the APIs and views.
 
+    :param mongo_uri: MongoDB URI
+    :param port: web server listening port, part of the default change stream consumer name
+    :returns: the frumpdex database
+    '''
     db = FrumpdexDatabase.instance()
     db.connect(mongo_uri)
+    if config.journal.enabled:
+        db.enable_journal(config.journal.path, config.journal.max_segment_size,
+                          config.journal.retry_interval)
+    db.leaderboards.load(db)
+    if config.invalidation.enabled:
+        db.enable_invalidation(config.invalidation.consumer or f'{socket.gethostname()}:{port}',
+                               config.invalidation.save_interval)
 
     register_apis()
     register_views()
 
-    if cors_allowed_origins:
-        # is this a hack? idk
-        socketio.server.eio.cors_allowed_origins = cors_allowed_origins
+    if config.compression.enabled:
+        ResponseCompression(app, min_size=config.compression.min_size,
+                            level=config.compression.level,
+                            brotli_quality=config.compression.brotli_quality)
 
-    logger.info(f'starting frumpdex server: http://{host}:{port}')
-    socketio.run(app, debug=debug, host=host, port=port)
+    return db
 
 
 if __name__ == '__main__':
@@ -191,6 +371,8 @@ if __name__ == '__main__':
                         help='comma-separated list of allowed origins ("*") for all')
     parser.add_argument('-c', '--config', type='str', action='store',
                         help='load configuration file')
+    parser.add_argument('--asyncio', action='store_true',
+                        help='run the asyncio server (requires aiohttp and motor)')
 
     args = parser.parse_args()
     if args.cors_allowed_origins:
@@ -202,6 +384,12 @@ if __name__ == '__main__':
     else:
         cors_allowed_origins = None
 
-    run_server(debug=args.debug, host=args.host, port=args.port, logfile=args.logfile,
-               silent=args.silent, mongo_uri=args.mongo_uri,
-               cors_allowed_origins=cors_allowed_origins)
+    if args.asyncio:
+        from .aserver import run_async_server
+        server_main = run_async_server
+    else:
+        server_main = run_server
+
+    server_main(debug=args.debug, host=args.host, port=args.port, logfile=args.logfile,
+                silent=args.silent, mongo_uri=args.mongo_uri,
+                cors_allowed_origins=cors_allowed_origins)
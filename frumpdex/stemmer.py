@@ -0,0 +1,173 @@
+#
+# Copyright (c) 2020, Adam Meily
+# All rights reserved.
+#
+'''
+Snowball English (Porter2) stemmer.
+
+MongoDB text indexes with the default ``english`` language stem words with the Snowball English
+stemmer before indexing and searching them. Vote buckets embed many votes in one text indexed
+document, so matching a single vote's comment against a search string has to stem its words the
+same way, which is what this module is for. It implements the algorithm as published at
+https://snowballstem.org/algorithms/english/stemmer.html, in the revision shipped with MongoDB.
+'''
+from typing import Optional, Tuple
+
+VOWELS = frozenset('aeiouy')
+DOUBLES = ('bb', 'dd', 'ff', 'gg', 'mm', 'nn', 'pp', 'rr', 'tt')
+LI_ENDINGS = frozenset('cdeghkmnrt')
+
+#: words that are not stemmed by the rules
+EXCEPTIONS = {
+    'skis': 'ski', 'skies': 'sky', 'dying': 'die', 'lying': 'lie', 'tying': 'tie',
+    'idly': 'idl', 'gently': 'gentl', 'ugly': 'ugli', 'early': 'earli', 'only': 'onli',
+    'singly': 'singl', 'sky': 'sky', 'news': 'news', 'howe': 'howe', 'atlas': 'atlas',
+    'cosmos': 'cosmos', 'bias': 'bias', 'andes': 'andes'
+}
+
+#: words that are left alone after step 1a
+STEP_1A_INVARIANTS = frozenset(('inning', 'outing', 'canning', 'herring', 'earring', 'proceed',
+                                'exceed', 'succeed'))
+
+#: prefixes whose R1 region starts right after the prefix
+R1_PREFIXES = ('gener', 'commun', 'arsen')
+
+#: step 2 suffixes and their replacements, longest first
+STEP_2 = (('ization', 'ize'), ('ational', 'ate'), ('fulness', 'ful'), ('ousness', 'ous'),
+          ('iveness', 'ive'), ('tional', 'tion'), ('biliti', 'ble'), ('lessli', 'less'),
+          ('entli', 'ent'), ('ation', 'ate'), ('alism', 'al'), ('aliti', 'al'), ('ousli', 'ous'),
+          ('iviti', 'ive'), ('fulli', 'ful'), ('enci', 'ence'), ('anci', 'ance'),
+          ('abli', 'able'), ('izer', 'ize'), ('ator', 'ate'), ('alli', 'al'), ('bli', 'ble'),
+          ('ogi', 'og'), ('li', ''))
+
+#: step 3 suffixes and their replacements, longest first, ``None`` is deleted when in R2
+STEP_3 = (('ational', 'ate'), ('tional', 'tion'), ('alize', 'al'), ('icate', 'ic'),
+          ('iciti', 'ic'), ('ative', None), ('ical', 'ic'), ('ness', ''), ('ful', ''))
+
+#: step 4 suffixes, longest first
+STEP_4 = ('ement', 'ance', 'ence', 'able', 'ible', 'ment', 'ant', 'ent', 'ism', 'ate', 'iti',
+          'ous', 'ive', 'ize', 'ion', 'al', 'er', 'ic')
+
+
+def _longest(word: str, suffixes: Tuple[str, ...]) -> Optional[str]:
+    for suffix in suffixes:
+        if word.endswith(suffix):
+            return suffix
+    return None
+
+
+def _region(word: str, start: int) -> int:
+    # the region after the first non-vowel that follows a vowel, at or after start
+    for i in range(start + 1, len(word)):
+        if word[i] not in VOWELS and word[i - 1] in VOWELS:
+            return i + 1
+    return len(word)
+
+
+def _ends_short_syllable(word: str) -> bool:
+    if len(word) == 2:
+        return word[0] in VOWELS and word[1] not in VOWELS
+    return (len(word) > 2 and word[-3] not in VOWELS and word[-2] in VOWELS and
+            word[-1] not in VOWELS and word[-1] not in 'wxY')
+
+
+def _has_vowel(word: str) -> bool:
+    return any(char in VOWELS for char in word)
+
+
+def stem(word: str) -> str:
+    '''
+    :param word: lower case word
+    :returns: the word's stem
+    '''
+    if len(word) <= 2:
+        return word
+    if word in EXCEPTIONS:
+        return EXCEPTIONS[word]
+
+    word = word.lstrip("'")
+    if word.startswith('y'):
+        word = 'Y' + word[1:]
+    for i in range(1, len(word)):
+        if word[i] == 'y' and word[i - 1] in VOWELS:
+            word = word[:i] + 'Y' + word[i + 1:]
+
+    prefix = next((prefix for prefix in R1_PREFIXES if word.startswith(prefix)), None)
+    r1 = len(prefix) if prefix else _region(word, 0)
+    r2 = _region(word, r1)
+
+    # step 0
+    suffix = _longest(word, ("'s'", "'s", "'"))
+    if suffix:
+        word = word[:-len(suffix)]
+
+    # step 1a
+    suffix = _longest(word, ('sses', 'ied', 'ies', 'us', 'ss', 's'))
+    if suffix == 'sses':
+        word = word[:-2]
+    elif suffix in ('ied', 'ies'):
+        word = word[:-3] + ('i' if len(word) > 4 else 'ie')
+    elif suffix == 's' and _has_vowel(word[:-2]):
+        word = word[:-1]
+
+    if word in STEP_1A_INVARIANTS:
+        return word
+
+    # step 1b
+    suffix = _longest(word, ('eedly', 'ingly', 'edly', 'eed', 'ing', 'ed'))
+    if suffix in ('eed', 'eedly'):
+        if len(word) - len(suffix) >= r1:
+            word = word[:-len(suffix)] + 'ee'
+    elif suffix and _has_vowel(word[:-len(suffix)]):
+        word = word[:-len(suffix)]
+        if word.endswith(('at', 'bl', 'iz')):
+            word += 'e'
+        elif word.endswith(DOUBLES):
+            word = word[:-1]
+        elif r1 >= len(word) and _ends_short_syllable(word):
+            word += 'e'
+
+    # step 1c
+    if len(word) > 2 and word[-1] in 'yY' and word[-2] not in VOWELS:
+        word = word[:-1] + 'i'
+
+    # step 2
+    for suffix, replacement in STEP_2:
+        if word.endswith(suffix):
+            if len(word) - len(suffix) >= r1:
+                if suffix == 'ogi':
+                    if word[-4:-3] == 'l':
+                        word = word[:-3] + replacement
+                elif suffix == 'li':
+                    if word[-3:-2] and word[-3] in LI_ENDINGS:
+                        word = word[:-2]
+                else:
+                    word = word[:-len(suffix)] + replacement
+            break
+
+    # step 3
+    for suffix, replacement in STEP_3:
+        if word.endswith(suffix):
+            if len(word) - len(suffix) >= r1:
+                if replacement is None:
+                    if len(word) - len(suffix) >= r2:
+                        word = word[:-len(suffix)]
+                else:
+                    word = word[:-len(suffix)] + replacement
+            break
+
+    # step 4
+    suffix = _longest(word, STEP_4)
+    if suffix and len(word) - len(suffix) >= r2:
+        if suffix != 'ion' or word[-4:-3] in ('s', 't'):
+            word = word[:-len(suffix)]
+
+    # step 5
+    if word.endswith('e'):
+        if (len(word) - 1 >= r2 or
+                (len(word) - 1 >= r1 and not _ends_short_syllable(word[:-1]))):
+            word = word[:-1]
+    elif word.endswith('ll') and len(word) - 1 >= r2:
+        word = word[:-1]
+
+    return word.replace('Y', 'y')
@@ -0,0 +1,123 @@
+#
+# Copyright (c) 2020, Adam Meily
+# All rights reserved.
+#
+'''
+Columnar daily time series built from ``stock_day_activity`` documents.
+'''
+from datetime import date, datetime, timedelta
+from typing import Iterable, List, Optional
+
+import arrow
+import numpy as np
+
+#: supported time series buckets
+BUCKETS = ('day', 'week', 'month')
+
+#: activity counters included in each series
+SERIES_FIELDS = ('ups', 'downs', 'rating')
+
+ONE_DAY = np.timedelta64(1, 'D')
+
+
+def to_local_days(values: List[datetime]) -> np.ndarray:
+    '''
+    Convert activity dates to local calendar days. Activity dates are local midnight stored as
+    UTC, so the local UTC offset is applied and the result is rounded to the nearest day, which
+    also absorbs daylight savings transitions.
+
+    :param values: activity dates (naive UTC or timezone aware)
+    :returns: array of ``datetime64[D]``
+    '''
+    if not values:
+        return np.array([], dtype='datetime64[D]')
+
+    offset = arrow.now().utcoffset() or timedelta(0)
+    utc = np.array([arrow.get(value).to('utc').naive if value.tzinfo else value
+                    for value in values],
+                   dtype='datetime64[m]')
+    local = utc + np.timedelta64(int(offset.total_seconds() // 60), 'm')
+    return (local + np.timedelta64(12, 'h')).astype('datetime64[D]')
+
+
+def bucket_boundaries(days: np.ndarray, bucket: str) -> np.ndarray:
+    '''
+    :param days: contiguous array of ``datetime64[D]``
+    :param bucket: bucket size
+    :returns: the index of the first day of each bucket
+    '''
+    if bucket == 'day':
+        return np.arange(len(days))
+
+    if bucket == 'week':
+        # 1970-01-01 was a Thursday, shift so that buckets start on Monday
+        mask = ((days - np.datetime64('1970-01-05')) // ONE_DAY) % 7 == 0
+    else:
+        mask = days == days.astype('datetime64[M]').astype('datetime64[D]')
+
+    mask[0] = True
+    return np.flatnonzero(mask)
+
+
+def build_series(rows: Iterable[dict], start: Optional[date], end: date, bucket: str = 'day',
+                 max_points: int = None) -> dict:
+    '''
+    Build per-stock time series from day activity documents. The activity is accumulated into
+    dense ``stocks x days`` matrices which are then reduced into buckets.
+
+    :param rows: ``stock_day_activity`` documents
+    :param start: the first day of the series, or the oldest activity if not specified
+    :param end: the last day of the series
+    :param bucket: bucket size, "day", "week", or "month"
+    :param max_points: maximum number of points per series, consecutive buckets are merged until
+        the series fits
+    :returns: the columnar time series
+    '''
+    rows = list(rows)
+    stock_ids = []
+    stock_index = {}
+    row_stocks = np.empty(len(rows), dtype=np.int64)
+    for i, row in enumerate(rows):
+        index = stock_index.get(row['stock_id'])
+        if index is None:
+            index = stock_index[row['stock_id']] = len(stock_ids)
+            stock_ids.append(row['stock_id'])
+        row_stocks[i] = index
+
+    row_days = to_local_days([row['date'] for row in rows])
+    first = np.datetime64(start, 'D') if start else (row_days.min() if len(rows) else
+                                                      np.datetime64(end, 'D'))
+    last = np.datetime64(end, 'D')
+    days = np.arange(first, last + ONE_DAY, dtype='datetime64[D]')
+
+    in_range = (row_days >= first) & (row_days <= last)
+    row_stocks = row_stocks[in_range]
+    row_offsets = ((row_days[in_range] - first) // ONE_DAY).astype(np.int64)
+
+    matrices = {}
+    for field in SERIES_FIELDS:
+        values = np.array([row.get(field, 0) for row in rows], dtype=np.int64)[in_range]
+        matrix = np.zeros((len(stock_ids), len(days)), dtype=np.int64)
+        np.add.at(matrix, (row_stocks, row_offsets), values)
+        matrices[field] = matrix
+
+    boundaries = bucket_boundaries(days, bucket) if len(days) else np.array([], dtype=np.int64)
+    if max_points and len(boundaries) > max_points:
+        stride = -(-len(boundaries) // max_points)
+        boundaries = boundaries[::stride]
+
+    series = []
+    if len(boundaries):
+        reduced = {field: np.add.reduceat(matrix, boundaries, axis=1)
+                   for field, matrix in matrices.items()}
+        for i, stock_id in enumerate(stock_ids):
+            item = {'stock_id': stock_id}
+            for field in SERIES_FIELDS:
+                item[field] = reduced[field][i].tolist()
+            series.append(item)
+
+    return {
+        'bucket': bucket,
+        'dates': [str(day) for day in days[boundaries]],
+        'series': series
+    }
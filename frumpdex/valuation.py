@@ -0,0 +1,346 @@
+#
+# Copyright (c) 2020, Adam Meily
+# All rights reserved.
+#
+'''
+Stock valuation.
+
+Every stock starts at the same initial value and compounds a daily return derived from its
+``stock_day_activity``::
+
+    return = clip(vote_weight * (ups - downs) + rating_weight * rating
+                  + gitlab_weight * log(1 + gitlab events), -max_change, max_change)
+
+    value[day] = value[day - 1] * (1 + return)
+
+The value series of every stock in an exchange are computed together as ``stocks x days`` NumPy
+matrices covering at most ``max_days`` days. A day without activity has no return, so older
+activity compounds into a single starting value per stock without a column per day. The values at
+the close of each past day are cached per exchange until the day changes, for a bounded number of
+exchanges.
+Today's activity is kept as a small counter matrix that is updated as votes arrive, so the current
+values are recomputed from yesterday's close without reading the database.
+'''
+import threading
+import time
+from collections import OrderedDict
+from datetime import date, datetime
+from typing import Iterable, List, Optional
+
+import arrow
+import numpy as np
+from bson import ObjectId
+
+from .leaderboard import local_date
+from .timeseries import ONE_DAY, to_local_days
+
+#: columns of the activity counter matrices
+ACTIVITY_FIELDS = ('ups', 'downs', 'rating', 'gitlab')
+
+
+class ValuationModel:
+    '''
+    Parameters of the daily return of a stock.
+
+    :param initial_value: value of a stock before it has any activity
+    :param vote_weight: return per net up vote
+    :param rating_weight: return per point of total rating
+    :param gitlab_weight: return per log GitLab event
+    :param max_change: maximum absolute daily return
+    '''
+
+    def __init__(self, initial_value: float = 1000.0, vote_weight: float = 0.01,
+                 rating_weight: float = 0.002, gitlab_weight: float = 0.005,
+                 max_change: float = 0.1):
+        self.initial_value = initial_value
+        self.vote_weight = vote_weight
+        self.rating_weight = rating_weight
+        self.gitlab_weight = gitlab_weight
+        self.max_change = max_change
+
+    def returns(self, activity: np.ndarray) -> np.ndarray:
+        '''
+        :param activity: activity counters, the last axis is :data:`ACTIVITY_FIELDS`
+        :returns: the daily returns, with the last axis removed
+        '''
+        ups, downs, rating, gitlab = np.moveaxis(activity, -1, 0)
+        returns = (self.vote_weight * (ups - downs) + self.rating_weight * rating +
+                   self.gitlab_weight * np.log1p(np.maximum(gitlab, 0)))
+        return np.clip(returns, -self.max_change, self.max_change)
+
+
+class ExchangeValuation:
+    '''
+    Value series of every stock in an exchange.
+
+    :param model: valuation model
+    :param stock_ids: the stocks of the exchange
+    :param first: the first day of the series
+    :param today: the current local day
+    '''
+
+    def __init__(self, model: ValuationModel, stock_ids: List[ObjectId], first: np.datetime64,
+                 today: date):
+        self.model = model
+        self.stock_ids = list(stock_ids)
+        self.index = {stock_id: i for i, stock_id in enumerate(self.stock_ids)}
+        self.first = first
+        self.today = today
+        self.loaded = time.monotonic()
+        #: whether there is activity before ``first`` that is folded into ``base``
+        self.truncated = False
+        #: value of each stock at the start of ``first``
+        self.base = np.full(len(self.stock_ids), model.initial_value)
+        #: value of each stock at the close of each day from ``first`` until yesterday
+        self.closes = np.zeros((len(self.stock_ids), 0))
+        #: today's activity of each stock
+        self.activity = np.zeros((len(self.stock_ids), len(ACTIVITY_FIELDS)), dtype=np.int64)
+
+    @classmethod
+    def load(cls, db, exchange_id: ObjectId, model: ValuationModel,
+             max_days: int) -> 'ExchangeValuation':
+        '''
+        Compute the value series of an exchange from its activity history.
+
+        :param db: frumpdex database
+        :param exchange_id: exchange id
+        :param model: valuation model
+        :param max_days: maximum number of days in the value series, older activity is only
+            reflected in the values of the first day
+        :returns: the exchange valuation
+        '''
+        stock_ids = [stock['_id'] for stock in db.stocks.find({'exchange_id': exchange_id},
+                                                              {'_id': 1})]
+        rows = list(db.stock_day_activity.find({'exchange_id': exchange_id}, {
+            'stock_id': 1, 'date': 1, 'ups': 1, 'downs': 1, 'rating': 1,
+            'gitlab_activity.total': 1
+        }))
+
+        today = arrow.now().date()
+        last = np.datetime64(today, 'D')
+        row_days = to_local_days([row['date'] for row in rows])
+        first = min(row_days.min(), last) if len(rows) else last
+        limit = last - np.timedelta64(max_days - 1, 'D')
+        valuation = cls(model, stock_ids, max(first, limit), today)
+        valuation.truncated = first < limit
+        first = valuation.first
+
+        row_stocks = np.array([valuation.index.get(row['stock_id'], -1) for row in rows],
+                              dtype=np.int64)
+        valid = (row_stocks >= 0) & (row_days <= last)
+        values = np.array([[row.get('ups', 0), row.get('downs', 0), row.get('rating', 0),
+                            (row.get('gitlab_activity') or {}).get('total', 0)]
+                           for row in rows], dtype=np.int64).reshape(len(rows),
+                                                                     len(ACTIVITY_FIELDS))
+
+        older = valid & (row_days < first)
+        if older.any():
+            # total the older activity per stock and day, then compound each day's return
+            keys = np.stack([row_stocks[older], row_days[older].astype(np.int64)], axis=1)
+            keys, inverse = np.unique(keys, axis=0, return_inverse=True)
+            totals = np.zeros((len(keys), len(ACTIVITY_FIELDS)), dtype=np.int64)
+            np.add.at(totals, inverse.reshape(-1), values[older])
+            np.multiply.at(valuation.base, keys[:, 0], 1 + model.returns(totals))
+        valid &= row_days >= first
+
+        days = int((last - first) // ONE_DAY) + 1
+        activity = np.zeros((len(stock_ids), days, len(ACTIVITY_FIELDS)), dtype=np.int64)
+        np.add.at(activity, (row_stocks[valid], ((row_days[valid] - first) // ONE_DAY)
+                             .astype(np.int64)), values[valid])
+
+        returns = model.returns(activity[:, :-1])
+        valuation.closes = valuation.base[:, np.newaxis] * np.cumprod(1 + returns, axis=1)
+        valuation.activity = activity[:, -1].copy()
+        return valuation
+
+    def previous_close(self) -> np.ndarray:
+        '''
+        :returns: the value of each stock at the close of yesterday
+        '''
+        if self.closes.shape[1]:
+            return self.closes[:, -1]
+        return self.base
+
+    def current(self) -> np.ndarray:
+        '''
+        :returns: the current value of each stock
+        '''
+        return self.previous_close() * (1 + self.model.returns(self.activity))
+
+    def add_stock(self, stock_id: ObjectId) -> int:
+        '''
+        Add a stock without any activity.
+
+        :returns: the index of the stock
+        '''
+        index = self.index.get(stock_id)
+        if index is None:
+            index = self.index[stock_id] = len(self.stock_ids)
+            self.stock_ids.append(stock_id)
+            self.base = np.append(self.base, self.model.initial_value)
+            self.closes = np.vstack([self.closes, np.full((1, self.closes.shape[1]),
+                                                          self.model.initial_value)])
+            self.activity = np.vstack([self.activity, np.zeros((1, len(ACTIVITY_FIELDS)),
+                                                               dtype=np.int64)])
+        return index
+
+    def series(self, start: Optional[date], end: date,
+               stock_id: ObjectId = None) -> dict:
+        '''
+        :param start: the first day of the series, or the first day with activity if not
+            specified, the series starts no earlier than the oldest retained day
+        :param end: the last day of the series
+        :param stock_id: only include this stock
+        :returns: the columnar value series
+        '''
+        first = np.datetime64(start, 'D') if start else self.first
+        if self.truncated:
+            first = max(first, self.first)
+        last = min(np.datetime64(end, 'D'), np.datetime64(self.today, 'D'))
+        days = np.arange(first, last + ONE_DAY, dtype='datetime64[D]')
+
+        values = np.hstack([self.closes, self.current()[:, np.newaxis]])
+        offsets = ((days - self.first) // ONE_DAY).astype(np.int64)
+        # stocks hold their initial value before the first day with activity
+        before = offsets < 0
+        matrix = values[:, np.clip(offsets, 0, None)]
+        matrix[:, before] = self.model.initial_value
+
+        rows = [self.index[stock_id]] if stock_id else range(len(self.stock_ids))
+        return {
+            'dates': [str(day) for day in days],
+            'series': [{
+                'stock_id': self.stock_ids[i],
+                'values': np.round(matrix[i], 2).tolist()
+            } for i in rows]
+        }
+
+
+class StockValuations:
+    '''
+    Valuations of the most recently accessed exchanges.
+
+    :param model: valuation model
+    :param max_days: maximum number of days in each exchange's value series
+    :param max_entries: maximum number of cached exchange valuations
+    '''
+
+    def __init__(self, model: ValuationModel = None, max_days: int = 3660,
+                 max_entries: int = 64):
+        self.model = model or ValuationModel()
+        self.max_days = max_days
+        self.max_entries = max_entries
+        #: seconds before a valuation is recomputed, ``None`` to keep valuations until cleared
+        self.max_age: Optional[float] = None
+        self.__lock = threading.Lock()
+        self.__valuations: 'OrderedDict[ObjectId, ExchangeValuation]' = OrderedDict()
+
+    def _get(self, db, exchange_id: ObjectId) -> ExchangeValuation:
+        # must be called with the lock held
+        valuation = self.__valuations.get(exchange_id)
+        if (not valuation or valuation.today != arrow.now().date() or
+                (self.max_age and time.monotonic() - valuation.loaded > self.max_age)):
+            valuation = self.__valuations[exchange_id] = ExchangeValuation.load(
+                db, exchange_id, self.model, self.max_days)
+            while len(self.__valuations) > self.max_entries:
+                self.__valuations.popitem(last=False)
+        self.__valuations.move_to_end(exchange_id)
+        return valuation
+
+    def values(self, db, exchange_id: ObjectId) -> List[dict]:
+        '''
+        :param db: frumpdex database
+        :param exchange_id: exchange id
+        :returns: the current value of every stock in the exchange and its change since
+            yesterday's close
+        '''
+        with self.__lock:
+            valuation = self._get(db, exchange_id)
+            previous = valuation.previous_close()
+            current = valuation.current()
+            return [{
+                'stock_id': stock_id,
+                'value': round(float(current[i]), 2),
+                'change': round(float(current[i] - previous[i]), 2)
+            } for i, stock_id in enumerate(valuation.stock_ids)]
+
+    def series(self, db, exchange_id: ObjectId, start: Optional[date], end: date,
+               stock_id: ObjectId = None) -> dict:
+        '''
+        :param db: frumpdex database
+        :param exchange_id: exchange id
+        :param start: the first day of the series, or the first day with activity if not
+            specified, the series starts no earlier than the oldest retained day
+        :param end: the last day of the series
+        :param stock_id: only include this stock
+        :returns: the daily value series of the stocks in the exchange
+        '''
+        with self.__lock:
+            valuation = self._get(db, exchange_id)
+            if stock_id and stock_id not in valuation.index:
+                return {'dates': [], 'series': []}
+            return valuation.series(start, end, stock_id)
+
+    def record_vote(self, stock: dict, day: datetime, ups: int, downs: int, rating: int) -> None:
+        '''
+        Add a vote to today's activity.
+
+        :param stock: the stock that was voted on
+        :param day: the day of the vote
+        :param ups: number of up votes
+        :param downs: number of down votes
+        :param rating: vote rating
+        '''
+        with self.__lock:
+            valuation = self.__valuations.get(stock['exchange_id'])
+            if not valuation:
+                return
+
+            if local_date(day) != valuation.today:
+                self.__valuations.pop(stock['exchange_id'])
+                return
+
+            index = valuation.add_stock(stock['_id'])
+            valuation.activity[index, :3] += (ups, downs, rating)
+
+    def set_activity(self, exchange_id: ObjectId, stock_id: ObjectId, day: datetime, ups: int,
+                     downs: int, rating: int, gitlab: int) -> None:
+        '''
+        Set a stock's activity to the values stored in the database. Unlike
+        :meth:`record_vote`, this is idempotent and is used to apply changes made by other
+        processes.
+        '''
+        with self.__lock:
+            valuation = self.__valuations.get(exchange_id)
+            if not valuation:
+                return
+
+            if local_date(day) != valuation.today:
+                # past activity changed, every later close is affected
+                self.__valuations.pop(exchange_id)
+                return
+
+            index = valuation.add_stock(stock_id)
+            valuation.activity[index] = (ups, downs, rating, gitlab)
+
+    def add_stocks(self, stocks: Iterable[dict]) -> None:
+        '''
+        Add newly created stocks to their exchange valuations.
+        '''
+        with self.__lock:
+            for stock in stocks:
+                valuation = self.__valuations.get(stock['exchange_id'])
+                if valuation:
+                    valuation.add_stock(stock['_id'])
+
+    def clear(self, exchange_id: ObjectId = None) -> None:
+        '''
+        Drop cached valuations so they are recomputed on next access.
+
+        :param exchange_id: the exchange to drop, or every exchange if not specified
+        '''
+        with self.__lock:
+            if exchange_id:
+                self.__valuations.pop(exchange_id, None)
+            else:
+                self.__valuations.clear()
@@ -0,0 +1,51 @@
+import os
+
+from flask import Blueprint, abort, request, send_from_directory
+
+from ..assets import DIST_DIR, ENCODINGS, get_manifest
+
+blueprint = Blueprint('assets', __name__, url_prefix='/assets')
+
+#: bundle filenames contain a content hash so they can be cached forever
+IMMUTABLE_MAX_AGE = 365 * 24 * 60 * 60
+
+MIMETYPES = {
+    '.js': 'application/javascript',
+    '.css': 'text/css'
+}
+
+
+@blueprint.app_context_processor
+def inject_assets() -> dict:
+    manifest = get_manifest()
+
+    def asset_url(name: str) -> str:
+        return f'/assets/{manifest[name]}'
+
+    return {'asset_manifest': manifest, 'asset_url': asset_url}
+
+
+@blueprint.route('/<path:filename>')
+def asset_file(filename: str):
+    ext = os.path.splitext(filename)[1]
+    if ext not in MIMETYPES:
+        abort(404)
+
+    # serve the precompressed variant the client prefers
+    served = filename
+    encoding = None
+    for candidate, suffix in ENCODINGS.items():
+        if candidate in request.accept_encodings and \
+                os.path.isfile(os.path.join(DIST_DIR, filename + suffix)):
+            served = filename + suffix
+            encoding = candidate
+            break
+
+    response = send_from_directory(DIST_DIR, served, mimetype=MIMETYPES[ext])
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+    response.headers['Vary'] = 'Accept-Encoding'
+    response.cache_control.public = True
+    response.cache_control.max_age = IMMUTABLE_MAX_AGE
+    response.cache_control.immutable = True
+    return response
@@ -10,4 +10,5 @@ blueprint = Blueprint('exchange', __name__)
 @blueprint.route('/activity')
 @auth_required
 def activity():
-    return render_template('exchange-activity.html')
+    snapshot = g.db.exchange_snapshot(g.exchange['_id'])
+    return render_template('exchange-activity.html', snapshot=snapshot)
@@ -5,6 +5,12 @@ blueprint = Blueprint('vendor', __name__, static_folder='../../node_modules', ur
 
 NODE_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..', 'node_modules'))
 
+#: vendor files are not content hashed, so they are only cached for a short time
+VENDOR_MAX_AGE = 60 * 60
+
 @blueprint.route('/<path:filename>')
 def vendor_file(filename: str):
-    return send_from_directory(NODE_DIR, filename)
+    response = send_from_directory(NODE_DIR, filename)
+    response.cache_control.public = True
+    response.cache_control.max_age = VENDOR_MAX_AGE
+    return response
@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2020, Adam Meily
+# All rights reserved.
+#
+'''
+Load test a running frumpdex server, requires the ``aiohttp`` package.
+
+Run the same workload against the threaded server (``python -m frumpdex.server``) and the asyncio
+server (``python -m frumpdex.server --asyncio``) to compare them. Disable rate limiting in the
+server's configuration first, otherwise most votes will be rejected with 429.
+
+    python scripts/benchmark.py --token TOKEN --stock-id STOCK_ID --workload mixed
+
+Reference results, 10 second runs with both servers backed by an in-process mongomock database
+(no MongoDB server or network round trips, so they compare request handling overhead only;
+mongomock serializes writes, which caps vote throughput for both servers):
+
+    workload  clients  threaded req/s  p50 / p99 ms   asyncio req/s  p50 / p99 ms
+    vote      10       143.8           56.5 / 177.6   159.6          51.1 / 140.9
+    vote      50       138.4           306.3 / 799.3  139.5          318.7 / 676.8
+    activity  10       610.5           15.7 / 32.0    2829.8         3.2 / 6.6
+    activity  50       693.4           70.0 / 116.5   2345.3         21.3 / 31.8
+    mixed     10       355.4           25.4 / 67.3    463.9          19.1 / 58.1
+    mixed     50       308.4           160.3 / 228.6  448.8          106.5 / 281.7
+
+Re-run against a real MongoDB deployment before drawing conclusions about vote throughput.
+'''
+import argparse
+import asyncio
+import random
+import statistics
+import time
+from collections import Counter
+from typing import List
+
+import aiohttp
+
+
+async def vote(session: aiohttp.ClientSession, args) -> int:
+    async with session.post(f'{args.url}/api/v1/stocks/{args.stock_id}/votes', data={
+        'direction': random.choice(('up', 'down')),
+        'comment': 'benchmark',
+        'rating': str(random.randint(1, 5))
+    }) as response:
+        await response.read()
+        return response.status
+
+
+async def activity(session: aiohttp.ClientSession, args) -> int:
+    async with session.get(f'{args.url}/api/v1/exchange/activity') as response:
+        await response.read()
+        return response.status
+
+
+WORKLOADS = {
+    'vote': (vote,),
+    'activity': (activity,),
+    'mixed': (vote, activity, activity, activity)
+}
+
+
+async def worker(session: aiohttp.ClientSession, args, deadline: float, latencies: List[float],
+                 statuses: Counter) -> None:
+    requests = WORKLOADS[args.workload]
+    while time.monotonic() < deadline:
+        request = random.choice(requests)
+        start = time.perf_counter()
+        try:
+            status = await request(session, args)
+        except aiohttp.ClientError as err:
+            status = type(err).__name__
+        latencies.append(time.perf_counter() - start)
+        statuses[status] += 1
+
+
+def percentile(values: List[float], pct: float) -> float:
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+async def run(args) -> None:
+    latencies: List[float] = []
+    statuses: Counter = Counter()
+    headers = {'Authorization': f'Bearer {args.token}'}
+    connector = aiohttp.TCPConnector(limit=args.concurrency)
+    async with aiohttp.ClientSession(headers=headers, connector=connector) as session:
+        start = time.monotonic()
+        deadline = start + args.duration
+        await asyncio.gather(*[worker(session, args, deadline, latencies, statuses)
+                               for _ in range(args.concurrency)])
+        elapsed = time.monotonic() - start
+
+    if not latencies:
+        print('no requests completed')
+        return
+
+    latencies.sort()
+    print(f'workload:    {args.workload}, {args.concurrency} concurrent clients')
+    print(f'requests:    {len(latencies)} in {elapsed:.1f}s ({len(latencies) / elapsed:.1f}/s)')
+    print(f'status:      {", ".join(f"{key}={value}" for key, value in statuses.items())}')
+    print(f'latency ms:  mean={statistics.mean(latencies) * 1000:.1f} '
+          f'p50={percentile(latencies, 50) * 1000:.1f} '
+          f'p95={percentile(latencies, 95) * 1000:.1f} '
+          f'p99={percentile(latencies, 99) * 1000:.1f}')
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='frumpdex load test')
+    parser.add_argument('--url', default='http://127.0.0.1:5000', help='server url')
+    parser.add_argument('--token', required=True, help='user api token')
+    parser.add_argument('--stock-id', help='stock to vote on, required by vote workloads')
+    parser.add_argument('-c', '--concurrency', type=int, default=50, help='concurrent clients')
+    parser.add_argument('-d', '--duration', type=float, default=30, help='seconds to run')
+    parser.add_argument('-w', '--workload', choices=list(WORKLOADS), default='mixed',
+                        help='requests to send')
+    args = parser.parse_args()
+
+    if args.workload != 'activity' and not args.stock_id:
+        parser.error(f'--stock-id is required by the {args.workload} workload')
+
+    asyncio.run(run(args))
+
+
+if __name__ == '__main__':
+    main()
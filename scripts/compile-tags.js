@@ -0,0 +1,40 @@
+/*
+ * Copyright (c) 2020, Adam Meily
+ * All rights reserved.
+ *
+ * Precompile riot tags into a single script that registers each component with riot.
+ *
+ * usage: node scripts/compile-tags.js <tag directory> <output file>
+ */
+const fs = require('fs');
+const path = require('path');
+const {compile} = require('@riotjs/compiler');
+
+const TAG_EXT = '.tag.html';
+
+function compileTag(filename) {
+  const source = fs.readFileSync(filename, 'utf8');
+  const name = path.basename(filename, TAG_EXT);
+  const {code} = compile(source, {file: filename});
+
+  // the compiler emits an ES module, turn the default export into a riot.register() call
+  const body = code.replace(/export default/, 'return');
+  return `riot.register(${JSON.stringify(name)}, (function() {\n${body}\n})());\n`;
+}
+
+function main(argv) {
+  if(argv.length != 2) {
+    console.error('usage: compile-tags.js <tag directory> <output file>');
+    return 1;
+  }
+
+  const [tagDir, output] = argv;
+  const tags = fs.readdirSync(tagDir).filter(name => name.endsWith(TAG_EXT)).sort();
+  const compiled = tags.map(name => compileTag(path.join(tagDir, name)));
+
+  fs.writeFileSync(output, compiled.join('\n'));
+  console.log(`compiled ${tags.length} tags -> ${output}`);
+  return 0;
+}
+
+process.exit(main(process.argv.slice(2)));